@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmark_monitor.py - 设备监控器端到端基准测试
+用 message_generator 合成的回放文件驱动 DeviceMonitor（--source file），
+在 10k/1M/10M 等规模下统计吞吐量（条/秒）、峰值内存(RSS)与写盘字节数，
+结果保存为JSON，可与之前的结果对比发现性能回退
+
+使用示例:
+  python3 benchmark_monitor.py --scales 10k,1m --output bench.json
+  python3 benchmark_monitor.py --scales 10k,1m --compare bench.json
+  python3 benchmark_monitor.py --scales 10k,1m --consumer-mode process   # 同时报告各工作进程与协调进程耗时
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional
+
+from device_ids import format_bytes
+from message_generator import MessageGenerator, DEFAULT_TOPICS, write_topic_files
+from monitor_device_online import (
+    CONSUMER_MODES,
+    PARSER_BACKENDS,
+    DeviceMonitor,
+    OffsetCheckpointStore,
+    StateSnapshotStore,
+    read_io_counters,
+)
+
+
+# 规模后缀
+SCALE_UNITS = {'k': 1000, 'm': 1000000}
+
+# 对比时参与回退判断的指标: 指标名 -> 越大越好
+COMPARE_METRICS = {
+    'msgs_per_sec': True,
+    'peak_rss_bytes': False,
+    'write_bytes': False,
+}
+
+
+def parse_scale(text: str) -> int:
+    """解析规模（如 10k、1m、10m 或纯数字）"""
+    text = text.strip().lower()
+    if text and text[-1] in SCALE_UNITS:
+        return int(float(text[:-1]) * SCALE_UNITS[text[-1]])
+    return int(text)
+
+
+def peak_rss_bytes(who: str = 'self') -> Optional[int]:
+    """峰值常驻内存（字节）：who 为 'self' 时是本进程，'children' 时是已回收子进程中最大的一个"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    scope = resource.RUSAGE_CHILDREN if who == 'children' else resource.RUSAGE_SELF
+    peak = resource.getrusage(scope).ru_maxrss
+    # Linux 以KB为单位，macOS 以字节为单位
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_monitor(replay_pattern: str, work_dir: Path, settings: Dict) -> Dict:
+    """在当前进程中用回放文件端到端运行一次 DeviceMonitor，返回计时与计数"""
+    # 所有文件放在工作目录，不影响同目录下运行中的守护进程（PID文件、控制套接字等）
+    monitor = DeviceMonitor(parser_backend=settings['parser'])
+    monitor.pid_file = work_dir / "device_monitor.pid"
+    monitor.output_dir = work_dir / "output"
+    monitor.log_file = work_dir / "device_monitor.log"
+    monitor.checkpoint_file = work_dir / "device_monitor.offsets.json"
+    monitor.checkpoints = OffsetCheckpointStore(monitor.checkpoint_file)
+    monitor.snapshots = StateSnapshotStore(work_dir / "device_monitor.snapshot")
+    monitor.control_socket = work_dir / "device_monitor.sock"
+    monitor.metrics_interval = 0
+    monitor.source_type = "file"
+    monitor.replay_path = replay_pattern
+    monitor.consumer_mode = settings['consumer_mode']
+    monitor.batch_size = settings['batch_size']
+    monitor.pipeline_queue_size = settings['pipeline_queue']
+    
+    monitor.setup_logging()
+    monitor.create_output_files()
+    monitor.running = True
+    monitor.start_time = time.time()
+    monitor.output_writer.start_flusher()
+    
+    io_start = read_io_counters()
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    monitor.start_kafka_consumers()
+    elapsed = time.perf_counter() - start
+    # 本进程的CPU时间；多进程模式下即协调进程（工作进程的耗时见 workers）
+    cpu_seconds = time.process_time() - cpu_start
+    
+    # 停止过程（整理输出文件、快照、写出缓冲）单独计时
+    stop_start = time.perf_counter()
+    processed = monitor.processed_count
+    business = monitor.business_msg_count
+    stats = monitor.snapshot_stats()
+    monitor.stop_monitoring()
+    shutdown = time.perf_counter() - stop_start
+    io_end = read_io_counters()
+    
+    output_bytes = sum(path.stat().st_size for path in monitor.output_dir.glob("*.txt"))
+    self_peak, children_peak = peak_rss_bytes('self'), peak_rss_bytes('children')
+    peaks = [peak for peak in (self_peak, children_peak) if peak]
+    result = {
+        'processed': processed,
+        'business': business,
+        'seconds': elapsed,
+        'shutdown_seconds': shutdown,
+        'cpu_seconds': cpu_seconds,
+        'msgs_per_sec': processed / elapsed if elapsed > 0 else 0.0,
+        # 本进程与最大的工作进程（多进程模式）中较大的峰值；两者分别见 self_/children_peak_rss_bytes
+        'peak_rss_bytes': max(peaks) if peaks else None,
+        'self_peak_rss_bytes': self_peak,
+        'children_peak_rss_bytes': children_peak,
+        # wchar: 经 write 系统调用写出的字节数（输出文件、日志、检查点与快照），含各工作进程
+        'write_bytes': io_end['wchar'] - io_start['wchar'] if io_start and io_end else None,
+        'output_file_bytes': output_bytes,
+        'apps': stats,
+    }
+    if settings['consumer_mode'] == 'process':
+        # 主题 -> 工作进程的运行/CPU秒数与写出字节数；协调进程应用增量（写输出文件、合并状态）的累计耗时
+        result['workers'] = monitor.worker_times
+        result['coordinator_apply_seconds'] = monitor.worker_apply_seconds
+        result['coordinator_write_bytes'] = result['write_bytes']
+        worker_bytes = [times.get('write_bytes') for times in monitor.worker_times.values()]
+        if result['write_bytes'] is not None and None not in worker_bytes:
+            result['write_bytes'] += sum(worker_bytes)
+    return result
+
+
+def run_scale_subprocess(replay_pattern: str, settings: Dict) -> Dict:
+    """在独立子进程中运行一次，使峰值内存只反映该规模"""
+    work_dir = Path(tempfile.mkdtemp(prefix="device_monitor_bench_"))
+    try:
+        cmd = [sys.executable, os.path.abspath(__file__), '--run-one', replay_pattern,
+               '--work-dir', str(work_dir), '--settings', json.dumps(settings)]
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, check=True)
+        return json.loads(result.stdout.decode('utf-8').strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def prepare_data(data_dir: Path, count: int, seed: int) -> str:
+    """生成（或复用已有的）该规模的回放文件，返回带 {topic} 占位符的路径"""
+    replay_pattern = str(data_dir / f"{count}_{seed}_{{topic}}.txt")
+    if all(Path(replay_pattern.format(topic=topic)).exists() for topic, _ in DEFAULT_TOPICS):
+        return replay_pattern
+    
+    devices = max(100, count // len(DEFAULT_TOPICS) // 10)
+    start = time.perf_counter()
+    write_topic_files(MessageGenerator(devices=devices, seed=seed), replay_pattern, count)
+    print(f"  生成 {count} 条消息（每应用 {devices} 个设备）耗时 {time.perf_counter() - start:.1f}s")
+    return replay_pattern
+
+
+def format_size(size: Optional[int]) -> str:
+    return format_bytes(size) if size is not None else "-"
+
+
+def compare_results(previous: Dict, current: Dict, tolerance: float) -> int:
+    """与之前的结果按规模对比，返回超出容差的回退项数"""
+    baseline = {result['scale']: result for result in previous.get('results', [])}
+    regressions = 0
+    print("\n与基线对比:")
+    for result in current['results']:
+        before = baseline.get(result['scale'])
+        if before is None:
+            print(f"  {result['scale']:>6}: 基线中没有该规模")
+            continue
+        parts = []
+        for metric, higher_is_better in COMPARE_METRICS.items():
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > tolerance:
+                flag = " ✗"
+                regressions += 1
+            parts.append(f"{metric} {change:+.1%}{flag}")
+        print(f"  {result['scale']:>6}: " + ", ".join(parts))
+    return regressions
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="设备监控器端到端基准测试")
+    parser.add_argument('--scales', default='10k,1m,10m',
+                        help='消息规模列表（默认 10k,1m,10m）')
+    parser.add_argument('--seed', type=int, default=42, help='合成消息的随机种子（默认42）')
+    parser.add_argument('--data-dir', default=None,
+                        help='回放文件目录（指定时保留并复用生成的文件，默认使用临时目录）')
+    parser.add_argument('--parser', default='auto', choices=['auto'] + list(PARSER_BACKENDS),
+                        help='消息解析后端（默认auto）')
+    parser.add_argument('--consumer-mode', default='thread', choices=CONSUMER_MODES,
+                        help='消费模式（默认thread）')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='批量消费每批最多消息条数（默认1000，1为逐条处理）')
+    parser.add_argument('--pipeline-queue', type=int, default=64,
+                        help='读取/处理队列容量（默认64，0为在读取线程中处理）')
+    parser.add_argument('--output', default=None,
+                        help='结果JSON文件（默认 benchmark_results_<时间>.json）')
+    parser.add_argument('--compare', default=None,
+                        help='与之前的结果JSON对比，吞吐下降或内存/写盘增加超过容差时返回非0')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='对比容差（默认0.10，即10%%）')
+    parser.add_argument('--run-one', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--work-dir', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--settings', default=None, help=argparse.SUPPRESS)
+    
+    args = parser.parse_args()
+    
+    if args.run_one:
+        # 子进程: 运行单个规模并在最后一行输出JSON
+        result = run_monitor(args.run_one, Path(args.work_dir), json.loads(args.settings))
+        print(json.dumps(result, ensure_ascii=False))
+        return
+    
+    try:
+        scales = [(text.strip(), parse_scale(text)) for text in args.scales.split(',') if text.strip()]
+    except ValueError:
+        print(f"✗ 无效的规模: {args.scales}")
+        sys.exit(1)
+    
+    settings = {
+        'parser': args.parser,
+        'consumer_mode': args.consumer_mode,
+        'batch_size': args.batch_size,
+        'pipeline_queue': args.pipeline_queue,
+    }
+    
+    print("=" * 60)
+    print("设备监控器端到端基准测试")
+    print("=" * 60)
+    print(f"规模: {', '.join(label for label, _ in scales)}")
+    print(f"配置: {json.dumps(settings, ensure_ascii=False)}")
+    
+    data_dir = Path(args.data_dir) if args.data_dir else Path(tempfile.mkdtemp(prefix="device_monitor_data_"))
+    data_dir.mkdir(parents=True, exist_ok=True)
+    results = []
+    try:
+        for label, count in scales:
+            print(f"\n[{label}] {count} 条消息")
+            replay_pattern = prepare_data(data_dir, count, args.seed)
+            result = run_scale_subprocess(replay_pattern, settings)
+            result.update({'scale': label, 'messages': count})
+            results.append(result)
+            print(f"  吞吐: {result['msgs_per_sec']:,.0f} 条/秒 ({result['seconds']:.2f}s, "
+                  f"停止 {result['shutdown_seconds']:.2f}s)")
+            print(f"  峰值内存(本进程与工作进程取大): {format_size(result['peak_rss_bytes'])}, "
+                  f"写盘: {format_size(result['write_bytes'])}, "
+                  f"输出文件: {format_size(result['output_file_bytes'])}")
+            if 'workers' in result:
+                for topic_name, times in sorted(result['workers'].items()):
+                    print(f"  工作进程 {topic_name}: 运行 {times['seconds']:.2f}s, CPU {times['cpu_seconds']:.2f}s, "
+                          f"写出 {format_size(times.get('write_bytes'))}")
+                print(f"  协调进程: CPU {result['cpu_seconds']:.2f}s, "
+                      f"应用增量 {result['coordinator_apply_seconds']:.2f}s, "
+                      f"写出 {format_size(result['coordinator_write_bytes'])}, "
+                      f"峰值内存 {format_size(result['self_peak_rss_bytes'])}")
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'host': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'settings': settings,
+        'seed': args.seed,
+        'results': results,
+    }
+    output = Path(args.output or f"benchmark_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n✓ 结果已保存: {output}")
+    
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+        if compare_results(previous, report, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmark_parser.py - 消息解析后端微基准测试
+对比 regex / json / fastjson 解析后端在录制消息上的吞吐量
+
+录制消息示例:
+  kafka-console-consumer.sh --bootstrap-server 10.1.1.177:19092 \\
+      --topic s17_dcs_dev_online_10001 --from-beginning --max-messages 100000 > messages.txt
+"""
+
+import sys
+import time
+import random
+import argparse
+from pathlib import Path
+from typing import List, Dict
+
+from monitor_device_online import (
+    available_parser_backends,
+    create_message_parser,
+    RegexFieldParser,
+)
+
+
+def generate_sample_messages(count: int) -> List[str]:
+    """未提供录制文件时，生成与线上格式一致的样例消息"""
+    rng = random.Random(42)
+    messages = []
+    for i in range(count):
+        if i % 50 == 0:
+            messages.append(f"[2024-01-01 00:00:00,000] WARNING sample system line {i}")
+            continue
+        dev_sn = f"0099{rng.randrange(0x10000, 0xFFFFF):05X}"
+        status = "ONLINE" if rng.random() < 0.7 else "OFFLINE"
+        messages.append(
+            f'{{"devSn": "{dev_sn}", "onlineStatus": "{status}", '
+            f'"changeTime": {1700000000000 + i}, "devId": "dev{rng.randrange(100000)}", '
+            f'"plateNum": "粤B{rng.randrange(10000, 99999)}", "appId": "1000{1 + i % 2}"}}'
+        )
+    return messages
+
+
+def load_messages(file_path: Path, limit: int = None) -> List[str]:
+    """读取录制的消息文件（每行一条原始消息）"""
+    messages = []
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                messages.append(line)
+                if limit and len(messages) >= limit:
+                    break
+    return messages
+
+
+def run_backend(backend: str, messages: List[str], rounds: int) -> Dict[str, float]:
+    """对单个解析后端计时，取多轮中的最佳结果"""
+    parser = create_message_parser(backend)
+    is_system_message = parser.is_system_message
+    extract_fields = parser.extract_fields
+    
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for message in messages:
+            if not is_system_message(message):
+                extract_fields(message)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    
+    return {
+        'backend': parser.name,
+        'seconds': best,
+        'msgs_per_sec': len(messages) / best if best > 0 else 0.0,
+    }
+
+
+def check_consistency(backends: List[str], messages: List[str]) -> int:
+    """校验各后端与基准正则解析结果一致，返回不一致的消息数"""
+    reference = RegexFieldParser()
+    parsers = [create_message_parser(backend) for backend in backends]
+    mismatches = 0
+    for message in messages:
+        if reference.is_system_message(message):
+            continue
+        expected = reference.extract_fields(message)
+        for parser in parsers:
+            if parser.extract_fields(message) != expected:
+                mismatches += 1
+                if mismatches <= 5:
+                    print(f"  不一致 [{parser.name}]: {message[:100]}")
+                break
+    return mismatches
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="消息解析后端微基准测试")
+    parser.add_argument('file', nargs='?',
+                       help='录制的消息文件（每行一条消息，不指定则生成样例消息）')
+    parser.add_argument('--limit', type=int, default=None,
+                       help='最多读取的消息条数')
+    parser.add_argument('--count', type=int, default=100000,
+                       help='生成样例消息的条数（默认100000）')
+    parser.add_argument('--rounds', type=int, default=3,
+                       help='每个后端的计时轮数（默认3）')
+    
+    args = parser.parse_args()
+    
+    if args.file:
+        messages = load_messages(Path(args.file), args.limit)
+        source = args.file
+    else:
+        messages = generate_sample_messages(args.count)
+        source = "生成的样例消息"
+    
+    if not messages:
+        print("✗ 没有可用的消息")
+        sys.exit(1)
+    
+    backends = available_parser_backends()
+    
+    print("=" * 60)
+    print("消息解析后端基准测试")
+    print("=" * 60)
+    print(f"消息来源: {source}")
+    print(f"消息条数: {len(messages)}")
+    print(f"可用后端: {', '.join(backends)}")
+    
+    print("\n结果一致性校验:")
+    mismatches = check_consistency(backends, messages)
+    print(f"  不一致消息数: {mismatches}")
+    
+    print("\n吞吐量 (最佳轮次):")
+    results = [run_backend(backend, messages, args.rounds) for backend in backends]
+    baseline = results[0]['seconds']
+    for result in results:
+        speedup = baseline / result['seconds'] if result['seconds'] > 0 else 0.0
+        print(f"  {result['backend']:<10} {result['seconds']:.3f}s  "
+              f"{result['msgs_per_sec']:>12,.0f} 条/秒  x{speedup:.2f}")
+
+
+if __name__ == "__main__":
+    main()
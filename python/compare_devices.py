@@ -2,16 +2,107 @@
 # -*- coding: utf-8 -*-
 """
 compare_devices.py - 对比设备文件，找出离线设备
-对比all_devices.txt和在线设备文件，输出离线设备列表
+对比all_devices.txt和在线设备文件（自动发现 device_online_output 下的全部 online_devices_*.txt），
+输出离线设备列表
 """
 
 import os
+import re
 import sys
+import time
+import zlib
+import heapq
+import shutil
 import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from pathlib import Path
-from typing import Set, List, Dict
+from typing import Set, List, Dict, Tuple, Iterator, Iterable, Optional
 from datetime import datetime
 
+from device_ids import DeviceIdRegistry, DeviceSet, memory_report, format_bytes
+from device_files import read_device_list, parse_device_lines, map_file, strip_comment_lines, needs_strip
+
+
+# 在线设备文件名: online_devices_{应用ID}.txt
+ONLINE_FILE_PATTERN = re.compile(r'^online_devices_(.+)\.txt$')
+
+# 未发现任何在线设备文件时检查的默认应用
+DEFAULT_APP_IDS = ("10001", "10002")
+
+
+def split_device_bytes(data: bytes) -> List[bytes]:
+    """从设备列表字节内容中切分设备序列号（不解码），规则与 parse_device_lines 相同"""
+    body = strip_comment_lines(data)
+    if needs_strip(body):
+        return [line for line in (line.strip() for line in body.split(b'\n')) if line]
+    return body.split()
+
+
+def read_partition(paths: List[Path]) -> Set[bytes]:
+    """读入一个分区的全部分区文件（同一源文件的各字节段各有一个）"""
+    devices: Set[bytes] = set()
+    for path in paths:
+        with map_file(path) as data:
+            devices.update(data[:].split(b'\n'))
+    devices.discard(b'')
+    return devices
+
+
+def byte_ranges(size: int, chunk_size: int) -> List[Tuple[int, int]]:
+    """把 size 字节的文件按 chunk_size 切为字节段（至少一段），段边界在工作进程中对齐到行首"""
+    chunks = max(1, -(-size // max(1, chunk_size)))
+    step = -(-size // chunks) if size else 0
+    return [(index * step, min(size, (index + 1) * step)) for index in range(chunks)]
+
+
+def line_start(data: bytes, pos: int) -> int:
+    """pos 处或之后的第一个行首（pos 恰为行首时不变）"""
+    if pos <= 0:
+        return 0
+    newline = data.find(b'\n', pos - 1)
+    return len(data) if newline == -1 else newline + 1
+
+
+def partition_device_file(file_path: Path, start: int, end: int, output_prefix: str, partitions: int) -> int:
+    """（工作进程）把设备文件字节段 [start, end) 中的行按 devSn 的 CRC32 分到 partitions 个分区文件
+    {output_prefix}.{分区}，返回行数
+    
+    行首落在段内的行属于该段，相邻两段按同一规则对齐，每行恰好由一个段处理。
+    """
+    with map_file(file_path) as data:
+        lines = split_device_bytes(data[line_start(data, start):line_start(data, end)])
+    buckets = [[] for _ in range(partitions)]
+    crc32 = zlib.crc32
+    for line in lines:
+        buckets[crc32(line) % partitions].append(line)
+    for partition, bucket in enumerate(buckets):
+        with open(f"{output_prefix}.{partition}", 'wb') as f:
+            if bucket:
+                f.write(b'\n'.join(bucket) + b'\n')
+    return len(lines)
+
+
+def diff_partition(all_paths: List[Path], online_paths: List[Tuple[str, List[Path]]], offline_path: Path
+                   ) -> Tuple[int, int, Dict[str, int], int]:
+    """（工作进程）对一个分区求差，离线设备排序后写入 offline_path
+    
+    返回 (总设备数, 在线并集设备数, 各应用在线设备数, 离线设备数)，同一 devSn 只会落在一个分区，
+    各分区结果直接相加即为全局结果。
+    """
+    all_devices = read_partition(all_paths)
+    online: Set[bytes] = set()
+    online_by_app = {}
+    for app_id, paths in online_paths:
+        devices = read_partition(paths)
+        online_by_app[app_id] = len(devices)
+        online |= devices
+    offline = sorted(all_devices.difference(online))
+    with open(offline_path, 'wb') as f:
+        if offline:
+            f.write(b'\n'.join(offline) + b'\n')
+    return len(all_devices), len(online), online_by_app, len(offline)
+
 
 class DeviceComparator:
     """设备对比器"""
@@ -21,34 +112,55 @@ class DeviceComparator:
         self.all_devices_file = self.script_dir / "all_devices.txt"
         self.output_dir = self.script_dir / "device_online_output"
         
-        # 在线设备文件列表
-        self.online_files = [
-            ("10001", self.output_dir / "online_devices_10001.txt"),
-            ("10002", self.output_dir / "online_devices_10002.txt")
-        ]
+        # devSn编码表：所有设备文件共用，集合只保存设备ID位图
+        self.registry = DeviceIdRegistry()
+        
+        # 在线设备文件列表 [(应用ID, 路径)]：输出目录下的全部 online_devices_*.txt
+        self.online_files = self.discover_online_files()
     
-    def read_device_file(self, file_path: Path) -> Set[str]:
+    def discover_online_files(self) -> List[Tuple[str, Path]]:
+        """按应用ID排序列出输出目录中的在线设备文件；一个都没有时返回默认应用的路径（供缺失提示）"""
+        files = []
+        if self.output_dir.is_dir():
+            for file_path in self.output_dir.iterdir():
+                match = ONLINE_FILE_PATTERN.match(file_path.name)
+                if match and file_path.is_file():
+                    files.append((match.group(1), file_path))
+        if not files:
+            return [(app_id, self.output_dir / f"online_devices_{app_id}.txt") for app_id in DEFAULT_APP_IDS]
+        return sorted(files, key=lambda item: (len(item[0]), item[0]))
+    
+    def read_device_file(self, file_path: Path) -> DeviceSet:
         """读取设备文件，返回设备序列号集合"""
-        devices = set()
-        
+        return self.read_device_files([file_path])[0]
+    
+    @staticmethod
+    def load_device_list(file_path: Path) -> Tuple[Optional[List[str]], Optional[str]]:
+        """读取设备文件的设备序列号列表，返回 (列表, 错误信息)，文件不存在时列表为 None"""
         if not file_path.exists():
-            print(f"警告: 文件不存在 - {file_path}")
-            return devices
-        
+            return None, None
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    # 跳过空行和注释行
-                    if line and not line.startswith('#'):
-                        devices.add(line)
-            
-            print(f"✓ 读取文件: {file_path.name} - {len(devices)} 个设备")
-            return devices
-            
+            # 批量读取，跳过空行和注释行
+            return read_device_list(file_path), None
         except Exception as e:
-            print(f"✗ 读取文件失败: {file_path} - {e}")
-            return devices
+            return [], str(e)
+    
+    def read_device_files(self, file_paths: List[Path], jobs: int = None) -> List[DeviceSet]:
+        """用线程池并发读取多个设备文件，再按顺序登记到共用的编码表（编码表只在本线程写入）"""
+        jobs = jobs or min(len(file_paths), os.cpu_count() or 1)
+        results = []
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            for file_path, (dev_sns, error) in zip(file_paths, pool.map(self.load_device_list, file_paths)):
+                devices = DeviceSet(self.registry)
+                if dev_sns is None:
+                    print(f"警告: 文件不存在 - {file_path}")
+                elif error is not None:
+                    print(f"✗ 读取文件失败: {file_path} - {error}")
+                else:
+                    devices.update(dev_sns)
+                    print(f"✓ 读取文件: {file_path.name} - {len(devices)} 个设备")
+                results.append(devices)
+        return results
     
     def compare_devices(self) -> Dict[str, any]:
         """对比设备文件"""
@@ -56,22 +168,19 @@ class DeviceComparator:
         print("设备对比分析")
         print("=" * 60)
         
-        # 读取所有设备文件
+        # 并发读取总设备文件与全部在线设备文件
         print("\n1. 读取设备文件:")
-        all_devices = self.read_device_file(self.all_devices_file)
+        device_sets = self.read_device_files([self.all_devices_file] +
+                                             [file_path for _, file_path in self.online_files])
+        all_devices = device_sets[0]
         
         if not all_devices:
             print(f"✗ 无法读取总设备文件: {self.all_devices_file}")
             return None
         
-        # 读取在线设备文件
-        online_devices_by_app = {}
-        all_online_devices = set()
-        
-        for app_id, file_path in self.online_files:
-            online_devices = self.read_device_file(file_path)
-            online_devices_by_app[app_id] = online_devices
-            all_online_devices.update(online_devices)
+        online_devices_by_app = {app_id: devices
+                                 for (app_id, _), devices in zip(self.online_files, device_sets[1:])}
+        all_online_devices = DeviceSet(self.registry).union(*online_devices_by_app.values())
         
         # 计算离线设备
         offline_devices = all_devices - all_online_devices
@@ -82,16 +191,22 @@ class DeviceComparator:
             'online_devices_by_app': online_devices_by_app,
             'all_online_devices': all_online_devices,
             'offline_devices': offline_devices,
-            'stats': {
-                'total_devices': len(all_devices),
-                'total_online': len(all_online_devices),
-                'total_offline': len(offline_devices),
-                'online_by_app': {app_id: len(devices) for app_id, devices in online_devices_by_app.items()}
-            }
         }
+        self.update_stats(result)
         
         return result
     
+    @staticmethod
+    def update_stats(result: Dict[str, any]):
+        """按当前设备集合刷新统计信息"""
+        result['stats'] = {
+            'total_devices': len(result['all_devices']),
+            'total_online': len(result['all_online_devices']),
+            'total_offline': len(result['offline_devices']),
+            'online_by_app': {app_id: len(devices)
+                              for app_id, devices in result['online_devices_by_app'].items()}
+        }
+    
     def print_summary(self, result: Dict[str, any]):
         """打印统计摘要"""
         if not result:
@@ -110,28 +225,52 @@ class DeviceComparator:
             percentage = count/stats['total_devices']*100 if stats['total_devices'] > 0 else 0
             print(f"     应用{app_id}: {count} 个 ({percentage:.1f}%)")
     
+    def print_memory_report(self, result: Dict[str, any]):
+        """打印设备集合内存占用：字典编码存储 vs 普通 set[str]"""
+        if not result:
+            return
+        
+        device_sets = {'all_devices': result['all_devices'],
+                       'all_online_devices': result['all_online_devices'],
+                       'offline_devices': result['offline_devices']}
+        for app_id, devices in result['online_devices_by_app'].items():
+            device_sets[f'online_{app_id}'] = devices
+        report = memory_report(self.registry, device_sets)
+        
+        print("\n   内存占用:")
+        print(f"     设备数: {report['devices']}, 集合成员总数: {report['entries']}")
+        print(f"     普通集合基线: {format_bytes(report['baseline_bytes'])}")
+        print(f"     字典编码存储: {format_bytes(report['compact_bytes'])} "
+              f"(编码表 {format_bytes(report['registry_bytes'])} + "
+              f"位图 {format_bytes(report['bitmap_bytes'])})")
+        if report['compact_bytes']:
+            print(f"     节省: {report['baseline_bytes'] / report['compact_bytes']:.1f}x")
+    
     def print_offline_devices(self, result: Dict[str, any], limit: int = None):
         """打印离线设备列表"""
         if not result:
             return
         
         offline_devices = sorted(result['offline_devices'])
-        
-        print(f"\n3. 离线设备列表 (共 {len(offline_devices)} 个):")
+        self.print_offline_list(offline_devices, len(offline_devices), limit)
+    
+    def print_offline_list(self, offline_devices: Iterable[str], total: int, limit: int = None):
+        """按序打印离线设备（可为流式迭代器），超出 limit 的部分只给出数量"""
+        print(f"\n3. 离线设备列表 (共 {total} 个):")
         print("-" * 50)
         
-        if not offline_devices:
+        if not total:
             print("   🎉 所有设备都在线！")
             return
         
-        # 限制显示数量
-        display_devices = offline_devices[:limit] if limit else offline_devices
-        
-        for i, device in enumerate(display_devices, 1):
+        for i, device in enumerate(offline_devices, 1):
+            # 限制显示数量
+            if limit and i > limit:
+                break
             print(f"   {i:4d}. {device}")
         
-        if limit and len(offline_devices) > limit:
-            print(f"   ... 还有 {len(offline_devices) - limit} 个设备未显示")
+        if limit and total > limit:
+            print(f"   ... 还有 {total - limit} 个设备未显示")
             print(f"   使用 --all 参数查看完整列表")
     
     def save_offline_devices(self, result: Dict[str, any], output_file: str = None):
@@ -149,19 +288,7 @@ class DeviceComparator:
         
         try:
             with open(output_path, 'w', encoding='utf-8') as f:
-                # 写入头部信息
-                f.write(f"# 离线设备列表 - 生成于 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-                f.write(f"# 总设备数量: {stats['total_devices']}\n")
-                f.write(f"# 在线设备数量: {stats['total_online']}\n")
-                f.write(f"# 离线设备数量: {stats['total_offline']}\n")
-                f.write(f"# 离线率: {stats['total_offline']/stats['total_devices']*100:.1f}%\n")
-                f.write("#\n")
-                f.write("# 各应用在线设备统计:\n")
-                for app_id, count in stats['online_by_app'].items():
-                    percentage = count/stats['total_devices']*100 if stats['total_devices'] > 0 else 0
-                    f.write(f"#   应用{app_id}: {count} 个 ({percentage:.1f}%)\n")
-                f.write("#\n")
-                f.write("# 离线设备序列号列表:\n")
+                self.write_offline_header(f, stats)
                 
                 # 写入离线设备列表
                 for device in offline_devices:
@@ -174,6 +301,403 @@ class DeviceComparator:
             print(f"✗ 保存文件失败: {e}")
             return False
     
+    def write_offline_header(self, f, stats: Dict[str, any]):
+        """写入离线设备文件的头部统计信息"""
+        f.write(f"# 离线设备列表 - 生成于 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        f.write(f"# 总设备数量: {stats['total_devices']}\n")
+        f.write(f"# 在线设备数量: {stats['total_online']}\n")
+        f.write(f"# 离线设备数量: {stats['total_offline']}\n")
+        f.write(f"# 离线率: {stats['total_offline']/stats['total_devices']*100:.1f}%\n")
+        f.write("#\n")
+        f.write("# 各应用在线设备统计:\n")
+        for app_id, count in stats['online_by_app'].items():
+            percentage = count/stats['total_devices']*100 if stats['total_devices'] > 0 else 0
+            f.write(f"#   应用{app_id}: {count} 个 ({percentage:.1f}%)\n")
+        f.write("#\n")
+        f.write("# 离线设备序列号列表:\n")
+    
+    def iter_device_lines(self, file_path: Path) -> Iterator[str]:
+        """逐行读取设备文件，跳过空行和注释行"""
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    yield line
+    
+    @staticmethod
+    def iter_unique(devices: Iterable[str]) -> Iterator[str]:
+        """有序序列去重"""
+        previous = None
+        for dev_sn in devices:
+            if dev_sn != previous:
+                yield dev_sn
+                previous = dev_sn
+    
+    @staticmethod
+    def iter_run_file(run_file: Path) -> Iterator[str]:
+        """读取一个已排序的段文件"""
+        with open(run_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                yield line[:-1]
+    
+    def external_sort(self, file_path: Path, temp_dir: Path, run_size: int) -> Iterator[str]:
+        """外部排序：每 run_size 行排序去重后落盘为一段，再多路归并输出去重后的有序序列
+        
+        内存占用只与 run_size 有关，与文件大小无关；只有一段时不落盘。
+        """
+        runs: List[Path] = []
+        chunk: List[str] = []
+        for dev_sn in self.iter_device_lines(file_path):
+            chunk.append(dev_sn)
+            if len(chunk) >= run_size:
+                runs.append(self.spill_run(chunk, temp_dir))
+                chunk = []
+        
+        if not runs:
+            return iter(sorted(set(chunk)))
+        if chunk:
+            runs.append(self.spill_run(chunk, temp_dir))
+        return self.iter_unique(heapq.merge(*(self.iter_run_file(run) for run in runs)))
+    
+    @staticmethod
+    def spill_run(chunk: List[str], temp_dir: Path) -> Path:
+        """把一段设备序列号排序去重后写入临时文件"""
+        fd, name = tempfile.mkstemp(suffix='.run', dir=temp_dir)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            for dev_sn in sorted(set(chunk)):
+                f.write(f"{dev_sn}\n")
+        return Path(name)
+    
+    def compare_devices_streaming(self, offline_file, temp_dir: Path,
+                                  run_size: int) -> Dict[str, any]:
+        """流式对比：各文件外部排序后归并求差，离线设备按序直接写入 offline_file
+        
+        峰值内存由 run_size 决定，可处理超出内存的设备清单；返回与 compare_devices
+        相同结构的统计信息。
+        """
+        print("=" * 60)
+        print("设备对比分析 (流式模式)")
+        print("=" * 60)
+        
+        print("\n1. 外部排序设备文件:")
+        all_devices = self.external_sort(self.all_devices_file, temp_dir, run_size)
+        online_by_app = {}
+        
+        def count_app(app_id: str, devices: Iterator[str]) -> Iterator[str]:
+            count = 0
+            for dev_sn in devices:
+                count += 1
+                yield dev_sn
+            online_by_app[app_id] = count
+        
+        online_streams = []
+        for app_id, file_path in self.online_files:
+            if not file_path.exists():
+                print(f"警告: 文件不存在 - {file_path}")
+                online_by_app[app_id] = 0
+                continue
+            online_streams.append(count_app(app_id, self.external_sort(file_path, temp_dir, run_size)))
+            print(f"✓ 已排序: {file_path.name}")
+        online_devices = self.iter_unique(heapq.merge(*online_streams))
+        
+        # 归并求差：总设备序列中不在在线并集中的即为离线设备
+        total_devices = total_online = total_offline = 0
+        current = next(online_devices, None)
+        for dev_sn in all_devices:
+            total_devices += 1
+            while current is not None and current < dev_sn:
+                total_online += 1
+                current = next(online_devices, None)
+            if current == dev_sn:
+                continue
+            total_offline += 1
+            offline_file.write(f"{dev_sn}\n")
+        if current is not None:
+            total_online += 1 + sum(1 for _ in online_devices)
+        
+        print(f"✓ 总设备 {total_devices} 个, 在线并集 {total_online} 个")
+        return {
+            'stats': {
+                'total_devices': total_devices,
+                'total_online': total_online,
+                'total_offline': total_offline,
+                'online_by_app': {app_id: online_by_app.get(app_id, 0)
+                                  for app_id, _ in self.online_files}
+            }
+        }
+    
+    def run_streaming_comparison(self, show_all: bool = False, save_file: str = None,
+                                 limit: int = 50, run_size: int = 1000000,
+                                 temp_dir: str = None) -> bool:
+        """运行流式设备对比：排序段与离线列表均落在临时目录，最后拼接头部写出结果文件"""
+        if not self.check_files_exist():
+            return False
+        
+        with tempfile.TemporaryDirectory(prefix='compare_devices_', dir=temp_dir) as work_dir:
+            work_dir = Path(work_dir)
+            body_file = work_dir / "offline.txt"
+            try:
+                with open(body_file, 'w', encoding='utf-8') as f:
+                    result = self.compare_devices_streaming(f, work_dir, run_size)
+            except Exception as e:
+                print(f"✗ 流式对比失败: {e}")
+                return False
+            
+            return self.finish_offline_body(result, body_file, show_all, save_file, limit)
+    
+    def finish_offline_body(self, result: Dict[str, any], body_file: Path, show_all: bool,
+                            save_file: Optional[str], limit: int) -> bool:
+        """流式/分区对比的收尾：打印摘要与离线列表（从已排序的离线列表文件读取），拼接头部写出结果文件"""
+        stats = result['stats']
+        if not stats['total_devices']:
+            print(f"✗ 无法读取总设备文件: {self.all_devices_file}")
+            return False
+        
+        self.print_summary(result)
+        self.print_offline_list(self.iter_run_file(body_file), stats['total_offline'],
+                                None if show_all else limit)
+        
+        if not save_file and not stats['total_offline']:
+            return True
+        if not save_file:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            save_file = f"offline_devices_{timestamp}.txt"
+        output_path = self.script_dir / save_file
+        tmp_path = output_path.with_name(output_path.name + '.tmp')
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as out, \
+                    open(body_file, 'r', encoding='utf-8') as body:
+                self.write_offline_header(out, stats)
+                shutil.copyfileobj(body, out)
+            os.replace(tmp_path, output_path)
+        except Exception as e:
+            print(f"✗ 保存文件失败: {e}")
+            return False
+        print(f"\n4. 离线设备列表已保存到: {output_path}")
+        return True
+    
+    def compare_devices_partitioned(self, offline_file, temp_dir: Path, jobs: int) -> Dict[str, any]:
+        """分区并行对比：按 devSn 哈希分区，各分区在独立进程中求差，再归并各分区的有序离线列表
+        
+        第一阶段把各文件按总大小切为约 jobs 个字节段（每个文件至少一段），各段在工作进程中按行对齐
+        并切分为 jobs 个分区文件，大文件的切分同样并行；第二阶段每个分区由一个进程读入总设备与
+        各应用在线设备在该分区的全部段求差；同一 devSn 总落在同一分区，各分区计数相加即为全局结果。
+        离线设备按序以字节写入 offline_file（二进制）。
+        """
+        print("=" * 60)
+        print(f"设备对比分析 (分区并行模式, {jobs} 个进程)")
+        print("=" * 60)
+        
+        online_files = []
+        for app_id, file_path in self.online_files:
+            if file_path.exists():
+                online_files.append((app_id, file_path))
+            else:
+                print(f"警告: 文件不存在 - {file_path}")
+        
+        print("\n1. 按devSn哈希分区:")
+        sources = [('all', self.all_devices_file)] + [(f"app{index}", file_path) for index, (_, file_path)
+                                                      in enumerate(online_files)]
+        sizes = [file_path.stat().st_size for _, file_path in sources]
+        chunk_size = -(-sum(sizes) // jobs)
+        chunks = {name: byte_ranges(size, chunk_size) for (name, _), size in zip(sources, sizes)}
+        
+        def chunk_paths(name: str, partition: int) -> List[Path]:
+            return [temp_dir / f"{name}.{chunk}.{partition}" for chunk in range(len(chunks[name]))]
+        
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(partition_device_file, file_path, range_start, range_end,
+                                   str(temp_dir / f"{name}.{chunk}"), jobs)
+                       for name, file_path in sources
+                       for chunk, (range_start, range_end) in enumerate(chunks[name])]
+            line_counts = [future.result() for future in futures]
+            print(f"✓ {len(sources)} 个文件, {len(futures)} 个字节段, {sum(line_counts)} 行, "
+                  f"耗时 {time.perf_counter() - start:.2f} 秒")
+            
+            start = time.perf_counter()
+            futures = [
+                pool.submit(diff_partition, chunk_paths('all', partition),
+                            [(app_id, chunk_paths(f"app{index}", partition))
+                             for index, (app_id, _) in enumerate(online_files)],
+                            temp_dir / f"offline.{partition}")
+                for partition in range(jobs)
+            ]
+            partitions = [future.result() for future in futures]
+        
+        total_devices = sum(result[0] for result in partitions)
+        total_online = sum(result[1] for result in partitions)
+        total_offline = sum(result[3] for result in partitions)
+        online_by_app = {app_id: 0 for app_id, _ in self.online_files}
+        for _, _, app_counts, _ in partitions:
+            for app_id, count in app_counts.items():
+                online_by_app[app_id] += count
+        print(f"✓ {jobs} 个分区求差, 耗时 {time.perf_counter() - start:.2f} 秒")
+        
+        # 各分区的离线列表已排序，多路归并为全局有序列表
+        streams = [open(temp_dir / f"offline.{partition}", 'rb') for partition in range(jobs)]
+        try:
+            offline_file.writelines(heapq.merge(*streams))
+        finally:
+            for stream in streams:
+                stream.close()
+        
+        print(f"✓ 总设备 {total_devices} 个, 在线并集 {total_online} 个")
+        return {
+            'stats': {
+                'total_devices': total_devices,
+                'total_online': total_online,
+                'total_offline': total_offline,
+                'online_by_app': online_by_app,
+            }
+        }
+    
+    def run_partitioned_comparison(self, jobs: int, show_all: bool = False, save_file: str = None,
+                                   limit: int = 50, temp_dir: str = None) -> bool:
+        """运行分区并行对比：分区文件与离线列表落在临时目录，最后拼接头部写出结果文件"""
+        if not self.check_files_exist():
+            return False
+        
+        with tempfile.TemporaryDirectory(prefix='compare_devices_', dir=temp_dir) as work_dir:
+            work_dir = Path(work_dir)
+            body_file = work_dir / "offline.txt"
+            try:
+                with open(body_file, 'wb') as f:
+                    result = self.compare_devices_partitioned(f, work_dir, max(1, jobs))
+            except Exception as e:
+                print(f"✗ 分区并行对比失败: {e}")
+                return False
+            
+            return self.finish_offline_body(result, body_file, show_all, save_file, limit)
+    
+    def start_watch(self) -> Dict[str, any]:
+        """监视模式初始化：总设备文件只读一次，在线文件从头读入并记录读取位置"""
+        print("=" * 60)
+        print("设备对比分析 (监视模式)")
+        print("=" * 60)
+        
+        print("\n1. 读取设备文件:")
+        all_devices = self.read_device_file(self.all_devices_file)
+        if not all_devices:
+            print(f"✗ 无法读取总设备文件: {self.all_devices_file}")
+            return None
+        
+        # 应用ID -> (inode, 已读取的字节数)
+        self.watch_positions: Dict[str, tuple] = {}
+        result = {
+            'all_devices': all_devices,
+            'online_devices_by_app': {app_id: DeviceSet(self.registry) for app_id, _ in self.online_files},
+            'all_online_devices': DeviceSet(self.registry),
+            'offline_devices': all_devices.copy(),
+        }
+        self.poll_online_files(result)
+        for app_id, devices in result['online_devices_by_app'].items():
+            print(f"✓ 读取应用{app_id}在线设备: {len(devices)} 个")
+        return result
+    
+    def poll_online_files(self, result: Dict[str, any]) -> int:
+        """读取各在线文件新追加的行并增量更新离线集合，返回新增在线设备数
+        
+        只读取上次位置之后的完整行；文件被重写（inode变化或变短，如监控器整理输出文件）
+        时重新读取该文件，并按集合运算重建在线并集与离线集合。新出现的应用文件自动加入监视。
+        离线集合有变化时置 result['offline_changed']，由调用方保存后清除。
+        """
+        online_devices_by_app = result['online_devices_by_app']
+        all_online = result['all_online_devices']
+        offline = result['offline_devices']
+        added = 0
+        rewritten = False
+        
+        for app_id, file_path in self.discover_online_files():
+            if app_id not in online_devices_by_app and file_path.exists():
+                self.online_files.append((app_id, file_path))
+                online_devices_by_app[app_id] = DeviceSet(self.registry)
+        
+        for app_id, file_path in self.online_files:
+            try:
+                stat = file_path.stat()
+            except OSError:
+                continue
+            inode, offset = self.watch_positions.get(app_id, (stat.st_ino, 0))
+            if inode != stat.st_ino or stat.st_size < offset:
+                online_devices_by_app[app_id] = DeviceSet(self.registry)
+                offset = 0
+                rewritten = True
+            if stat.st_size == offset:
+                self.watch_positions[app_id] = (stat.st_ino, offset)
+                continue
+            
+            with open(file_path, 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+            # 只处理完整的行，未写完的末行留到下次
+            end = data.rfind(b'\n') + 1
+            self.watch_positions[app_id] = (stat.st_ino, offset + end)
+            
+            app_devices = online_devices_by_app[app_id]
+            for dev_sn in parse_device_lines(data[:end]):
+                if app_devices.add(dev_sn):
+                    added += 1
+                    if not rewritten and all_online.add(dev_sn) and offline.discard(dev_sn):
+                        result['offline_changed'] = True
+        
+        if rewritten:
+            all_online = DeviceSet(self.registry).union(*online_devices_by_app.values())
+            offline = result['all_devices'] - all_online
+            if offline.bitmap.to_int() != result['offline_devices'].bitmap.to_int():
+                result['offline_changed'] = True
+            result['all_online_devices'] = all_online
+            result['offline_devices'] = offline
+        self.update_stats(result)
+        return added
+    
+    def run_watch(self, interval: float = 5.0, save_file: str = None, save_interval: float = 60.0):
+        """监视模式：定时增量读取在线文件，有变化时打印摘要并按需保存离线设备
+        
+        保存需要排序并重写整个离线列表，只在离线集合有变化时进行，且至少间隔 save_interval 秒；
+        退出时写出尚未保存的变化。
+        """
+        result = self.start_watch()
+        if not result:
+            return False
+        self.print_summary(result)
+        
+        if save_file == '':
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            save_file = f"offline_devices_{timestamp}.txt"
+        if save_file:
+            self.save_offline_devices(result, save_file)
+        result['offline_changed'] = False
+        saved_at = time.monotonic()
+        
+        print(f"\n开始监视在线设备文件（每 {interval} 秒检查一次，Ctrl+C 退出）")
+        last_stats = result['stats']
+        try:
+            while True:
+                time.sleep(interval)
+                added = self.poll_online_files(result)
+                if (save_file and result['offline_changed']
+                        and time.monotonic() - saved_at >= save_interval):
+                    self.save_offline_devices(result, save_file)
+                    result['offline_changed'] = False
+                    saved_at = time.monotonic()
+                
+                stats = result['stats']
+                if stats == last_stats:
+                    continue
+                last_stats = stats
+                
+                by_app = ", ".join(f"应用{app_id}: {count}" for app_id, count in stats['online_by_app'].items())
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] 新增 {added} 条, "
+                      f"在线 {stats['total_online']} 个, 离线 {stats['total_offline']} 个 ({by_app})")
+        except KeyboardInterrupt:
+            print("\n停止监视")
+        
+        if save_file and result['offline_changed']:
+            self.save_offline_devices(result, save_file)
+        self.print_summary(result)
+        return True
+    
     def check_files_exist(self) -> bool:
         """检查必要文件是否存在"""
         missing_files = []
@@ -197,7 +721,8 @@ class DeviceComparator:
         
         return True
     
-    def run_comparison(self, show_all: bool = False, save_file: str = None, limit: int = 50):
+    def run_comparison(self, show_all: bool = False, save_file: str = None, limit: int = 50,
+                       show_memory: bool = False):
         """运行设备对比"""
         # 检查文件是否存在
         if not self.check_files_exist():
@@ -210,6 +735,8 @@ class DeviceComparator:
         
         # 显示结果
         self.print_summary(result)
+        if show_memory:
+            self.print_memory_report(result)
         
         # 显示离线设备
         display_limit = None if show_all else limit
@@ -234,11 +761,14 @@ def main():
   python3 compare_devices.py --limit 100        # 显示前100个离线设备
   python3 compare_devices.py --save offline.txt # 保存结果到指定文件
   python3 compare_devices.py --all --save       # 显示所有设备并保存到默认文件
+  python3 compare_devices.py --memory-report    # 同时显示设备集合内存占用
+  python3 compare_devices.py --streaming        # 外部排序流式对比（适用于超大设备清单）
+  python3 compare_devices.py --jobs 8           # 按devSn哈希分区，8个进程并行求差
+  python3 compare_devices.py --watch --save     # 持续监视在线文件，增量更新离线列表
 
 文件说明:
   all_devices.txt                    - 所有设备列表
-  device_online_output/online_devices_10001.txt - 应用10001在线设备
-  device_online_output/online_devices_10002.txt - 应用10002在线设备
+  device_online_output/online_devices_*.txt     - 各应用在线设备（自动发现全部应用）
         """
     )
     
@@ -248,9 +778,30 @@ def main():
                        help='限制显示的离线设备数量（默认50）')
     parser.add_argument('--save', nargs='?', const='',
                        help='保存离线设备到文件（可指定文件名）')
+    parser.add_argument('--memory-report', action='store_true',
+                       help='显示字典编码存储与普通集合的内存占用对比')
+    parser.add_argument('--streaming', action='store_true',
+                       help='流式模式：外部排序 + 多路归并求差，内存占用有界（不能与 --jobs 同时使用）')
+    parser.add_argument('--run-size', type=int, default=1000000,
+                       help='流式模式下每个排序段的行数（默认1000000）')
+    parser.add_argument('--temp-dir', default=None,
+                       help='流式模式排序段与分区并行模式分区文件的临时目录（默认系统临时目录）')
+    parser.add_argument('--jobs', type=int, default=1,
+                       help='分区并行模式的进程数：大于1时按devSn哈希分区，各分区在独立进程中求差'
+                            '后归并离线列表（默认1，不分区；不能与 --streaming 同时使用）')
+    parser.add_argument('--watch', action='store_true',
+                       help='监视模式：只读取在线文件新追加的行，定时输出摘要')
+    parser.add_argument('--interval', type=float, default=5.0,
+                       help='监视模式的检查间隔秒数（默认5）')
+    parser.add_argument('--save-interval', type=float, default=60.0,
+                       help='监视模式下重写离线设备文件的最短间隔秒数，仅在离线集合变化时重写（默认60）')
     
     args = parser.parse_args()
     
+    if args.jobs > 1 and args.streaming:
+        print("✗ --jobs 与 --streaming 不能同时使用：分区并行模式各分区在内存中求差，流式模式为单进程外部排序")
+        sys.exit(1)
+    
     # 创建对比器
     comparator = DeviceComparator()
     
@@ -260,11 +811,32 @@ def main():
         save_file = args.save if args.save else None
     
     # 运行对比
-    success = comparator.run_comparison(
-        show_all=args.all,
-        save_file=save_file,
-        limit=args.limit
-    )
+    if args.watch:
+        success = comparator.run_watch(interval=args.interval, save_file=args.save,
+                                       save_interval=args.save_interval)
+    elif args.jobs > 1:
+        success = comparator.run_partitioned_comparison(
+            args.jobs,
+            show_all=args.all,
+            save_file=save_file,
+            limit=args.limit,
+            temp_dir=args.temp_dir
+        )
+    elif args.streaming:
+        success = comparator.run_streaming_comparison(
+            show_all=args.all,
+            save_file=save_file,
+            limit=args.limit,
+            run_size=args.run_size,
+            temp_dir=args.temp_dir
+        )
+    else:
+        success = comparator.run_comparison(
+            show_all=args.all,
+            save_file=save_file,
+            limit=args.limit,
+            show_memory=args.memory_report
+        )
     
     if not success:
         sys.exit(1)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+device_files.py - 设备列表文件批量读取
+以 mmap 映射设备列表文件（all_devices.txt、online_devices_*.txt 等），按字节批量切分行，
+跳过空行与 # 注释行，供设备监控器、设备对比工具与使用示例共用
+"""
+
+import mmap
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Iterator
+
+
+# 设备行内可能出现、需要逐行 strip 的ASCII空白（换行除外）
+LINE_WHITESPACE = (b' ', b'\t', b'\r', b'\f', b'\v')
+
+
+@contextmanager
+def map_file(file_path: Path) -> Iterator[bytes]:
+    """只读映射文件；空文件无法映射，返回空字节串"""
+    with open(file_path, 'rb') as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            yield b''
+            return
+        try:
+            yield mapped
+        finally:
+            mapped.close()
+
+
+def strip_comment_lines(data: bytes) -> bytes:
+    """删除注释行（去掉行首空白后以 # 开头的行）
+    
+    注释只出现在文件头尾，按 # 的位置定位所在行，不扫描每一行。
+    """
+    pos = data.find(b'#')
+    if pos == -1:
+        return data[:]
+    parts = []
+    start = 0
+    while pos != -1:
+        line_start = data.rfind(b'\n', 0, pos) + 1
+        line_end = data.find(b'\n', pos)
+        if line_end == -1:
+            line_end = len(data)
+        if not data[line_start:pos].strip():
+            parts.append(data[start:line_start])
+            start = line_end
+        pos = data.find(b'#', line_end)
+    parts.append(data[start:])
+    return b''.join(parts)
+
+
+def needs_strip(body: bytes) -> bool:
+    """是否存在需要逐行去除的行内空白"""
+    return any(char in body for char in LINE_WHITESPACE)
+
+
+def read_device_list(file_path: Path) -> List[str]:
+    """读取设备列表文件，按文件顺序返回设备序列号"""
+    with map_file(file_path) as data:
+        return parse_device_lines(data)
+
+
+def parse_device_lines(data: bytes) -> List[str]:
+    """从设备列表字节内容中切分设备序列号
+    
+    删除注释行后整体解码一次再按换行切分，行内没有多余空白时不做逐行处理。
+    """
+    body = strip_comment_lines(data)
+    text = body.decode('utf-8')
+    if needs_strip(body):
+        return [line for line in (line.strip() for line in text.split('\n')) if line]
+    return list(filter(None, text.split('\n')))
+
+
+def count_device_list(file_path: Path) -> int:
+    """只统计设备列表文件中的设备行数，不解码、不构建集合"""
+    with map_file(file_path) as data:
+        body = strip_comment_lines(data)
+    if needs_strip(body):
+        return sum(1 for line in body.split(b'\n') if line.strip())
+    return len(body.split())
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+device_ids.py - 设备序列号字典编码与紧凑设备集合
+把 devSn 映射为稠密整数ID，用位图表示设备集合，供设备监控器与设备对比工具共用
+"""
+
+import sys
+import threading
+from typing import Dict, List, Iterable, Iterator, Optional
+
+
+def popcount(value: int) -> int:
+    """统计整数中置位的个数"""
+    if hasattr(value, 'bit_count'):
+        return value.bit_count()
+    return bin(value).count('1')
+
+
+class DeviceIdRegistry:
+    """devSn <-> 稠密整数ID 的字典编码表
+    
+    只增不减；读取无锁，仅在登记新设备时加锁，可被多个消费线程共享。
+    每个devSn字符串在进程内只保存一份，各集合只保存ID位。
+    """
+    
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.names: List[str] = []
+        self.lock = threading.Lock()
+    
+    def __len__(self) -> int:
+        return len(self.names)
+    
+    @classmethod
+    def from_names(cls, names: List[str]) -> 'DeviceIdRegistry':
+        """按ID顺序的devSn列表重建编码表（从快照加载时使用）"""
+        registry = cls()
+        registry.names = list(names)
+        registry.ids = dict(zip(registry.names, range(len(registry.names))))
+        return registry
+    
+    def intern(self, dev_sn: str) -> int:
+        """获取devSn的ID，首次出现时分配新ID"""
+        device_id = self.ids.get(dev_sn)
+        if device_id is None:
+            with self.lock:
+                device_id = self.ids.get(dev_sn)
+                if device_id is None:
+                    device_id = len(self.names)
+                    self.names.append(dev_sn)
+                    self.ids[dev_sn] = device_id
+        return device_id
+    
+    def lookup(self, dev_sn: str) -> Optional[int]:
+        """查询devSn的ID，未登记时返回 None"""
+        return self.ids.get(dev_sn)
+    
+    def name(self, device_id: int) -> str:
+        """按ID取回devSn"""
+        return self.names[device_id]
+    
+    def memory_bytes(self) -> int:
+        """估算编码表占用的字节数（字典 + 列表 + 字符串对象）"""
+        return (sys.getsizeof(self.ids) + sys.getsizeof(self.names)
+                + sum(sys.getsizeof(dev_sn) for dev_sn in self.names))
+
+
+class DeviceBitmap:
+    """bytearray 位图：每个设备ID占1位，集合运算按大整数整体计算"""
+    
+    __slots__ = ('bits', 'count')
+    
+    def __init__(self, bits: bytearray = None, count: int = None):
+        self.bits = bits if bits is not None else bytearray()
+        self.count = count if count is not None else popcount(int.from_bytes(self.bits, 'little'))
+    
+    @classmethod
+    def from_int(cls, value: int) -> 'DeviceBitmap':
+        length = (value.bit_length() + 7) // 8
+        return cls(bytearray(value.to_bytes(length, 'little')), popcount(value))
+    
+    def to_int(self) -> int:
+        return int.from_bytes(self.bits, 'little')
+    
+    def add(self, device_id: int) -> bool:
+        """加入ID，返回是否为新加入"""
+        bits = self.bits
+        index = device_id >> 3
+        if index >= len(bits):
+            # 按倍数扩容，摊还为 O(1)
+            bits.extend(bytes(max(index + 1 - len(bits), len(bits))))
+        mask = 1 << (device_id & 7)
+        if bits[index] & mask:
+            return False
+        bits[index] |= mask
+        self.count += 1
+        return True
+    
+    def discard(self, device_id: int) -> bool:
+        """移除ID，返回是否原本存在"""
+        bits = self.bits
+        index = device_id >> 3
+        if index >= len(bits):
+            return False
+        mask = 1 << (device_id & 7)
+        if not bits[index] & mask:
+            return False
+        bits[index] &= ~mask & 0xFF
+        self.count -= 1
+        return True
+    
+    def __contains__(self, device_id: int) -> bool:
+        index = device_id >> 3
+        return index < len(self.bits) and bool(self.bits[index] & (1 << (device_id & 7)))
+    
+    def __len__(self) -> int:
+        return self.count
+    
+    def __iter__(self) -> Iterator[int]:
+        """按ID升序遍历"""
+        for index, byte in enumerate(self.bits):
+            if byte:
+                base = index << 3
+                for bit in range(8):
+                    if byte >> bit & 1:
+                        yield base + bit
+    
+    def iter_from(self, start: int) -> Iterator[int]:
+        """从ID start（含）起按ID升序遍历，分页续读时直接定位到起始字节"""
+        bits = self.bits
+        for index in range(start >> 3, len(bits)):
+            byte = bits[index]
+            if byte:
+                base = index << 3
+                for bit in range(8):
+                    if byte >> bit & 1 and base + bit >= start:
+                        yield base + bit
+    
+    def copy(self) -> 'DeviceBitmap':
+        return DeviceBitmap(bytearray(self.bits), self.count)
+    
+    def union(self, *others: 'DeviceBitmap') -> 'DeviceBitmap':
+        value = self.to_int()
+        for other in others:
+            value |= other.to_int()
+        return DeviceBitmap.from_int(value)
+    
+    def intersection(self, *others: 'DeviceBitmap') -> 'DeviceBitmap':
+        value = self.to_int()
+        for other in others:
+            value &= other.to_int()
+        return DeviceBitmap.from_int(value)
+    
+    def difference(self, *others: 'DeviceBitmap') -> 'DeviceBitmap':
+        value = self.to_int()
+        for other in others:
+            value &= ~other.to_int()
+        return DeviceBitmap.from_int(value)
+    
+    def memory_bytes(self) -> int:
+        return sys.getsizeof(self.bits)
+
+
+class DeviceSet:
+    """基于 DeviceIdRegistry + DeviceBitmap 的devSn集合
+    
+    提供 set 的常用接口（add/discard/in/len/迭代/并差交），迭代时返回devSn字符串；
+    参与集合运算的各集合必须共用同一个编码表。
+    """
+    
+    __slots__ = ('registry', 'bitmap')
+    
+    def __init__(self, registry: DeviceIdRegistry, devices: Iterable[str] = None,
+                 bitmap: DeviceBitmap = None):
+        self.registry = registry
+        self.bitmap = bitmap if bitmap is not None else DeviceBitmap()
+        if devices is not None:
+            self.update(devices)
+    
+    def add(self, dev_sn: str) -> bool:
+        return self.bitmap.add(self.registry.intern(dev_sn))
+    
+    def update(self, devices: Iterable[str]):
+        intern = self.registry.intern
+        add = self.bitmap.add
+        for dev_sn in devices:
+            add(intern(dev_sn))
+    
+    def discard(self, dev_sn: str) -> bool:
+        device_id = self.registry.lookup(dev_sn)
+        return device_id is not None and self.bitmap.discard(device_id)
+    
+    def __contains__(self, dev_sn: str) -> bool:
+        device_id = self.registry.lookup(dev_sn)
+        return device_id is not None and device_id in self.bitmap
+    
+    def __len__(self) -> int:
+        return len(self.bitmap)
+    
+    def __iter__(self) -> Iterator[str]:
+        names = self.registry.names
+        for device_id in self.bitmap:
+            yield names[device_id]
+    
+    def _check_registry(self, others):
+        for other in others:
+            if other.registry is not self.registry:
+                raise ValueError("参与运算的设备集合必须使用同一个编码表")
+    
+    def copy(self) -> 'DeviceSet':
+        return DeviceSet(self.registry, bitmap=self.bitmap.copy())
+    
+    def union(self, *others: 'DeviceSet') -> 'DeviceSet':
+        self._check_registry(others)
+        return DeviceSet(self.registry, bitmap=self.bitmap.union(*(o.bitmap for o in others)))
+    
+    def intersection(self, *others: 'DeviceSet') -> 'DeviceSet':
+        self._check_registry(others)
+        return DeviceSet(self.registry, bitmap=self.bitmap.intersection(*(o.bitmap for o in others)))
+    
+    def difference(self, *others: 'DeviceSet') -> 'DeviceSet':
+        self._check_registry(others)
+        return DeviceSet(self.registry, bitmap=self.bitmap.difference(*(o.bitmap for o in others)))
+    
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+
+def estimate_set_bytes(devices: Iterable[str]) -> int:
+    """估算等价的 Python set[str] 占用的字节数（集合本身 + 每个字符串对象）"""
+    plain = set(devices)
+    return sys.getsizeof(plain) + sum(sys.getsizeof(dev_sn) for dev_sn in plain)
+
+
+def memory_report(registry: DeviceIdRegistry, device_sets: Dict[str, DeviceSet]) -> Dict[str, int]:
+    """对比字典编码存储与普通 set[str] 基线的内存占用
+    
+    基线按每个集合各自持有字符串对象估算（与逐文件读取为 set 的做法一致）。
+    """
+    baseline = sum(estimate_set_bytes(devices) for devices in device_sets.values())
+    registry_bytes = registry.memory_bytes()
+    bitmap_bytes = sum(devices.bitmap.memory_bytes() for devices in device_sets.values())
+    return {
+        'devices': len(registry),
+        'entries': sum(len(devices) for devices in device_sets.values()),
+        'baseline_bytes': baseline,
+        'registry_bytes': registry_bytes,
+        'bitmap_bytes': bitmap_bytes,
+        'compact_bytes': registry_bytes + bitmap_bytes,
+    }
+
+
+def format_bytes(size: int) -> str:
+    """字节数转为易读格式"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024
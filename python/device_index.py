@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+device_index.py - 已排序的在线设备索引文件
+设备监控器定期把每个应用的当前在线设备写成 online_devices_{app_id}.idx：文件头含统计信息，
+其后为按字节序排序的定长 devSn 键（不足补 \\0）。查询时以 mmap 映射，按序号直接定位分页、
+按前缀二分出范围、按 devSn 二分判断是否在线，均不需要扫描整个设备列表
+
+文件格式:
+  头部    魔数 DEVIDX01, 键宽度 uint32, 统计信息长度 uint32, 设备数 uint64
+  统计    JSON（应用ID、消息数、在线/已知设备数、生成时间），补齐到8字节
+  键      设备数 × 键宽度 字节，升序
+
+使用示例:
+  python3 device_index.py show output/online_devices_10001.idx --offset 1000 --limit 20
+  python3 device_index.py show output/online_devices_10001.idx --prefix 0012AB
+  python3 device_index.py lookup output/online_devices_10001.idx 0012AB34CD
+  python3 device_index.py build output/online_devices_10001.txt
+"""
+
+import os
+import sys
+import json
+import mmap
+import bisect
+import struct
+import argparse
+from pathlib import Path
+from typing import Dict, List, Tuple, Iterable
+
+from device_files import read_device_list
+from event_store import KeyView
+
+
+# 文件头: 魔数, 键宽度, 统计信息长度, 设备数
+INDEX_HEADER = struct.Struct('<8sIIQ')
+INDEX_MAGIC = b'DEVIDX01'
+
+
+def write_device_index(path: Path, devices: Iterable[str], stats: Dict = None) -> int:
+    """把设备集合排序后写为索引文件（临时文件 + rename），返回设备数"""
+    keys = sorted({dev_sn.encode('utf-8') for dev_sn in devices})
+    width = max(map(len, keys), default=0)
+    meta = json.dumps(stats or {}, ensure_ascii=False).encode('utf-8')
+    meta += bytes(-len(meta) % 8)
+    
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, width, len(meta), len(keys)))
+        f.write(meta)
+        # 分块拼接写出，避免为百万级设备生成一个巨大的字节串
+        for start in range(0, len(keys), 65536):
+            f.write(b''.join(key.ljust(width, b'\0') for key in keys[start:start + 65536]))
+    os.replace(tmp_path, path)
+    return len(keys)
+
+
+class DeviceIndex:
+    """只读映射的设备索引文件"""
+    
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.width, meta_length, self.count = INDEX_HEADER.unpack_from(self.data)
+        if magic != INDEX_MAGIC:
+            self.data.close()
+            raise ValueError(f"不是设备索引文件: {path}")
+        start = INDEX_HEADER.size + meta_length
+        self.stats: Dict = json.loads(self.data[INDEX_HEADER.size:start].rstrip(b'\0') or b'{}')
+        self.keys = KeyView(self.data, start, self.width, self.width, self.count)
+    
+    def __enter__(self) -> 'DeviceIndex':
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def close(self):
+        self.data.close()
+    
+    def __len__(self) -> int:
+        return self.count
+    
+    def __getitem__(self, i: int) -> str:
+        return self.keys[i].rstrip(b'\0').decode('utf-8')
+    
+    def __contains__(self, dev_sn: str) -> bool:
+        key = dev_sn.encode('utf-8')
+        if not key or len(key) > self.width:
+            return False
+        key = key.ljust(self.width, b'\0')
+        i = bisect.bisect_left(self.keys, key)
+        return i < self.count and self.keys[i] == key
+    
+    def prefix_range(self, prefix: str) -> Tuple[int, int]:
+        """以 prefix 开头的设备所在的序号区间 [start, end)"""
+        key = prefix.encode('utf-8')
+        # UTF-8 中不会出现 0xFF 字节，前缀加 0xFF 大于所有以该前缀开头的键
+        return bisect.bisect_left(self.keys, key), bisect.bisect_left(self.keys, key + b'\xff')
+    
+    def devices(self, start: int = 0, end: int = None) -> List[str]:
+        """序号区间 [start, end) 内的设备"""
+        end = self.count if end is None else min(end, self.count)
+        return [self[i] for i in range(max(0, start), end)]
+    
+    def page(self, offset: int = 0, limit: int = None, prefix: str = None) -> Tuple[int, List[str]]:
+        """分页读取（可按前缀过滤），返回 (匹配的设备总数, 本页设备)"""
+        start, end = self.prefix_range(prefix) if prefix else (0, self.count)
+        first = start + max(0, offset)
+        last = end if limit is None else min(end, first + limit)
+        return end - start, self.devices(first, last)
+
+
+def is_fresh_index(index_path: Path, list_path: Path) -> bool:
+    """索引文件存在且不早于设备列表文件（列表在索引之后又有追加时索引已过期）"""
+    try:
+        index_mtime = index_path.stat().st_mtime
+    except OSError:
+        return False
+    try:
+        return index_mtime >= list_path.stat().st_mtime
+    except OSError:
+        return True
+
+
+def print_stats(stats: Dict):
+    labels = (('app_id', '应用ID'), ('online', '在线消息数'), ('offline', '离线消息数'),
+              ('devices', '当前在线设备数'), ('known', '已知设备数'), ('stale', '乱序事件数'),
+              ('generated', '生成时间'))
+    for key, label in labels:
+        if key in stats:
+            print(f"# {label}: {stats[key]}")
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="已排序的在线设备索引文件")
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    show_parser = commands.add_parser('show', help='分页显示设备（可按前缀过滤）')
+    show_parser.add_argument('file', help='索引文件（online_devices_*.idx）')
+    show_parser.add_argument('--offset', type=int, default=0, help='跳过的设备数（默认0）')
+    show_parser.add_argument('--limit', type=int, default=None, help='最多显示的设备数（默认全部）')
+    show_parser.add_argument('--prefix', default=None, help='只显示以该前缀开头的设备')
+    
+    lookup_parser = commands.add_parser('lookup', help='判断设备是否在索引中')
+    lookup_parser.add_argument('file', help='索引文件')
+    lookup_parser.add_argument('dev_sn', help='设备序列号')
+    
+    build_parser = commands.add_parser('build', help='由设备列表文件生成索引文件')
+    build_parser.add_argument('file', help='设备列表文件（如 online_devices_10001.txt）')
+    build_parser.add_argument('--output', default=None, help='索引文件路径（默认同名 .idx）')
+    
+    args = parser.parse_args()
+    
+    if args.command == 'build':
+        source = Path(args.file)
+        output = Path(args.output) if args.output else source.with_suffix('.idx')
+        count = write_device_index(output, read_device_list(source), {'source': source.name})
+        print(f"✓ {output}: {count} 个设备")
+        return
+    
+    try:
+        index = DeviceIndex(Path(args.file))
+    except (OSError, ValueError, struct.error) as e:
+        print(f"✗ 无法打开索引文件: {e}")
+        sys.exit(1)
+    
+    with index:
+        if args.command == 'show':
+            total, devices = index.page(args.offset, args.limit, args.prefix)
+            for i, dev_sn in enumerate(devices, args.offset + 1):
+                print(f"{i}. {dev_sn}")
+            print("=" * 50)
+            print(f"总计: {total} 个设备" + (f"（前缀 {args.prefix}）" if args.prefix else ""))
+            print_stats(index.stats)
+        
+        elif args.command == 'lookup':
+            found = args.dev_sn in index
+            print(f"{args.dev_sn}: {'在线' if found else '不在在线列表中'}")
+            sys.exit(0 if found else 1)
+
+
+if __name__ == "__main__":
+    main()
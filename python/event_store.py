@@ -0,0 +1,667 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+event_store.py - 设备状态事件历史存储
+设备监控器把每次在线状态变化（应用、设备、状态、changeTime）写成定长记录，
+按 changeTime 的UTC日期分区、只追加写入不可变的分段文件；查询时以 mmap 映射分段，
+经稀疏索引二分查找回答"设备X在时间T是否在线"、"时间T应用A有哪些设备在线"
+与"设备X在一段时间内的状态变化"，无需重新扫描原始消息文本
+
+存储目录结构:
+  devices.dict              devSn 字典（第N行为设备编号N），只追加
+  apps.dict                 应用ID字典（第N行为应用编号N），只追加
+  YYYYMMDD/seg-L-SEQ.dseg   当日事件分段（L为合并层级），每段按 (应用, 设备, changeTime) 排序
+  YYYYMMDD/base.dseg        当日基线：当日0点（UTC）前每个设备的最后一条事件（前一日封存时生成）
+
+使用示例:
+  python3 event_store.py --dir device_history info
+  python3 event_store.py --dir device_history state 0012AB34CD --at "2024-01-01 09:00:00"
+  python3 event_store.py --dir device_history online --app 10001 --at "2024-01-01 09:00:00" --limit 20
+  python3 event_store.py --dir device_history history 0012AB34CD --from 2024-01-01 --to 2024-01-02
+"""
+
+import os
+import sys
+import mmap
+import array
+import heapq
+import bisect
+import struct
+import argparse
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple, Iterator, Iterable, Optional
+
+from device_ids import DeviceIdRegistry
+
+
+# 记录: 应用编号 uint16, 设备编号 uint32, changeTime(毫秒) uint64, 是否在线, 填充（大端，
+# 记录字节序即 (应用, 设备, changeTime) 的排序顺序，二分查找直接比较字节串）
+RECORD = struct.Struct('>HIQ?x')
+KEY = struct.Struct('>HIQ')
+DEVICE_KEY = struct.Struct('>HI')
+
+# 分段文件头: 魔数, 记录数, 稀疏索引间隔
+SEGMENT_HEADER = struct.Struct('<8sQI4x')
+SEGMENT_MAGIC = b'DEVHIST1'
+
+# 每隔多少条记录在稀疏索引中登记一个键
+INDEX_STRIDE = 128
+
+DAY_MS = 86400 * 1000
+
+# 同一层级的分段数达到该值时合并为上一层级的一个分段
+MERGE_FANOUT = 8
+
+BASE_NAME = "base.dseg"
+
+
+def day_name(day: int) -> str:
+    """日期序号（UTC纪元起的天数）-> 分区目录名 YYYYMMDD"""
+    return datetime.fromtimestamp(day * 86400, timezone.utc).strftime('%Y%m%d')
+
+
+def parse_day_name(name: str) -> Optional[int]:
+    """分区目录名 -> 日期序号，不是分区目录时返回 None"""
+    if len(name) != 8 or not name.isdigit():
+        return None
+    try:
+        moment = datetime.strptime(name, '%Y%m%d').replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+    return int(moment.timestamp()) // 86400
+
+
+def write_segment(path: Path, records: Iterable[bytes]) -> int:
+    """把已排序的记录流写为分段文件（临时文件 + rename），相同记录只保留一条，返回记录数"""
+    tmp_path = path.with_name(path.name + '.tmp')
+    count = 0
+    index = bytearray()
+    previous = None
+    with open(tmp_path, 'wb') as f:
+        f.write(bytes(SEGMENT_HEADER.size))
+        for record in records:
+            if record == previous:
+                continue
+            previous = record
+            if count % INDEX_STRIDE == 0:
+                index += record[:KEY.size]
+            f.write(record)
+            count += 1
+        f.write(index)
+        f.seek(0)
+        f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, count, INDEX_STRIDE))
+    if count:
+        os.replace(tmp_path, path)
+    else:
+        os.unlink(tmp_path)
+    return count
+
+
+class KeyView:
+    """把映射区中等间隔排列的键当作只读序列，供 bisect 直接二分"""
+    
+    __slots__ = ('data', 'start', 'step', 'width', 'length')
+    
+    def __init__(self, data, start: int, step: int, width: int, length: int):
+        self.data = data
+        self.start = start
+        self.step = step
+        self.width = width
+        self.length = length
+    
+    def __len__(self) -> int:
+        return self.length
+    
+    def __getitem__(self, i: int) -> bytes:
+        pos = self.start + i * self.step
+        return self.data[pos:pos + self.width]
+
+
+class Segment:
+    """只读映射的分段文件"""
+    
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.stride = SEGMENT_HEADER.unpack_from(self.data)
+        if magic != SEGMENT_MAGIC:
+            self.data.close()
+            raise ValueError(f"不是事件分段文件: {path}")
+        self.records = KeyView(self.data, SEGMENT_HEADER.size, RECORD.size, KEY.size, self.count)
+        index_start = SEGMENT_HEADER.size + self.count * RECORD.size
+        self.index = KeyView(self.data, index_start, KEY.size, KEY.size,
+                             (self.count + self.stride - 1) // self.stride)
+    
+    def close(self):
+        self.data.close()
+    
+    def record(self, i: int) -> bytes:
+        pos = SEGMENT_HEADER.size + i * RECORD.size
+        return self.data[pos:pos + RECORD.size]
+    
+    def bisect_left(self, key: bytes) -> int:
+        """第一条键 >= key 的记录位置：先在稀疏索引中定位区块，再在区块内二分"""
+        block = bisect.bisect_left(self.index, key)
+        lo = max(0, block - 1) * self.stride
+        return bisect.bisect_left(self.records, key, lo, min(self.count, block * self.stride))
+    
+    def bisect_right(self, key: bytes) -> int:
+        """第一条键 > key 的记录位置"""
+        block = bisect.bisect_right(self.index, key)
+        lo = max(0, block - 1) * self.stride
+        return bisect.bisect_right(self.records, key, lo, min(self.count, block * self.stride))
+    
+    def iter_records(self, start: int = 0, end: int = None) -> Iterator[bytes]:
+        """按顺序返回 [start, end) 的原始记录"""
+        data = self.data
+        size = RECORD.size
+        end = self.count if end is None else end
+        pos = SEGMENT_HEADER.size + start * size
+        for _ in range(start, end):
+            yield data[pos:pos + size]
+            pos += size
+    
+    def latest_before(self, app: int, device: int, change_time: int) -> Optional[bytes]:
+        """设备在 change_time（含）之前的最后一条记录"""
+        i = self.bisect_right(KEY.pack(app, device, change_time)) - 1
+        if i < 0:
+            return None
+        record = self.record(i)
+        return record if record[:DEVICE_KEY.size] == DEVICE_KEY.pack(app, device) else None
+    
+    def range(self, first_key: bytes, last_key: bytes) -> Iterator[bytes]:
+        """键在 [first_key, last_key] 内的记录"""
+        return self.iter_records(self.bisect_left(first_key), self.bisect_right(last_key))
+
+
+class NameDictionary:
+    """只追加的名称字典文件：第N行为编号N的名称"""
+    
+    def __init__(self, path: Path, writable: bool = False):
+        self.path = path
+        self.names: List[str] = []
+        self.ids: Dict[str, int] = {}
+        self.pending: List[str] = []
+        if path.exists():
+            data = path.read_bytes()
+            # 崩溃时可能留下不完整的最后一行：写入端截断到最后一个换行，查询端忽略
+            complete = data.rfind(b'\n') + 1
+            if writable and complete != len(data):
+                with open(path, 'r+b') as f:
+                    f.truncate(complete)
+            self.names = data[:complete].decode('utf-8').split('\n')[:-1]
+            self.ids = {name: i for i, name in enumerate(self.names)}
+    
+    def intern(self, name: str) -> int:
+        name_id = self.ids.get(name)
+        if name_id is None:
+            name_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.pending.append(name)
+        return name_id
+    
+    def save(self):
+        """追加新登记的名称（先于引用它们的分段写出）"""
+        if not self.pending:
+            return
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write("".join(name + "\n" for name in self.pending))
+        self.pending = []
+
+
+class EventRecorder:
+    """单个应用状态表的事件记录钩子，接口与 SessionAnalytics.record 相同
+    
+    消费线程只把事件追加到内存数组，由 EventStore.flush 取出、转换为存储编号后写出分段。
+    """
+    
+    __slots__ = ('app', 'registry', 'translate', 'lock', 'ids', 'times', 'flags')
+    
+    def __init__(self, app: int, registry):
+        self.app = app
+        self.registry = registry
+        self.translate = array.array('I')   # 编码表设备ID -> 存储设备编号
+        self.lock = threading.Lock()
+        self.ids = array.array('Q')
+        self.times = array.array('Q')
+        self.flags = bytearray()
+    
+    def record(self, device_id: int, online: bool, change_time: int, known: bool = True):
+        if not change_time:
+            return
+        with self.lock:
+            self.ids.append(device_id)
+            self.times.append(change_time)
+            self.flags.append(online)
+    
+    def take(self) -> Tuple[array.array, array.array, bytearray]:
+        with self.lock:
+            taken = (self.ids, self.times, self.flags)
+            self.ids = array.array('Q')
+            self.times = array.array('Q')
+            self.flags = bytearray()
+        return taken
+
+
+class EventStore:
+    """事件历史的写入端
+    
+    事件先缓存在各状态表的 EventRecorder 中，flush 时按UTC日期分组、排序后各写成一个
+    第0层分段；同一天同一层级的分段达到 MERGE_FANOUT 个时合并到上一层级。changeTime
+    超过某天结束 seal_grace 毫秒后封存该天：合并当日全部分段，并生成次日基线
+    （截至次日0点每个设备的最后一条事件），时间点查询最多回溯到最近的基线。
+    迟到事件写入已封存的日期时删除其后各天的基线，下次 flush 时按顺序重新生成。
+    """
+    
+    def __init__(self, root: Path, seal_grace: int = 3600 * 1000):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.seal_grace = seal_grace
+        self.devices = NameDictionary(self.root / "devices.dict", writable=True)
+        self.apps = NameDictionary(self.root / "apps.dict", writable=True)
+        self.recorders: List[EventRecorder] = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.latest = 0          # 已写入的最大 changeTime
+        self.written = 0         # 已写入的记录数
+    
+    def recorder(self, app_id: str, registry) -> EventRecorder:
+        """为应用的一张状态表创建事件记录钩子"""
+        with self.lock:
+            recorder = EventRecorder(self.apps.intern(app_id), registry)
+            self.recorders.append(recorder)
+        return recorder
+    
+    def day_dir(self, day: int) -> Path:
+        return self.root / day_name(day)
+    
+    def list_days(self) -> List[int]:
+        return sorted(day for day in (parse_day_name(path.name) for path in self.root.iterdir()
+                                      if path.is_dir()) if day is not None)
+    
+    @staticmethod
+    def list_segments(day_dir: Path) -> List[Tuple[int, int, Path]]:
+        """当日分段 [(层级, 序号, 路径)]，按序号排序"""
+        segments = []
+        for path in day_dir.glob("seg-*.dseg"):
+            _, level, seq = path.stem.split('-')
+            segments.append((int(level), int(seq), path))
+        return sorted(segments, key=lambda item: item[1])
+    
+    def next_segment_path(self, day_dir: Path, level: int) -> Path:
+        segments = self.list_segments(day_dir)
+        seq = segments[-1][1] + 1 if segments else 1
+        return day_dir / f"seg-{level}-{seq:08d}.dseg"
+    
+    def flush(self) -> int:
+        """写出所有记录钩子中缓存的事件，返回写入的记录数"""
+        with self.flush_lock:
+            records_by_day: Dict[int, List[bytes]] = {}
+            pack = RECORD.pack
+            for recorder in list(self.recorders):
+                ids, times, flags = recorder.take()
+                if not ids:
+                    continue
+                translate = recorder.translate
+                if len(translate) < len(recorder.registry):
+                    intern = self.devices.intern
+                    translate.extend(intern(name) for name in recorder.registry.names[len(translate):])
+                app = recorder.app
+                self.latest = max(self.latest, max(times))
+                for device_id, change_time, online in zip(ids, times, flags):
+                    records_by_day.setdefault(change_time // DAY_MS, []).append(
+                        pack(app, translate[device_id], change_time, online))
+            
+            # 字典先于引用它的分段落盘
+            self.apps.save()
+            self.devices.save()
+            
+            total = 0
+            for day in sorted(records_by_day):
+                records = records_by_day[day]
+                records.sort()
+                day_dir = self.day_dir(day)
+                day_dir.mkdir(exist_ok=True)
+                total += write_segment(self.next_segment_path(day_dir, 0), records)
+                self.invalidate_bases_after(day)
+                self.merge_levels(day_dir)
+            self.written += total
+            self.seal_days()
+            return total
+    
+    def invalidate_bases_after(self, day: int):
+        """删除 day 之后各天的基线（它们不再包含 day 的全部事件）"""
+        for later in self.list_days():
+            if later > day:
+                base = self.day_dir(later) / BASE_NAME
+                if base.exists():
+                    base.unlink()
+    
+    def merge_levels(self, day_dir: Path):
+        """同一层级的分段达到 MERGE_FANOUT 个时合并为上一层级的一个分段"""
+        level = 0
+        while True:
+            group = [path for seg_level, _, path in self.list_segments(day_dir) if seg_level == level]
+            if len(group) < MERGE_FANOUT:
+                return
+            self.merge_segments(group, self.next_segment_path(day_dir, level + 1))
+            level += 1
+    
+    @staticmethod
+    def merge_segments(paths: List[Path], target: Path) -> int:
+        """归并多个分段为一个新分段，再删除原分段"""
+        segments = [Segment(path) for path in paths]
+        try:
+            count = write_segment(target, heapq.merge(*(segment.iter_records() for segment in segments)))
+        finally:
+            for segment in segments:
+                segment.close()
+        for path in paths:
+            path.unlink()
+        return count
+    
+    def seal_days(self):
+        """按日期顺序封存已结束的日分区：合并当日分段并生成下一天的基线"""
+        horizon = (self.latest - self.seal_grace) // DAY_MS
+        for day in self.list_days():
+            if day >= horizon:
+                break
+            day_dir = self.day_dir(day)
+            segments = self.list_segments(day_dir)
+            next_base = self.day_dir(day + 1) / BASE_NAME
+            if not segments or next_base.exists():
+                continue
+            if len(segments) > 1:
+                self.merge_segments([path for _, _, path in segments], self.next_segment_path(day_dir, 9))
+            self.write_base(day + 1)
+    
+    def write_base(self, day: int):
+        """由截至前一天的数据生成 day 的基线：每个设备 day 0点前的最后一条事件"""
+        sources = open_sources(self.root, day - 1)
+        try:
+            merged = heapq.merge(*(segment.iter_records() for segment in sources))
+            self.day_dir(day).mkdir(exist_ok=True)
+            write_segment(self.day_dir(day) / BASE_NAME, last_per_device(merged))
+        finally:
+            for segment in sources:
+                segment.close()
+    
+    def close(self):
+        self.flush()
+
+
+def last_per_device(records: Iterable[bytes]) -> Iterator[bytes]:
+    """已按键排序的记录流中每个 (应用, 设备) 的最后一条"""
+    previous = None
+    for record in records:
+        if previous is not None and previous[:DEVICE_KEY.size] != record[:DEVICE_KEY.size]:
+            yield previous
+        previous = record
+    if previous is not None:
+        yield previous
+
+
+def open_sources(root: Path, day: int) -> List[Segment]:
+    """回答 day 当天（含）之前时间点查询所需的分段：最近的基线及其后各天的分段"""
+    def list_paths() -> List[Path]:
+        days = [(parse_day_name(path.name), path) for path in Path(root).iterdir() if path.is_dir()]
+        days = sorted((d, path) for d, path in days if d is not None and d <= day)
+        start = 0
+        for i in range(len(days) - 1, -1, -1):
+            if (days[i][1] / BASE_NAME).exists():
+                start = i
+                break
+        paths = []
+        for i, (_, day_dir) in enumerate(days[start:]):
+            if i == 0 and (day_dir / BASE_NAME).exists():
+                paths.append(day_dir / BASE_NAME)
+            paths.extend(path for _, _, path in EventStore.list_segments(day_dir))
+        return paths
+    
+    return open_segments(list_paths)
+
+
+def open_segments(list_paths: Callable[[], List[Path]]) -> List[Segment]:
+    """打开 list_paths() 列出的分段。
+    
+    写入端合并分段、封存日分区和删除失效基线时会删除文件，只跳过打不开的文件会漏掉记录
+    （合并后的新分段或较早的基线不在已列出的路径中）。打开时文件已被删除，或打开后重新列出的
+    路径有变化，就关闭已打开的分段重新列出；已打开的分段在删除后内容不变
+    """
+    while True:
+        paths = list_paths()
+        segments = []
+        try:
+            for path in paths:
+                segments.append(Segment(path))
+        except FileNotFoundError:
+            pass
+        else:
+            if list_paths() == paths:
+                return segments
+        for segment in segments:
+            segment.close()
+
+
+class EventHistory:
+    """事件历史的查询端（只读）"""
+    
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.app_names = NameDictionary(self.root / "apps.dict").names
+        self._devices = None
+    
+    @property
+    def devices(self) -> DeviceIdRegistry:
+        """devices.dict 的编码表（存储设备编号 <-> devSn），首次使用时加载"""
+        if self._devices is None:
+            self._devices = DeviceIdRegistry.from_names(NameDictionary(self.root / "devices.dict").names)
+        return self._devices
+    
+    @property
+    def device_names(self) -> List[str]:
+        return self.devices.names
+    
+    def device_id(self, dev_sn: str) -> Optional[int]:
+        return self.devices.lookup(dev_sn)
+    
+    def app_numbers(self, app_id: str = None) -> List[int]:
+        if app_id is None:
+            return list(range(len(self.app_names)))
+        return [self.app_names.index(app_id)] if app_id in self.app_names else []
+    
+    def state_at(self, dev_sn: str, change_time: int, app_id: str = None
+                 ) -> Dict[str, Optional[Tuple[bool, int]]]:
+        """设备在 change_time 时刻的状态: 应用ID -> (是否在线, 该状态的changeTime)，没有记录时为 None"""
+        device = self.device_id(dev_sn)
+        apps = self.app_numbers(app_id)
+        result = {self.app_names[app]: None for app in apps}
+        if device is None:
+            return result
+        sources = open_sources(self.root, change_time // DAY_MS)
+        try:
+            for app in apps:
+                latest = None
+                for segment in sources:
+                    record = segment.latest_before(app, device, change_time)
+                    if record is not None and (latest is None or record > latest):
+                        latest = record
+                if latest is not None:
+                    _, _, event_time, online = RECORD.unpack(latest)
+                    result[self.app_names[app]] = (online, event_time)
+        finally:
+            for segment in sources:
+                segment.close()
+        return result
+    
+    def online_at(self, app_id: str, change_time: int) -> Iterator[Tuple[str, int]]:
+        """change_time 时刻应用的在线设备 (devSn, 上线changeTime)，按设备编号顺序"""
+        apps = self.app_numbers(app_id)
+        if not apps:
+            return
+        app = apps[0]
+        sources = open_sources(self.root, change_time // DAY_MS)
+        try:
+            first, last = KEY.pack(app, 0, 0), KEY.pack(app, 0xFFFFFFFF, 0xFFFFFFFFFFFFFFFF)
+            merged = heapq.merge(*(segment.range(first, last) for segment in sources))
+            visible = (record for record in merged if RECORD.unpack(record)[2] <= change_time)
+            names = self.device_names
+            for record in last_per_device(visible):
+                _, device, event_time, online = RECORD.unpack(record)
+                if online:
+                    yield names[device], event_time
+        finally:
+            for segment in sources:
+                segment.close()
+    
+    def history(self, dev_sn: str, start: int, end: int, app_id: str = None
+                ) -> List[Tuple[str, int, bool]]:
+        """设备在 [start, end] 内的状态变化 [(应用ID, changeTime, 是否在线)]，按时间排序"""
+        device = self.device_id(dev_sn)
+        if device is None:
+            return []
+        
+        def list_paths() -> List[Path]:
+            paths = []
+            for day in range(start // DAY_MS, end // DAY_MS + 1):
+                day_dir = self.root / day_name(day)
+                if day_dir.is_dir():
+                    paths.extend(path for _, _, path in EventStore.list_segments(day_dir))
+            return paths
+        
+        events = set()
+        segments = open_segments(list_paths)
+        try:
+            for app in self.app_numbers(app_id):
+                first, last = KEY.pack(app, device, start), KEY.pack(app, device, end)
+                for segment in segments:
+                    for record in segment.range(first, last):
+                        _, _, event_time, online = RECORD.unpack(record)
+                        events.add((self.app_names[app], event_time, online))
+        finally:
+            for segment in segments:
+                segment.close()
+        return sorted(events, key=lambda event: (event[1], event[0]))
+    
+    def info(self) -> List[Dict]:
+        """各日期分区的分段数、记录数与字节数"""
+        days = []
+        for path in sorted(self.root.iterdir()):
+            day = parse_day_name(path.name)
+            if day is None or not path.is_dir():
+                continue
+            
+            def list_paths() -> List[Path]:
+                base = path / BASE_NAME
+                segments = [segment_path for _, _, segment_path in EventStore.list_segments(path)]
+                return segments + ([base] if base.exists() else [])
+            
+            opened = open_segments(list_paths)
+            try:
+                days.append({
+                    'day': path.name,
+                    'segments': sum(1 for segment in opened if segment.path.name != BASE_NAME),
+                    'records': sum(segment.count for segment in opened if segment.path.name != BASE_NAME),
+                    'base': sum(segment.count for segment in opened if segment.path.name == BASE_NAME),
+                    'bytes': sum(len(segment.data) for segment in opened),
+                })
+            finally:
+                for segment in opened:
+                    segment.close()
+        return days
+
+
+def parse_time(text: str) -> int:
+    """解析时间为毫秒时间戳: 纯数字按秒（<1e11）或毫秒，否则按ISO格式（无时区时为本地时间）"""
+    text = text.strip()
+    if text.isdigit():
+        value = int(text)
+        return value * 1000 if value < 10 ** 11 else value
+    try:
+        return int(datetime.fromisoformat(text).timestamp() * 1000)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无法解析的时间: {text}")
+
+
+def format_time(change_time: int) -> str:
+    return datetime.fromtimestamp(change_time / 1000).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="查询设备状态事件历史")
+    parser.add_argument('--dir', default=str(Path(__file__).parent.absolute() / "device_history"),
+                        help='事件历史目录（默认脚本目录下的 device_history）')
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    commands.add_parser('info', help='各日期分区的分段与记录数')
+    
+    state_parser = commands.add_parser('state', help='设备在某一时刻是否在线')
+    state_parser.add_argument('dev_sn', help='设备序列号')
+    state_parser.add_argument('--at', type=parse_time, required=True,
+                              help='时间（秒/毫秒时间戳或 "YYYY-MM-DD HH:MM:SS"，无时区时为本地时间）')
+    state_parser.add_argument('--app', default=None, help='应用ID（默认全部）')
+    
+    online_parser = commands.add_parser('online', help='某一时刻应用的在线设备')
+    online_parser.add_argument('--app', required=True, help='应用ID')
+    online_parser.add_argument('--at', type=parse_time, required=True, help='时间（格式同 state）')
+    online_parser.add_argument('--limit', type=int, default=None, help='最多显示的设备数（默认全部）')
+    online_parser.add_argument('--count', action='store_true', help='只显示在线设备数')
+    
+    history_parser = commands.add_parser('history', help='设备在一段时间内的状态变化')
+    history_parser.add_argument('dev_sn', help='设备序列号')
+    history_parser.add_argument('--from', dest='start', type=parse_time, required=True, help='开始时间')
+    history_parser.add_argument('--to', dest='end', type=parse_time, required=True, help='结束时间')
+    history_parser.add_argument('--app', default=None, help='应用ID（默认全部）')
+    
+    args = parser.parse_args()
+    
+    root = Path(args.dir)
+    if not root.is_dir():
+        print(f"✗ 事件历史目录不存在: {root}")
+        sys.exit(1)
+    store = EventHistory(root)
+    
+    if args.command == 'info':
+        days = store.info()
+        for day in days:
+            print(f"{day['day']}: {day['segments']} 个分段, {day['records']} 条事件, "
+                  f"基线 {day['base']} 个设备, {day['bytes']} 字节")
+        print(f"总计: {len(days)} 天, {sum(day['records'] for day in days)} 条事件")
+    
+    elif args.command == 'state':
+        states = store.state_at(args.dev_sn, args.at, args.app)
+        if not states:
+            print(f"✗ 未知的应用ID: {args.app}")
+            sys.exit(1)
+        print(f"设备 {args.dev_sn} 在 {format_time(args.at)}:")
+        for app_id, state in states.items():
+            if state is None:
+                print(f"  应用{app_id}: 无记录")
+            else:
+                status = "在线" if state[0] else "离线"
+                print(f"  应用{app_id}: {status}（自 {format_time(state[1])}）")
+    
+    elif args.command == 'online':
+        if args.app not in store.app_names:
+            print(f"✗ 未知的应用ID: {args.app}")
+            sys.exit(1)
+        count = 0
+        for dev_sn, since in store.online_at(args.app, args.at):
+            count += 1
+            if not args.count and (args.limit is None or count <= args.limit):
+                print(f"{count}. {dev_sn}（自 {format_time(since)}）")
+        print(f"应用{args.app} 在 {format_time(args.at)} 共 {count} 个在线设备")
+    
+    elif args.command == 'history':
+        events = store.history(args.dev_sn, args.start, args.end, args.app)
+        for app_id, change_time, online in events:
+            print(f"{format_time(change_time)}  应用{app_id}  {'上线' if online else '离线'}")
+        print(f"共 {len(events)} 条状态变化")
+
+
+if __name__ == "__main__":
+    main()
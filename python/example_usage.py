@@ -9,6 +9,8 @@ import time
 import subprocess
 from pathlib import Path
 
+from device_files import count_device_list
+
 
 def run_command(cmd, description):
     """运行命令并显示结果"""
@@ -48,8 +50,7 @@ def main():
     for file_name in files_to_check:
         file_path = script_dir / file_name
         if file_path.exists():
-            with open(file_path, 'r') as f:
-                lines = sum(1 for line in f if line.strip() and not line.startswith('#'))
+            lines = count_device_list(file_path)
             print(f"   ✓ {file_name}: {lines} 个设备")
         else:
             print(f"   ✗ {file_name}: 文件不存在")
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+message_generator.py - 合成设备在线状态消息
+生成与线上 s17_dcs_dev_online_* 主题格式一致的JSON消息（devSn、onlineStatus、changeTime、
+devId、plateNum、appId），按设备维护状态变化，并混入客户端系统日志行、无效消息、
+重复心跳与乱序事件；输出按主题分文件，可直接用于 --source file --replay 回放与基准测试
+
+使用示例:
+  python3 message_generator.py --count 1000000 --output 'replay/{topic}.txt'
+  python3 monitor_device_online.py start --source file --replay 'replay/{topic}.txt'
+"""
+
+import sys
+import random
+import argparse
+from pathlib import Path
+from typing import Dict, List, Iterator, Tuple
+
+
+# 默认主题与应用ID（与 DeviceMonitor.topics 一致）
+DEFAULT_TOPICS = [
+    ("s17_dcs_dev_online_10001", "10001"),
+    ("s17_dcs_dev_online_10002", "10002"),
+]
+
+# 车牌省份简称
+PLATE_PROVINCES = "京津沪渝冀豫云辽黑湘皖鲁新苏浙赣鄂桂甘晋蒙陕吉闽贵粤青藏川宁琼"
+
+
+class MessageGenerator:
+    """按应用生成设备在线状态消息流
+    
+    每个应用有固定的设备集合（devSn/devId/车牌号不变），每条消息随机挑选一个设备：
+    在线设备以 heartbeat_ratio 的概率重复上报 ONLINE（重复心跳），否则切换在线/离线；
+    以 stale_ratio 的概率产生 changeTime 早于该设备最新事件的乱序消息；
+    另按比例混入 kafka-console-consumer 的日志行（noise_ratio）与缺少字段的无效消息（invalid_ratio）。
+    相同参数与种子产生相同的消息序列。
+    """
+    
+    def __init__(self, devices: int = 10000, seed: int = 42, noise_ratio: float = 0.01,
+                 heartbeat_ratio: float = 0.3, stale_ratio: float = 0.01, invalid_ratio: float = 0.001,
+                 start_time_ms: int = 1700000000000, interval_ms: int = 20):
+        self.devices = max(1, devices)
+        self.seed = seed
+        self.noise_ratio = noise_ratio
+        self.heartbeat_ratio = heartbeat_ratio
+        self.stale_ratio = stale_ratio
+        self.invalid_ratio = invalid_ratio
+        self.start_time_ms = start_time_ms
+        self.interval_ms = interval_ms
+    
+    def device_pool(self, rng: random.Random, app_id: str) -> List[Tuple[str, str, str]]:
+        """生成应用的设备集合 [(devSn, devId, 车牌号)]，devSn 在应用内唯一"""
+        serials = rng.sample(range(0x100000, 0x1000000), self.devices)
+        return [
+            (f"00{app_id[-2:]}{serial:06X}",
+             f"{app_id}{index:08d}",
+             f"{rng.choice(PLATE_PROVINCES)}{chr(65 + rng.randrange(26))}{rng.randrange(10000, 99999)}")
+            for index, serial in enumerate(serials)
+        ]
+    
+    def noise_line(self, rng: random.Random, topic_name: str, index: int) -> str:
+        """kafka-console-consumer 输出的日志行（监控器按系统消息跳过）"""
+        kind = rng.randrange(3)
+        timestamp = f"2024-01-01 00:{(index // 60000) % 60:02d}:{(index // 1000) % 60:02d},{index % 1000:03d}"
+        if kind == 0:
+            return (f"[{timestamp}] WARNING [Consumer clientId=console-consumer, groupId=console-consumer-{self.seed}] "
+                    f"Connection to node -1 (/10.1.1.177:19092) could not be established. Broker may not be available.")
+        if kind == 1:
+            return (f"[{timestamp}] INFO [Consumer clientId=console-consumer, groupId=console-consumer-{self.seed}] "
+                    f"Resetting offset for partition {topic_name}-{rng.randrange(3)} to position FetchPosition{{offset=0}}")
+        return f"Processed a total of {index} messages"
+    
+    def messages(self, app_id: str, count: int, topic_name: str = None) -> Iterator[str]:
+        """生成一个应用的 count 行消息（含噪声行）"""
+        rng = random.Random(f"{self.seed}:{app_id}")
+        pool = self.device_pool(rng, app_id)
+        topic_name = topic_name or f"s17_dcs_dev_online_{app_id}"
+        # 设备ID -> (是否在线, 最新 changeTime)；未出现过的设备不在表中
+        states: Dict[int, Tuple[bool, int]] = {}
+        
+        random_value = rng.random
+        randrange = rng.randrange
+        device_count = len(pool)
+        noise_ratio = self.noise_ratio
+        invalid_ratio = self.invalid_ratio
+        stale_ratio = self.stale_ratio
+        heartbeat_ratio = self.heartbeat_ratio
+        change_time = self.start_time_ms
+        
+        for index in range(count):
+            change_time += randrange(1, 2 * self.interval_ms)
+            
+            roll = random_value()
+            if roll < noise_ratio:
+                yield self.noise_line(rng, topic_name, index)
+                continue
+            roll -= noise_ratio
+            
+            device = randrange(device_count)
+            dev_sn, dev_id, plate_num = pool[device]
+            
+            if roll < invalid_ratio:
+                # 缺少 devSn 的无效业务消息
+                yield (f'{{"devSn": "", "onlineStatus": "ONLINE", "changeTime": {change_time}, '
+                       f'"devId": "{dev_id}", "plateNum": "{plate_num}", "appId": "{app_id}"}}')
+                continue
+            
+            state = states.get(device)
+            if state is not None and random_value() < stale_ratio:
+                # 乱序事件：时间早于该设备最新事件，状态随机
+                online = random_value() < 0.5
+                event_time = state[1] - randrange(1, 60000)
+            else:
+                if state is None:
+                    online = True
+                elif state[0] and random_value() < heartbeat_ratio:
+                    online = True          # 重复心跳
+                else:
+                    online = not state[0]
+                event_time = change_time
+                states[device] = (online, event_time)
+            
+            yield (f'{{"devSn": "{dev_sn}", "onlineStatus": "{"ONLINE" if online else "OFFLINE"}", '
+                   f'"changeTime": {event_time}, "devId": "{dev_id}", '
+                   f'"plateNum": "{plate_num}", "appId": "{app_id}"}}')
+
+
+def split_count(count: int, parts: int) -> List[int]:
+    """把总条数尽量均分到各主题"""
+    base, extra = divmod(count, parts)
+    return [base + (1 if index < extra else 0) for index in range(parts)]
+
+
+def write_topic_files(generator: MessageGenerator, output_pattern: str, count: int,
+                      topics: List[Tuple[str, str]] = None, chunk_lines: int = 10000) -> Dict[str, Dict]:
+    """为每个主题写出回放文件（路径中的 {topic} 替换为主题名），返回 主题 -> {路径, 行数, 字节数}"""
+    topics = topics or DEFAULT_TOPICS
+    results = {}
+    for (topic_name, app_id), topic_count in zip(topics, split_count(count, len(topics))):
+        path = Path(output_pattern.format(topic=topic_name))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            chunk = []
+            for line in generator.messages(app_id, topic_count, topic_name):
+                chunk.append(line)
+                if len(chunk) >= chunk_lines:
+                    f.write("\n".join(chunk) + "\n")
+                    chunk = []
+            if chunk:
+                f.write("\n".join(chunk) + "\n")
+        results[topic_name] = {'path': str(path), 'lines': topic_count, 'bytes': path.stat().st_size}
+    return results
+
+
+def parse_topics(text: str) -> List[Tuple[str, str]]:
+    """解析 主题:应用ID,... 格式的主题列表"""
+    topics = []
+    for item in text.split(','):
+        topic_name, _, app_id = item.strip().partition(':')
+        if not topic_name or not app_id:
+            raise argparse.ArgumentTypeError(f"主题格式应为 主题:应用ID: {item}")
+        topics.append((topic_name, app_id))
+    return topics
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="合成设备在线状态消息（回放文件）")
+    parser.add_argument('--count', type=int, default=100000,
+                        help='生成的总行数，均分到各主题（默认100000）')
+    parser.add_argument('--output', default='messages_{topic}.txt',
+                        help='输出文件路径，{topic} 替换为主题名（默认 messages_{topic}.txt）')
+    parser.add_argument('--topics', type=parse_topics, default=None,
+                        help='主题列表，格式 主题:应用ID,...（默认 10001/10002 两个主题）')
+    parser.add_argument('--devices', type=int, default=None,
+                        help='每个应用的设备数（默认为每个主题行数的1/10）')
+    parser.add_argument('--seed', type=int, default=42, help='随机种子（默认42）')
+    parser.add_argument('--noise-ratio', type=float, default=0.01,
+                        help='客户端日志行比例（默认0.01）')
+    parser.add_argument('--heartbeat-ratio', type=float, default=0.3,
+                        help='在线设备重复上报 ONLINE 的概率（默认0.3）')
+    parser.add_argument('--stale-ratio', type=float, default=0.01,
+                        help='乱序事件比例（默认0.01）')
+    parser.add_argument('--invalid-ratio', type=float, default=0.001,
+                        help='无效业务消息比例（默认0.001）')
+    
+    args = parser.parse_args()
+    
+    topics = args.topics or DEFAULT_TOPICS
+    if '{topic}' not in args.output and len(topics) > 1:
+        print("✗ 多个主题时输出路径需包含 {topic} 占位符")
+        sys.exit(1)
+    
+    devices = args.devices or max(100, args.count // len(topics) // 10)
+    generator = MessageGenerator(devices=devices, seed=args.seed, noise_ratio=args.noise_ratio,
+                                 heartbeat_ratio=args.heartbeat_ratio, stale_ratio=args.stale_ratio,
+                                 invalid_ratio=args.invalid_ratio)
+    
+    results = write_topic_files(generator, args.output, args.count, topics)
+    for topic_name, info in results.items():
+        print(f"✓ {topic_name}: {info['lines']} 行, {info['bytes']} 字节 -> {info['path']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,29 +5,2311 @@ monitor_device_online.py - 监听设备在线状态变化并统计在线设备
 支持后台守护进程运行
 """
 
+import io
 import os
+import abc
 import sys
 import json
 import time
+import zlib
+import pickle
+import array
+import bisect
+import heapq
+import struct
 import signal
+import socket
+import tempfile
+import collections
+import select
+import queue
 import logging
+import contextlib
+import logging.handlers
+import asyncio
 import argparse
+import itertools
+import shutil
 import subprocess
 import threading
+import multiprocessing
+import concurrent.futures
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, Set, List, Tuple
+from typing import Dict, Set, List, Tuple, Iterable, Iterator, Optional, NamedTuple
 import re
 
+from device_ids import DeviceIdRegistry, DeviceSet, DeviceBitmap, format_bytes
+from device_files import read_device_list, count_device_list
+from event_store import EventStore
+from device_index import DeviceIndex, write_device_index, is_fresh_index
+from sketches import HyperLogLog, CountingHyperLogLog, BloomFilter, hash64, save_sketches
+
+# 可选的高性能JSON后端（未安装时自动回退到标准库json）
+try:
+    import orjson as fast_json
+except ImportError:
+    try:
+        import ujson as fast_json
+    except ImportError:
+        fast_json = None
+
+# 进程内Kafka客户端（--source kafka 时使用），未安装时使用同结构的本地定义
+try:
+    from kafka import TopicPartition
+except ImportError:
+    class TopicPartition(NamedTuple):
+        topic: str
+        partition: int
+
+
+# 系统消息前缀（Kafka客户端输出的日志/统计行）
+SYSTEM_MESSAGE_PATTERN = re.compile(r'Processed a total of|WARNING|INFO|ERROR|\[')
+
+# console-consumer 开启 print.partition/print.offset 后每行的元数据前缀
+RECORD_META_PATTERN = re.compile(r'(?:CreateTime:-?\d+\t)?Partition:(\d+)\tOffset:(\d+)\t')
+
+# kafka-topics.sh --describe 输出中每个分区一行（Topic: t\tPartition: 0\tLeader: ...）
+TOPIC_PARTITION_PATTERN = re.compile(r'\bPartition:\s*(\d+)')
+
+# kcat -L 输出中的主题行（  topic "t" with 3 partitions:）与分区行（    partition 0, leader 1, ...）
+KCAT_TOPIC_PATTERN = re.compile(r'^\s*topic "([^"]+)" with \d+ partitions?:')
+KCAT_PARTITION_PATTERN = re.compile(r'^\s*partition (\d+),')
+
+# 多路复用消费时每行的元数据前缀（kcat -f 输出的主题/key/分区/offset，见 MultiplexConsoleSource）
+MULTIPLEX_META_PATTERN = re.compile(r'Topic:([^\t]+)\t(?:Key:[^\t]*\t)?Partition:(\d+)\tOffset:(\d+)\t')
+
+# 从主题名末尾的数字推断应用ID（如 s17_dcs_dev_online_10003 -> 10003），用于未配置应用ID的主题
+TOPIC_APP_PATTERN = re.compile(r'_(\d+)$')
+
+# 单次扫描提取所有字段：字符串字段与数字字段(changeTime)合并为一个预编译正则
+FIELD_SCAN_PATTERN = re.compile(
+    r'"(devSn|onlineStatus|devId|plateNum|appId)":\s*"([^"]*)"'
+    r'|"(changeTime)":\s*([0-9]+)'
+)
+
+# 字符串类型字段与数字类型字段
+STRING_FIELDS = ('devSn', 'onlineStatus', 'devId', 'plateNum', 'appId')
+NUMBER_FIELDS = ('changeTime',)
+
+
+class MessageParser(abc.ABC):
+    """消息解析器基类，子类实现 extract_fields"""
+    
+    name = "base"
+    
+    def is_system_message(self, message: str) -> bool:
+        """判断是否为系统消息"""
+        if SYSTEM_MESSAGE_PATTERN.match(message):
+            return True
+        
+        # 检查是否包含JSON格式
+        return not ('{' in message and '}' in message)
+    
+    @abc.abstractmethod
+    def extract_fields(self, message: str) -> Dict[str, str]:
+        """从消息中提取字段，返回 字段名 -> 字符串值"""
+
+
+class RegexFieldParser(MessageParser):
+    """预编译单次扫描解析器：一次遍历消息提取全部字段"""
+    
+    name = "regex"
+    
+    def extract_fields(self, message: str) -> Dict[str, str]:
+        fields = {}
+        for match in FIELD_SCAN_PATTERN.finditer(message):
+            field = match.group(1)
+            if field is not None:
+                value = match.group(2)
+            else:
+                field = match.group(3)
+                value = match.group(4)
+            # 与逐字段 re.search 保持一致：同名字段只取第一次出现的值
+            if field not in fields:
+                fields[field] = value
+        return fields
+
+
+class JsonFieldParser(MessageParser):
+    """json.loads 快速路径，非标准JSON或字段不在顶层时回退到正则扫描"""
+    
+    name = "json"
+    
+    def __init__(self, loads=json.loads):
+        self.loads = loads
+        self.fallback = RegexFieldParser()
+    
+    def extract_fields(self, message: str) -> Dict[str, str]:
+        try:
+            data = self.loads(message)
+        except ValueError:
+            return self.fallback.extract_fields(message)
+        
+        if not isinstance(data, dict) or 'devSn' not in data:
+            return self.fallback.extract_fields(message)
+        
+        fields = {}
+        for field in STRING_FIELDS:
+            value = data.get(field)
+            if isinstance(value, str):
+                fields[field] = value
+        for field in NUMBER_FIELDS:
+            value = data.get(field)
+            if isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+                fields[field] = str(value)
+        return fields
+
+
+class FastJsonFieldParser(JsonFieldParser):
+    """基于 orjson/ujson 的JSON解析器（需要安装对应的第三方库）"""
+    
+    name = "fastjson"
+    
+    def __init__(self):
+        if fast_json is None:
+            raise ImportError("未安装 orjson 或 ujson")
+        super().__init__(loads=fast_json.loads)
+
+
+# 可选的解析后端：名称 -> 解析器类
+PARSER_BACKENDS = {
+    'regex': RegexFieldParser,
+    'json': JsonFieldParser,
+    'fastjson': FastJsonFieldParser,
+}
+
+
+def available_parser_backends() -> List[str]:
+    """返回当前环境可用的解析后端名称"""
+    return [name for name in PARSER_BACKENDS
+            if name != 'fastjson' or fast_json is not None]
+
+
+def create_message_parser(backend: str = "auto") -> MessageParser:
+    """按名称创建解析器；auto 优先使用 fastjson，不可用时使用标准库 json"""
+    if backend == "auto":
+        backend = "fastjson" if fast_json is not None else "json"
+    
+    if backend not in PARSER_BACKENDS:
+        raise ValueError(f"未知的解析后端: {backend}，可选: auto, {', '.join(PARSER_BACKENDS)}")
+    
+    if backend == "fastjson" and fast_json is None:
+        # 未安装第三方JSON库时回退到标准库
+        backend = "json"
+    
+    return PARSER_BACKENDS[backend]()
+
+
+def split_complete_lines(data: bytes, batch: List[str]) -> bytes:
+    """把数据中的完整行整体解码一次追加到批次（跳过空行），返回末尾不完整的部分"""
+    cut = data.rfind(b'\n') + 1
+    if cut:
+        for line in data[:cut].decode('utf-8', errors='replace').split('\n'):
+            line = line.strip()
+            if line:
+                batch.append(line)
+    return data[cut:]
+
+
+def iter_line_batches(streams, max_lines: int, max_wait_ms: int, read_size: int = 1 << 16):
+    """按块读取管道并切分为行批次：凑满 max_lines 行或首行等待超过 max_wait_ms 即产出一批
+    
+    每次 os.read 读取一大块字节，只对完整行整体解码一次，
+    避免逐行 readline/decode 的Python开销；可同时读取多个管道，
+    全部管道关闭(EOF)时产出剩余数据后结束。
+    """
+    if not isinstance(streams, (list, tuple)):
+        streams = [streams]
+    
+    max_wait = max_wait_ms / 1000.0
+    pending: Dict[int, bytes] = {stream.fileno(): b'' for stream in streams}
+    batch: List[str] = []
+    deadline = None
+    
+    while pending:
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        ready, _, _ = select.select(list(pending), [], [], timeout)
+        
+        for fd in ready:
+            chunk = os.read(fd, read_size)
+            if not chunk:
+                # 该管道已关闭，保留最后一个不完整行
+                tail = pending.pop(fd).decode('utf-8', errors='replace').strip()
+                if tail:
+                    batch.append(tail)
+                continue
+            
+            pending[fd] = split_complete_lines(pending[fd] + chunk, batch)
+        
+        if batch and deadline is None:
+            deadline = time.monotonic() + max_wait
+        
+        while len(batch) >= max_lines:
+            yield batch[:max_lines]
+            batch = batch[max_lines:]
+        
+        if not batch:
+            deadline = None
+        elif time.monotonic() >= deadline:
+            yield batch
+            batch = []
+            deadline = None
+    
+    if batch:
+        yield batch
+
+
+async def aiter_line_batches(readers, max_lines: int, max_wait_ms: int, read_size: int = 1 << 16):
+    """iter_line_batches 的 asyncio 版本：从多个 StreamReader 按块读取并切分为行批次
+    
+    每个读取器由一个读取任务把数据块放入有界队列（消费跟不上时读取任务暂停），
+    批次的凑满/超时规则与 iter_line_batches 相同；被取消时一并取消读取任务。
+    """
+    loop = asyncio.get_running_loop()
+    max_wait = max_wait_ms / 1000.0
+    chunks: asyncio.Queue = asyncio.Queue(2 * len(readers))
+    
+    async def pump(index: int, reader: asyncio.StreamReader):
+        try:
+            while True:
+                chunk = await reader.read(read_size)
+                await chunks.put((index, chunk))
+                if not chunk:
+                    return
+        except (ConnectionError, OSError):
+            await chunks.put((index, b''))
+    
+    tasks = [asyncio.ensure_future(pump(index, reader)) for index, reader in enumerate(readers)]
+    pending: Dict[int, bytes] = {index: b'' for index in range(len(readers))}
+    batch: List[str] = []
+    deadline = None
+    
+    try:
+        while pending:
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            try:
+                index, chunk = await asyncio.wait_for(chunks.get(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                if not chunk:
+                    # 该管道已关闭，保留最后一个不完整行
+                    tail = pending.pop(index).decode('utf-8', errors='replace').strip()
+                    if tail:
+                        batch.append(tail)
+                else:
+                    pending[index] = split_complete_lines(pending[index] + chunk, batch)
+            
+            if batch and deadline is None:
+                deadline = loop.time() + max_wait
+            
+            while len(batch) >= max_lines:
+                yield batch[:max_lines]
+                batch = batch[max_lines:]
+            
+            if not batch:
+                deadline = None
+            elif loop.time() >= deadline:
+                yield batch
+                batch = []
+                deadline = None
+        
+        if batch:
+            yield batch
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def use_pidfd_child_watcher(loop: asyncio.AbstractEventLoop):
+    """Python 3.8-3.11 默认的 ThreadedChildWatcher 为每个子进程开一个等待线程，
+    内核支持 pidfd 时改用绑定到 loop 的 PidfdChildWatcher，子进程退出由事件循环直接感知；
+    3.12 起已默认如此（且子进程监视器接口已废弃），无需设置。
+    """
+    if sys.version_info >= (3, 12) or not hasattr(asyncio, 'PidfdChildWatcher'):
+        return
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except (AttributeError, OSError):
+        return
+    watcher = asyncio.PidfdChildWatcher()
+    # 只有主线程创建的事件循环会自动绑定监视器，这里显式绑定到当前循环
+    watcher.attach_loop(loop)
+    asyncio.set_child_watcher(watcher)
+
+
+class MessageSource(abc.ABC):
+    """消息来源基类
+    
+    统一的生命周期: open() -> batches() 逐批产出消息文本（--batch-size 1 时用 lines()
+    逐条产出）-> close() 返回退出码；stop() 可在其他线程调用以中断正在进行的读取。
+    切换来源只影响消息如何到达，聚合逻辑(process_batch)保持不变。
+    """
+    
+    name = "base"
+    # 读取结束后是否需要由消费者线程重启（回放类来源读完即结束）
+    restartable = True
+    # 分区分配有变化而主动结束读取，消费者线程应立即按新的分配重启
+    reassigned = False
+    # 多路复用来源: batches() 产出 主题 -> 消息列表，位点按主题记录在 topic_positions
+    multiplexed = False
+    
+    def __init__(self, topic_name: str, start_offsets: Dict[int, int] = None):
+        self.topic_name = topic_name
+        # 分区 -> 起始offset（来自检查点），为空时从头消费
+        self.start_offsets: Dict[int, int] = dict(start_offsets or {})
+        # 分区 -> 下一条待消费的offset，随已产出的批次推进（不支持位点的来源保持不变）
+        self.positions: Dict[int, int] = dict(self.start_offsets)
+        # 打开时间（time.time()），用于导出来源/子进程运行时长
+        self.opened_at: Optional[float] = None
+    
+    def open(self):
+        """打开来源"""
+    
+    @abc.abstractmethod
+    def batches(self, max_lines: int, max_wait_ms: int) -> Iterator[List[str]]:
+        """逐批产出消息（已去除首尾空白、跳过空行）"""
+    
+    def lines(self) -> Iterator[str]:
+        """逐条产出消息（逐行消费路径）；默认按单条批次读取 batches()"""
+        for batch in self.batches(1, 0):
+            yield from batch
+    
+    def stop(self):
+        """中断读取"""
+    
+    def close(self) -> int:
+        """关闭来源并返回退出码（0表示正常结束）"""
+        return 0
+    
+    def describe(self) -> str:
+        """来源描述（用于日志）"""
+        return f"{self.name}:{self.topic_name}"
+    
+    # asyncio 引擎使用的接口；默认在线程池中执行同步接口，子类可提供原生实现
+    
+    async def open_async(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.open)
+    
+    async def abatches(self, max_lines: int, max_wait_ms: int):
+        """逐批产出消息的异步迭代器；默认在线程池中逐批拉取 batches()"""
+        loop = asyncio.get_running_loop()
+        iterator = self.batches(max_lines, max_wait_ms)
+        finished = object()
+        future = None
+        try:
+            while True:
+                future = loop.run_in_executor(None, next, iterator, finished)
+                # shield: 被取消时线程仍在读取，需等它返回后才能关闭来源
+                batch = await asyncio.shield(future)
+                if batch is finished:
+                    return
+                yield batch
+        finally:
+            if future is not None and not future.done():
+                self.stop()
+                await asyncio.wait([future])
+    
+    async def aclose(self) -> int:
+        return await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+
+class ConsoleConsumerSource(MessageSource):
+    """kafka-console-consumer.sh 子进程来源
+    
+    输出中携带分区与offset；无检查点时单进程 --from-beginning，
+    有检查点时用同目录的 kafka-topics.sh 列出主题的全部分区，每个分区启动一个进程：
+    已记录的分区从 --offset 续读，其余分区（含新增分区）从 earliest 消费。
+    无法列出分区时退回单进程从头消费，检查点之前的记录按位点跳过。
+    """
+    
+    name = "console"
+    
+    def __init__(self, topic_name: str, kafka_client: str, bootstrap_servers: str,
+                 start_offsets: Dict[int, int] = None):
+        super().__init__(topic_name, start_offsets)
+        self.kafka_client = kafka_client
+        self.bootstrap_servers = bootstrap_servers
+        self.processes: List[subprocess.Popen] = []
+        # 主题的全部分区（有检查点时打开前列出，列出失败为 None）
+        self.partitions: Optional[List[int]] = None
+    
+    def list_partitions(self) -> Optional[List[int]]:
+        """用 kafka-topics.sh --describe 列出主题的全部分区，失败时返回 None"""
+        cmd = [
+            str(Path(self.kafka_client).with_name("kafka-topics.sh")),
+            "--bootstrap-server", self.bootstrap_servers,
+            "--describe", "--topic", self.topic_name
+        ]
+        try:
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=60)
+        except (OSError, subprocess.SubprocessError):
+            return None
+        if result.returncode != 0:
+            return None
+        output = result.stdout.decode('utf-8', errors='replace')
+        partitions = {int(partition) for partition in TOPIC_PARTITION_PATTERN.findall(output)}
+        return sorted(partitions) or None
+    
+    def resolve_partitions(self):
+        """有检查点时列出主题分区，确定每个分区的起始位置"""
+        if self.start_offsets:
+            self.partitions = self.list_partitions()
+    
+    def build_commands(self) -> List[List[str]]:
+        """构建消费者命令行（每个元素对应一个进程）"""
+        base = [
+            self.kafka_client,
+            "--bootstrap-server", self.bootstrap_servers,
+            "--topic", self.topic_name,
+            "--property", "print.partition=true",
+            "--property", "print.offset=true"
+        ]
+        if not self.start_offsets or self.partitions is None:
+            return [base + ["--from-beginning"]]
+        # 检查点中的分区也保留（即使未出现在列出结果中），没有检查点的分区从头消费
+        partitions = sorted(set(self.partitions) | set(self.start_offsets))
+        return [base + ["--partition", str(partition),
+                        "--offset", str(self.start_offsets.get(partition, "earliest"))]
+                for partition in partitions]
+    
+    def open(self):
+        self.resolve_partitions()
+        # 二进制管道，按块读取
+        for cmd in self.build_commands():
+            self.processes.append(subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                bufsize=0
+            ))
+    
+    def batches(self, max_lines: int, max_wait_ms: int) -> Iterator[List[str]]:
+        streams = [process.stdout for process in self.processes]
+        for batch in iter_line_batches(streams, max_lines, max_wait_ms):
+            yield self.strip_record_meta(batch)
+    
+    def lines(self) -> Iterator[str]:
+        """单进程时按文本行读取管道（原逐行消费方式）；按分区多进程时同时等待各管道"""
+        if len(self.processes) != 1:
+            yield from super().lines()
+            return
+        stream = io.TextIOWrapper(io.BufferedReader(self.processes[0].stdout),
+                                  encoding='utf-8', errors='replace')
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield from self.strip_record_meta([line])
+    
+    def strip_record_meta(self, batch: List[str]) -> List[str]:
+        """去掉每行的分区/offset前缀并推进位点；无前缀的行（客户端日志等）原样保留"""
+        match_meta = RECORD_META_PATTERN.match
+        positions = self.positions
+        start_offsets = self.start_offsets
+        messages = []
+        for line in batch:
+            match = match_meta(line)
+            if match is None:
+                messages.append(line)
+                continue
+            
+            partition = int(match.group(1))
+            offset = int(match.group(2))
+            if offset < start_offsets.get(partition, 0):
+                # 检查点之前的记录已处理过
+                continue
+            positions[partition] = offset + 1
+            
+            value = line[match.end():].strip()
+            if value:
+                messages.append(value)
+        return messages
+    
+    def stop(self):
+        for process in self.processes:
+            if process.poll() is not None:
+                continue
+            try:
+                process.terminate()
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            except Exception:
+                pass
+    
+    def close(self) -> int:
+        if any(process.poll() is None for process in self.processes):
+            self.stop()
+        exit_code = 0
+        for process in self.processes:
+            process.stdout.close()
+            code = process.wait()
+            if code != 0 and exit_code == 0:
+                exit_code = code
+        return exit_code
+    
+    def describe(self) -> str:
+        description = f"{self.name}:{self.topic_name} ({self.kafka_client}, {len(self.processes)} 个进程"
+        if self.start_offsets and self.partitions is None:
+            description += ", 无法列出分区，从头消费并跳过检查点之前的记录"
+        return description + ")"
+
+
+class AsyncConsoleConsumerSource(ConsoleConsumerSource):
+    """asyncio 引擎使用的 console-consumer 来源
+    
+    子进程由 asyncio.create_subprocess_exec 启动，输出通过 StreamReader 读取，
+    所有主题的管道在同一个事件循环中等待，不再占用线程。
+    """
+    
+    async def open_async(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.resolve_partitions)
+        for cmd in self.build_commands():
+            self.processes.append(await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT
+            ))
+    
+    async def abatches(self, max_lines: int, max_wait_ms: int):
+        readers = [process.stdout for process in self.processes]
+        async for batch in aiter_line_batches(readers, max_lines, max_wait_ms):
+            yield self.strip_record_meta(batch)
+    
+    def stop(self):
+        # 只发送信号不等待，可在事件循环线程（含信号处理器）中调用；回收在 aclose 中完成
+        for process in self.processes:
+            if process.returncode is None:
+                try:
+                    process.terminate()
+                except ProcessLookupError:
+                    pass
+    
+    async def aclose(self) -> int:
+        exit_code = 0
+        for process in self.processes:
+            # 输出已读完的进程正在自行退出，只等待不终止，保留其真实退出码
+            if process.returncode is None and not process.stdout.at_eof():
+                try:
+                    process.terminate()
+                except ProcessLookupError:
+                    pass
+            try:
+                code = await asyncio.wait_for(process.wait(), 5)
+            except asyncio.TimeoutError:
+                process.kill()
+                code = await process.wait()
+            # 读到管道EOF：停止时读取已暂停，未读出的输出会让管道传输在事件循环关闭后才被回收
+            try:
+                await asyncio.wait_for(self.drain(process.stdout), 5)
+            except asyncio.TimeoutError:
+                pass
+            if code != 0 and exit_code == 0:
+                exit_code = code
+        return exit_code
+    
+    @staticmethod
+    async def drain(reader: asyncio.StreamReader):
+        while await reader.read(1 << 16):
+            pass
+
+
+class FileReplaySource(MessageSource):
+    """文件/NDJSON回放来源：按行读取录制的消息，读完即结束"""
+    
+    name = "file"
+    restartable = False
+    
+    def __init__(self, topic_name: str, file_path: Path):
+        super().__init__(topic_name)
+        self.file_path = Path(file_path)
+        self.file = None
+        self.stopped = False
+    
+    def open(self):
+        self.file = open(self.file_path, 'rb')
+    
+    def batches(self, max_lines: int, max_wait_ms: int) -> Iterator[List[str]]:
+        for batch in iter_line_batches(self.file, max_lines, max_wait_ms):
+            if self.stopped:
+                break
+            yield batch
+    
+    def stop(self):
+        self.stopped = True
+    
+    def close(self) -> int:
+        if self.file is not None:
+            self.file.close()
+        return 0
+    
+    def describe(self) -> str:
+        return f"{self.name}:{self.topic_name} ({self.file_path})"
+
+
+class KafkaClientSource(MessageSource):
+    """进程内Kafka客户端来源（kafka-python），省去每个主题一个JVM
+    
+    consumer_factory(**config) 需返回实现 partitions_for_topic / assign / seek /
+    seek_to_beginning / poll / close 的对象；默认使用 kafka.KafkaConsumer，
+    没有Kafka集群时可传入替身（见 test_monitor_device_online.py）。
+    """
+    
+    name = "kafka"
+    
+    def __init__(self, topic_name: str, bootstrap_servers: str, consumer_factory=None,
+                 start_offsets: Dict[int, int] = None):
+        super().__init__(topic_name, start_offsets)
+        self.bootstrap_servers = bootstrap_servers
+        self.consumer_factory = consumer_factory
+        self.consumer = None
+        self.stopped = False
+    
+    @staticmethod
+    def default_consumer_factory(**config):
+        """使用 kafka-python 创建消费者（未安装时抛出 ImportError）"""
+        from kafka import KafkaConsumer
+        return KafkaConsumer(**config)
+    
+    def open(self):
+        factory = self.consumer_factory or self.default_consumer_factory
+        self.consumer = factory(
+            bootstrap_servers=self.bootstrap_servers,
+            auto_offset_reset='earliest',
+            enable_auto_commit=False,
+            group_id=None,
+        )
+        
+        # 手动分配全部分区：有检查点的分区从记录的offset续读，其余从头消费
+        partitions = sorted(self.consumer.partitions_for_topic(self.topic_name) or [])
+        if not partitions:
+            raise RuntimeError(f"主题 {self.topic_name} 没有可用分区")
+        
+        topic_partitions = [TopicPartition(self.topic_name, partition) for partition in partitions]
+        self.consumer.assign(topic_partitions)
+        for topic_partition in topic_partitions:
+            offset = self.start_offsets.get(topic_partition.partition)
+            if offset is None:
+                self.consumer.seek_to_beginning(topic_partition)
+            else:
+                self.consumer.seek(topic_partition, offset)
+    
+    def batches(self, max_lines: int, max_wait_ms: int) -> Iterator[List[str]]:
+        positions = self.positions
+        while not self.stopped:
+            records = self.consumer.poll(timeout_ms=max_wait_ms, max_records=max_lines)
+            if records is None:
+                # 替身消费者用 None 表示流结束，结束后不再重启
+                self.restartable = False
+                break
+            
+            batch = []
+            for partition_records in records.values():
+                for record in partition_records:
+                    positions[record.partition] = record.offset + 1
+                    line = record.value.decode('utf-8', errors='replace').strip()
+                    if line:
+                        batch.append(line)
+            if batch:
+                yield batch
+    
+    def stop(self):
+        self.stopped = True
+    
+    def close(self) -> int:
+        if self.consumer is not None:
+            self.consumer.close()
+            self.consumer = None
+        return 0
+    
+    def describe(self) -> str:
+        return f"{self.name}:{self.topic_name} ({self.bootstrap_servers})"
+
+
+class TopicSubscription:
+    """多路复用消费的主题订阅：主题白名单，或正则（按 re.match 从主题名开头匹配）"""
+    
+    def __init__(self, names: List[str], pattern: str = None):
+        self.names = list(names)
+        self.pattern = re.compile(pattern) if pattern else None
+        self.matched: Dict[str, bool] = {}
+    
+    def matches(self, topic_name: str) -> bool:
+        result = self.matched.get(topic_name)
+        if result is None:
+            if self.pattern is not None:
+                result = self.pattern.match(topic_name) is not None
+            else:
+                result = topic_name in self.names
+            self.matched[topic_name] = result
+        return result
+    
+    def client_topics(self) -> List[str]:
+        """kcat 的订阅参数（正则主题须以 ^ 开头）"""
+        if self.pattern is None:
+            return list(self.names)
+        pattern = self.pattern.pattern
+        return [pattern if pattern.startswith('^') else '^' + pattern]
+    
+    def describe(self) -> str:
+        return self.pattern.pattern if self.pattern is not None else ",".join(self.names)
+
+
+def parse_topic_list(text: str) -> List[Tuple[str, str]]:
+    """解析 --topics 参数: 主题[:应用ID],...；省略应用ID时从主题名末尾的数字推断"""
+    topics = []
+    for item in text.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        topic_name, _, app_id = item.partition(':')
+        if not app_id:
+            match = TOPIC_APP_PATTERN.search(topic_name)
+            if match is None:
+                raise argparse.ArgumentTypeError(f"无法从主题名推断应用ID，请使用 主题:应用ID 格式: {item}")
+            app_id = match.group(1)
+        topics.append((topic_name, app_id))
+    if not topics:
+        raise argparse.ArgumentTypeError("主题列表为空")
+    return topics
+
+
+def route_multiplexed_lines(lines: List[str], subscription: TopicSubscription,
+                            start_offsets: Dict[str, Dict[int, int]],
+                            positions: Dict[str, Dict[int, int]]) -> Dict[Optional[str], List[str]]:
+    """按每行的主题/分区/offset前缀把一批行分组到各主题，并推进各主题的位点
+    
+    未订阅的主题与检查点之前的记录跳过；没有前缀的行（客户端日志等）归入 None 组。
+    """
+    match_meta = MULTIPLEX_META_PATTERN.match
+    groups: Dict[Optional[str], List[str]] = {}
+    current_topic = None
+    current = topic_starts = topic_positions = None
+    for line in lines:
+        match = match_meta(line)
+        if match is None:
+            groups.setdefault(None, []).append(line)
+            continue
+        
+        topic_name = match.group(1)
+        if topic_name != current_topic:
+            current_topic = topic_name
+            if subscription.matches(topic_name):
+                current = groups.setdefault(topic_name, [])
+                topic_starts = start_offsets.get(topic_name, {})
+                topic_positions = positions.setdefault(topic_name, {})
+            else:
+                current = None
+        if current is None:
+            continue
+        
+        partition = int(match.group(2))
+        offset = int(match.group(3))
+        if offset < topic_starts.get(partition, 0):
+            # 检查点之前的记录已处理过
+            continue
+        topic_positions[partition] = offset + 1
+        
+        value = line[match.end():].strip()
+        if value:
+            current.append(value)
+    return groups
+
+
+class MultiplexConsoleSource(ConsoleConsumerSource):
+    """kcat 子进程订阅主题白名单/正则，每条记录带主题、key、分区与offset前缀
+    
+    kafka-console-consumer.sh 的格式化器不能输出主题名，多路复用改用 kcat。
+    有检查点时用 kcat -L 列出匹配的主题与分区：有检查点的主题每个分区启动一个进程，
+    从检查点 -o 续读（没有记录的分区从头），其余主题各一个进程从头消费；
+    每隔 refresh_interval 秒重新列出，主题或分区有变化时结束读取，由消费者线程按新的分配重启。
+    无检查点或无法列出时以不提交位点的消费组订阅，从最早位置读取，检查点之前的记录按各主题位点跳过。
+    """
+    
+    name = "kcat"
+    multiplexed = True
+    OUTPUT_FORMAT = 'Topic:%t\\tKey:%k\\tPartition:%p\\tOffset:%o\\t%s\\n'
+    
+    def __init__(self, subscription: TopicSubscription, kafka_client: str, bootstrap_servers: str,
+                 start_offsets: Dict[str, Dict[int, int]] = None, refresh_interval: float = 60.0):
+        super().__init__(subscription.describe(), kafka_client, bootstrap_servers)
+        self.subscription = subscription
+        self.topic_start_offsets = {topic: dict(offsets) for topic, offsets in (start_offsets or {}).items()}
+        self.topic_positions = {topic: dict(offsets) for topic, offsets in self.topic_start_offsets.items()}
+        self.refresh_interval = refresh_interval
+        # 匹配订阅的主题 -> 全部分区（有检查点时打开前列出，列出失败或没有匹配的主题为 None）
+        self.topic_partitions: Optional[Dict[str, List[int]]] = None
+        self.refreshed_at = 0.0
+    
+    def list_topic_partitions(self) -> Optional[Dict[str, List[int]]]:
+        """用 kcat -L 列出匹配订阅的主题及其分区，失败或没有匹配的主题时返回 None"""
+        cmd = [self.kafka_client, "-L", "-b", self.bootstrap_servers]
+        try:
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=60)
+        except (OSError, subprocess.SubprocessError):
+            return None
+        if result.returncode != 0:
+            return None
+        
+        topic_partitions: Dict[str, List[int]] = {}
+        partitions = None
+        for line in result.stdout.decode('utf-8', errors='replace').splitlines():
+            match = KCAT_TOPIC_PATTERN.match(line)
+            if match is not None:
+                topic_name = match.group(1)
+                partitions = (topic_partitions.setdefault(topic_name, [])
+                              if self.subscription.matches(topic_name) else None)
+                continue
+            match = KCAT_PARTITION_PATTERN.match(line)
+            if match is not None and partitions is not None:
+                partitions.append(int(match.group(1)))
+        return {topic: sorted(partitions) for topic, partitions in topic_partitions.items()} or None
+    
+    def resolve_partitions(self):
+        """有检查点时列出匹配的主题与分区，确定每个分区的起始位置"""
+        self.refreshed_at = time.monotonic()
+        if self.topic_start_offsets:
+            self.topic_partitions = self.list_topic_partitions()
+    
+    def build_commands(self) -> List[List[str]]:
+        base = [self.kafka_client, "-C", "-q", "-u", "-b", self.bootstrap_servers]
+        if self.topic_partitions is None:
+            return [base + [
+                "-G", f"device-monitor-{os.getpid()}",
+                "-X", "auto.offset.reset=earliest",
+                "-X", "enable.auto.commit=false",
+                "-f", self.OUTPUT_FORMAT,
+            ] + self.subscription.client_topics()]
+        
+        commands = []
+        for topic_name, partitions in sorted(self.topic_partitions.items()):
+            start_offsets = self.topic_start_offsets.get(topic_name)
+            if not start_offsets:
+                commands.append(base + ["-t", topic_name, "-o", "beginning", "-f", self.OUTPUT_FORMAT])
+                continue
+            # 检查点中的分区也保留（即使未出现在列出结果中），没有检查点的分区从头消费
+            for partition in sorted(set(partitions) | set(start_offsets)):
+                commands.append(base + ["-t", topic_name, "-p", str(partition),
+                                        "-o", str(start_offsets.get(partition, "beginning")),
+                                        "-f", self.OUTPUT_FORMAT])
+        return commands
+    
+    def assignment_changed(self) -> bool:
+        """重新列出主题与分区，出现新的主题或分区时返回 True（列出失败时保持当前分配）"""
+        self.refreshed_at = time.monotonic()
+        topic_partitions = self.list_topic_partitions()
+        if topic_partitions is None:
+            return False
+        return any(not set(partitions) <= set(self.topic_partitions.get(topic_name, ()))
+                   for topic_name, partitions in topic_partitions.items())
+    
+    def batches(self, max_lines: int, max_wait_ms: int) -> Iterator[Dict[Optional[str], List[str]]]:
+        streams = [process.stdout for process in self.processes]
+        for batch in iter_line_batches(streams, max_lines, max_wait_ms):
+            yield route_multiplexed_lines(batch, self.subscription, self.topic_start_offsets,
+                                          self.topic_positions)
+            if (self.topic_partitions is not None
+                    and time.monotonic() - self.refreshed_at >= self.refresh_interval
+                    and self.assignment_changed()):
+                self.reassigned = True
+                self.stop()
+    
+    def close(self) -> int:
+        exit_code = super().close()
+        # 为按新分配重启而终止的进程不算异常退出
+        return 0 if self.reassigned else exit_code
+    
+    def describe(self) -> str:
+        if self.topic_partitions is None:
+            description = f"{self.name}:{self.topic_name} ({self.kafka_client}, 消费组订阅"
+            if self.topic_start_offsets:
+                description += ", 无法列出分区，从头消费并跳过检查点之前的记录"
+            return description + ")"
+        return (f"{self.name}:{self.topic_name} ({self.kafka_client}, {len(self.topic_partitions)} 个主题, "
+                f"{len(self.processes)} 个进程)")
+
+
+class MultiplexKafkaSource(KafkaClientSource):
+    """进程内Kafka客户端订阅主题白名单/正则，记录自带主题
+    
+    手动分配所有匹配主题的全部分区并按检查点定位；每隔 refresh_interval 秒
+    重新解析订阅，新出现的主题无需重启即可加入。
+    """
+    
+    multiplexed = True
+    
+    def __init__(self, subscription: TopicSubscription, bootstrap_servers: str, consumer_factory=None,
+                 start_offsets: Dict[str, Dict[int, int]] = None, refresh_interval: float = 60.0):
+        super().__init__(subscription.describe(), bootstrap_servers, consumer_factory)
+        self.subscription = subscription
+        self.topic_positions = {topic: dict(offsets) for topic, offsets in (start_offsets or {}).items()}
+        self.refresh_interval = refresh_interval
+        self.assigned: Set[TopicPartition] = set()
+        self.refreshed_at = 0.0
+    
+    def open(self):
+        factory = self.consumer_factory or self.default_consumer_factory
+        self.consumer = factory(
+            bootstrap_servers=self.bootstrap_servers,
+            auto_offset_reset='earliest',
+            enable_auto_commit=False,
+            group_id=None,
+        )
+        self.assign_topics()
+        if not self.assigned:
+            raise RuntimeError(f"订阅 {self.topic_name} 没有匹配的主题")
+    
+    def assign_topics(self) -> bool:
+        """按订阅分配全部分区，返回分配是否变化
+        
+        重新分配会丢弃客户端内的读取位置，所有分区按已产出的位点（或检查点）重新定位，
+        没有位点的分区从头消费。
+        """
+        self.refreshed_at = time.monotonic()
+        topics = sorted(topic for topic in self.consumer.topics() if self.subscription.matches(topic))
+        topic_partitions = [TopicPartition(topic, partition) for topic in topics
+                            for partition in sorted(self.consumer.partitions_for_topic(topic) or [])]
+        if set(topic_partitions) == self.assigned:
+            return False
+        
+        self.consumer.assign(topic_partitions)
+        for topic_partition in topic_partitions:
+            offset = self.topic_positions.get(topic_partition.topic, {}).get(topic_partition.partition)
+            if offset is None:
+                self.consumer.seek_to_beginning(topic_partition)
+            else:
+                self.consumer.seek(topic_partition, offset)
+        self.assigned = set(topic_partitions)
+        return True
+    
+    def batches(self, max_lines: int, max_wait_ms: int) -> Iterator[Dict[Optional[str], List[str]]]:
+        positions = self.topic_positions
+        while not self.stopped:
+            if time.monotonic() - self.refreshed_at >= self.refresh_interval:
+                self.assign_topics()
+            
+            records = self.consumer.poll(timeout_ms=max_wait_ms, max_records=max_lines)
+            if records is None:
+                self.restartable = False
+                break
+            
+            groups: Dict[Optional[str], List[str]] = {}
+            for topic_partition, partition_records in records.items():
+                topic_positions = positions.setdefault(topic_partition.topic, {})
+                lines = groups.setdefault(topic_partition.topic, [])
+                for record in partition_records:
+                    topic_positions[record.partition] = record.offset + 1
+                    line = record.value.decode('utf-8', errors='replace').strip()
+                    if line:
+                        lines.append(line)
+            if groups:
+                yield groups
+
+
+class MultiplexFileSource(FileReplaySource):
+    """回放多路复用录制文件（每行带 Topic/Partition/Offset 前缀，如 kcat -f 的输出）"""
+    
+    multiplexed = True
+    
+    def __init__(self, subscription: TopicSubscription, file_path: Path,
+                 start_offsets: Dict[str, Dict[int, int]] = None):
+        super().__init__(subscription.describe(), file_path)
+        self.subscription = subscription
+        self.topic_start_offsets = {topic: dict(offsets) for topic, offsets in (start_offsets or {}).items()}
+        self.topic_positions = {topic: dict(offsets) for topic, offsets in self.topic_start_offsets.items()}
+    
+    def batches(self, max_lines: int, max_wait_ms: int) -> Iterator[Dict[Optional[str], List[str]]]:
+        for batch in super().batches(max_lines, max_wait_ms):
+            yield route_multiplexed_lines(batch, self.subscription, self.topic_start_offsets,
+                                          self.topic_positions)
+
+
+class OffsetCheckpointStore:
+    """消费位点检查点：记录每个主题各分区下一条待消费的offset
+    
+    消费线程每处理完一批更新内存中的位点，定时以临时文件+rename的方式原子落盘，
+    重启后各分区从记录的offset续读，而不是从头回放整个主题。
+    """
+    
+    def __init__(self, file_path: Path):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.offsets: Dict[str, Dict[int, int]] = {}  # topic -> {partition: next_offset}
+        self.dirty = False
+    
+    def load(self) -> bool:
+        """从文件加载检查点，文件不存在或损坏时返回 False"""
+        if not self.file_path.exists():
+            return False
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            offsets = {
+                topic: {int(partition): int(offset) for partition, offset in partitions.items()}
+                for topic, partitions in data.get('offsets', {}).items()
+            }
+        except (OSError, ValueError, AttributeError):
+            return False
+        
+        with self.lock:
+            self.offsets = offsets
+            self.dirty = False
+        return True
+    
+    def copy(self) -> Dict[str, Dict[int, int]]:
+        """获取全部位点的副本"""
+        with self.lock:
+            return {topic: dict(partitions) for topic, partitions in self.offsets.items()}
+    
+    def get(self, topic: str) -> Dict[int, int]:
+        """获取主题各分区的续读位点"""
+        with self.lock:
+            return dict(self.offsets.get(topic, {}))
+    
+    def update(self, topic: str, positions: Dict[int, int]):
+        """记录主题最新处理到的位点"""
+        with self.lock:
+            self.offsets.setdefault(topic, {}).update(positions)
+            self.dirty = True
+    
+    def snapshot(self) -> Optional[Dict[str, Dict[int, int]]]:
+        """取出自上次落盘后变化过的位点副本，无变化时返回 None"""
+        with self.lock:
+            if not self.dirty:
+                return None
+            self.dirty = False
+            return {topic: dict(partitions) for topic, partitions in self.offsets.items()}
+    
+    def save(self, offsets: Dict[str, Dict[int, int]]):
+        """原子写入检查点文件（临时文件 + fsync + rename）"""
+        data = {
+            'saved_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'offsets': {
+                topic: {str(partition): offset for partition, offset in sorted(partitions.items())}
+                for topic, partitions in offsets.items()
+            }
+        }
+        tmp_file = self.file_path.with_name(self.file_path.name + '.tmp')
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.file_path)
+
+
+# 可选的消息来源类型
+SOURCE_TYPES = ('console', 'file', 'kafka')
+
+# 消费模式（--consumer-mode）
+CONSUMER_MODES = ('thread', 'async', 'process')
+
+
+class StateSnapshotStore:
+    """设备状态二进制快照：各应用的设备状态表、计数器与消费位点
+    
+    文件格式: 魔数(4字节) + CRC32(4字节) + zlib压缩的载荷；载荷内各字段均为
+    长度前缀编码。每个应用保存其设备编码表（按ID顺序以换行连接的devSn）、
+    按ID索引的 uint64 状态数组与在线位图，加载时一次读取、一次切分，无需逐设备解析。
+    写入采用临时文件 + fsync + rename，崩溃时要么是旧快照要么是新快照。
+    """
+    
+    MAGIC = b'DMS3'
+    
+    def __init__(self, file_path: Path, compress_level: int = 1):
+        self.file_path = file_path
+        self.compress_level = compress_level
+    
+    @staticmethod
+    def _pack_bytes(parts: List[bytes], data: bytes):
+        parts.append(struct.pack('<I', len(data)))
+        parts.append(data)
+    
+    @staticmethod
+    def _unpack_bytes(view: memoryview, pos: int) -> Tuple[bytes, int]:
+        (length,) = struct.unpack_from('<I', view, pos)
+        pos += 4
+        return bytes(view[pos:pos + length]), pos + length
+    
+    def save(self, state: Dict) -> int:
+        """写入快照，返回文件字节数
+        
+        state 结构: {'processed': int, 'business': int,
+                    'apps': {app_id: {'online': int, 'offline': int, 'table': DeviceStateTable}},
+                    'offsets': {topic: {partition: offset}}}
+        """
+        parts: List[bytes] = [struct.pack('<QQ', state['processed'], state['business'])]
+        
+        apps = state['apps']
+        parts.append(struct.pack('<I', len(apps)))
+        for app_id, app_state in apps.items():
+            table = app_state['table']
+            self._pack_bytes(parts, app_id.encode('utf-8'))
+            parts.append(struct.pack('<QQQQ', app_state['online'], app_state['offline'],
+                                     table.stale_count, table.known_count))
+            # 编码表只增不减，状态数组中的ID必然已登记在 names 中
+            self._pack_bytes(parts, table.states.tobytes())
+            self._pack_bytes(parts, bytes(table.online.bitmap.bits))
+            self._pack_bytes(parts, '\n'.join(table.registry.names).encode('utf-8'))
+        
+        offsets = state['offsets']
+        parts.append(struct.pack('<I', len(offsets)))
+        for topic, partitions in offsets.items():
+            self._pack_bytes(parts, topic.encode('utf-8'))
+            parts.append(struct.pack('<I', len(partitions)))
+            for partition, offset in partitions.items():
+                parts.append(struct.pack('<iQ', partition, offset))
+        
+        payload = zlib.compress(b''.join(parts), self.compress_level)
+        data = self.MAGIC + struct.pack('<I', zlib.crc32(payload)) + payload
+        
+        tmp_file = self.file_path.with_name(self.file_path.name + '.tmp')
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.file_path)
+        return len(data)
+    
+    def load(self) -> Optional[Dict]:
+        """一次读取并解析快照，文件不存在或校验失败时返回 None"""
+        try:
+            with open(self.file_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        
+        if len(data) < 8 or data[:4] != self.MAGIC:
+            return None
+        (crc,) = struct.unpack_from('<I', data, 4)
+        payload = data[8:]
+        if zlib.crc32(payload) != crc:
+            return None
+        
+        try:
+            view = memoryview(zlib.decompress(payload))
+            processed, business = struct.unpack_from('<QQ', view, 0)
+            pos = 16
+            
+            apps = {}
+            (app_count,) = struct.unpack_from('<I', view, pos)
+            pos += 4
+            for _ in range(app_count):
+                app_id, pos = self._unpack_bytes(view, pos)
+                online, offline, stale, known = struct.unpack_from('<QQQQ', view, pos)
+                pos += 32
+                states, pos = self._unpack_bytes(view, pos)
+                bits, pos = self._unpack_bytes(view, pos)
+                names, pos = self._unpack_bytes(view, pos)
+                
+                registry = DeviceIdRegistry.from_names(
+                    names.decode('utf-8').split('\n') if names else [])
+                table = DeviceStateTable(registry)
+                table.states.frombytes(states)
+                table.online = DeviceSet(registry, bitmap=DeviceBitmap(bytearray(bits)))
+                table.known_count = known
+                table.stale_count = stale
+                apps[app_id.decode('utf-8')] = {'online': online, 'offline': offline, 'table': table}
+            
+            offsets = {}
+            (topic_count,) = struct.unpack_from('<I', view, pos)
+            pos += 4
+            for _ in range(topic_count):
+                topic, pos = self._unpack_bytes(view, pos)
+                (partition_count,) = struct.unpack_from('<I', view, pos)
+                pos += 4
+                partitions = {}
+                for _ in range(partition_count):
+                    partition, offset = struct.unpack_from('<iQ', view, pos)
+                    pos += 12
+                    partitions[partition] = offset
+                offsets[topic.decode('utf-8')] = partitions
+        except (zlib.error, struct.error, UnicodeDecodeError):
+            return None
+        
+        return {'processed': processed, 'business': business, 'apps': apps, 'offsets': offsets}
+
+
+class BufferedOutputWriter:
+    """输出文件缓冲写入器（组提交）
+    
+    每个文件保持一个打开的句柄，追加内容先写入内存缓冲，
+    达到字节阈值、时间阈值或关闭时统一写盘；fsync策略可选:
+      none     - 从不fsync，交给操作系统回写
+      periodic - 写盘时至多每 fsync_interval 秒fsync一次
+      batch    - 每批消息处理结束都写盘并fsync
+    """
+    
+    FSYNC_POLICIES = ('none', 'periodic', 'batch')
+    
+    def __init__(self, flush_bytes: int = 64 * 1024, flush_interval: float = 1.0,
+                 fsync_policy: str = 'none', fsync_interval: float = 5.0):
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        
+        self.lock = threading.RLock()
+        self.handles = {}                      # Path -> 文件句柄
+        self.buffers: Dict[Path, List[str]] = {}
+        self.buffered_bytes = 0
+        self.last_flush = time.monotonic()
+        self.last_fsync = time.monotonic()
+        self.closed = False
+        
+        self._flusher = None
+        self._flusher_stop = threading.Event()
+        
+        # 写盘耗时（持锁写入）
+        self.write_histogram = LatencyHistogram()
+    
+    def start_flusher(self):
+        """启动后台定时刷盘线程（保证流量停止时缓冲也能按时间阈值落盘）"""
+        if self._flusher is not None:
+            return
+        self._flusher_stop.clear()
+        self._flusher = threading.Thread(target=self._flush_loop, name="output-flusher")
+        self._flusher.daemon = True
+        self._flusher.start()
+    
+    def _flush_loop(self):
+        while not self._flusher_stop.wait(self.flush_interval):
+            self.maybe_flush()
+    
+    def _get_handle(self, path: Path):
+        handle = self.handles.get(path)
+        if handle is None:
+            handle = open(path, 'a', encoding='utf-8')
+            self.handles[path] = handle
+        return handle
+    
+    def rewrite(self, path: Path, text: str):
+        """原子重写文件（临时文件 + rename），丢弃该文件尚未落盘的缓冲"""
+        with self.lock:
+            handle = self.handles.pop(path, None)
+            if handle is not None:
+                handle.close()
+            for line in self.buffers.pop(path, []):
+                self.buffered_bytes -= len(line)
+            
+            start = time.perf_counter()
+            tmp_path = path.with_name(path.name + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+                if self.fsync_policy != 'none':
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            self.write_histogram.observe(time.perf_counter() - start)
+    
+    def append(self, path: Path, text: str):
+        """追加内容到文件缓冲，达到字节阈值时写盘"""
+        with self.lock:
+            if self.closed:
+                # 关闭后仍有写入（如停止过程中的最后一批）则直接落盘，不丢数据
+                with open(path, 'a', encoding='utf-8') as f:
+                    f.write(text)
+                return
+            
+            self.buffers.setdefault(path, []).append(text)
+            self.buffered_bytes += len(text)
+            if self.buffered_bytes >= self.flush_bytes:
+                self.flush()
+    
+    def end_batch(self):
+        """一批消息处理结束：batch策略下立即写盘并fsync，否则按阈值判断"""
+        if self.fsync_policy == 'batch':
+            self.flush(fsync=True)
+        else:
+            self.maybe_flush()
+    
+    def maybe_flush(self):
+        """缓冲超过时间阈值则写盘"""
+        with self.lock:
+            if self.buffers and time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush()
+    
+    def flush(self, fsync: bool = None):
+        """将全部缓冲写入文件；fsync为None时按策略决定是否fsync"""
+        with self.lock:
+            start = time.perf_counter()
+            wrote = bool(self.buffers)
+            for path, chunks in self.buffers.items():
+                if chunks:
+                    self._get_handle(path).write(''.join(chunks))
+            self.buffers.clear()
+            self.buffered_bytes = 0
+            
+            now = time.monotonic()
+            self.last_flush = now
+            
+            if fsync is None:
+                fsync = (self.fsync_policy == 'periodic'
+                         and now - self.last_fsync >= self.fsync_interval)
+            
+            for handle in self.handles.values():
+                handle.flush()
+                if fsync:
+                    os.fsync(handle.fileno())
+            if fsync:
+                self.last_fsync = now
+            if wrote or fsync:
+                self.write_histogram.observe(time.perf_counter() - start)
+    
+    def close(self):
+        """写出全部缓冲、fsync并关闭句柄（可重复调用）"""
+        self._flusher_stop.set()
+        if self._flusher is not None and self._flusher is not threading.current_thread():
+            self._flusher.join(timeout=5)
+        self._flusher = None
+        
+        with self.lock:
+            if self.closed:
+                return
+            self.flush(fsync=self.fsync_policy != 'none')
+            for handle in self.handles.values():
+                handle.close()
+            self.handles.clear()
+            self.closed = True
+
+
+class BatchPipeline:
+    """读取线程与处理线程之间的有界批次队列
+    
+    读取线程 put(批次, 位点)，处理线程 get() 后处理并调用 done(位点) 提交（on_commit），
+    检查点只覆盖已处理完的批次。每个队列只有一个处理线程：同一主题的设备状态表只有一个写入者，
+    事件按读取顺序应用。
+    队列满时的背压策略: block - 读取线程阻塞，背压传导到管道与消费进程；
+    spill - 批次溢出到磁盘临时文件，处理线程按先进先出顺序读回，读取线程不阻塞。
+    处理失败时 fail() 丢弃排队的批次且不提交失败批次的位点，读取线程在 check() 中得知后
+    关闭来源，reset() 后从已提交的位点重新读取。
+    """
+    
+    POLICIES = ('block', 'spill')
+    
+    def __init__(self, name: str, maxsize: int = 64, policy: str = 'block',
+                 spill_dir: Path = None, on_commit=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"未知的背压策略: {policy}")
+        self.name = name
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.on_commit = on_commit
+        self.cond = threading.Condition()
+        self.items: collections.deque = collections.deque()
+        self.closed = False
+        # 处理失败的异常（reset 前不再接受新批次）
+        self.error: Optional[Exception] = None
+        
+        # 溢出文件：写入与读回位置分开记录，溢出清空后截断
+        self.spill_file = None
+        self.spill_count = 0
+        self.spill_read = 0
+        self.spill_write = 0
+        
+        # 统计（put_count - done_count 为排队与处理中的批次数）
+        self.high_water = 0
+        self.put_count = 0
+        self.done_count = 0
+        self.spilled_total = 0
+        self.blocked_seconds = 0.0
+    
+    def depth(self) -> int:
+        """排队中的批次数（内存 + 溢出文件）"""
+        return len(self.items) + self.spill_count
+    
+    def put(self, batch, positions=None):
+        """加入一批消息及其读取后的位点；block 策略下队列满时阻塞，关闭后丢弃"""
+        with self.cond:
+            if self.closed or self.error is not None:
+                return
+            item = (batch, positions)
+            self.put_count += 1
+            
+            if self.spill_count or len(self.items) >= self.maxsize:
+                if self.policy == 'spill':
+                    # 已有溢出时也写入溢出文件，保持先进先出
+                    self._spill(item)
+                else:
+                    start = time.monotonic()
+                    while len(self.items) >= self.maxsize and not self.closed and self.error is None:
+                        self.cond.wait()
+                    self.blocked_seconds += time.monotonic() - start
+                    if self.closed or self.error is not None:
+                        return
+                    self.items.append(item)
+            else:
+                self.items.append(item)
+            
+            self.high_water = max(self.high_water, self.depth())
+            self.cond.notify_all()
+    
+    def get(self, timeout: float = None):
+        """取出下一批 (批次, 位点)；超时或已关闭且为空时返回 None"""
+        with self.cond:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self.items and not self.spill_count:
+                if self.closed:
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+            
+            if not self.items:
+                self._unspill()
+            item = self.items.popleft()
+            # 溢出的批次排在内存批次之后，内存有空位时读回
+            if self.spill_count and len(self.items) < self.maxsize // 2:
+                self._unspill()
+            self.cond.notify_all()
+            return item
+    
+    def done(self, positions=None):
+        """标记批次处理完成并提交其位点"""
+        if positions and self.on_commit is not None:
+            self.on_commit(positions)
+        with self.cond:
+            self.done_count += 1
+            self.cond.notify_all()
+    
+    def wait_drained(self, timeout: float = None) -> bool:
+        """等待已加入的批次全部处理完成（来源重启前调用，确保检查点已是最新）"""
+        with self.cond:
+            return self.cond.wait_for(
+                lambda: self.closed or self.error is not None or self.done_count == self.put_count,
+                timeout)
+    
+    def fail(self, error: Exception):
+        """处理线程标记批次处理失败：不提交该批次的位点，丢弃排队的批次并拒绝新批次直到 reset()"""
+        with self.cond:
+            self.error = error
+            self._discard()
+            self.done_count = self.put_count
+            self.cond.notify_all()
+    
+    def check(self):
+        """读取线程调用：处理线程已失败时抛出其异常"""
+        error = self.error
+        if error is not None:
+            raise RuntimeError(f"批次处理失败，从已提交的位点重新读取: {error}") from error
+    
+    def reset(self):
+        """来源重新打开前清除失败状态"""
+        with self.cond:
+            self.error = None
+    
+    def close(self):
+        """关闭队列：唤醒等待的线程，丢弃未处理的批次（其位点未提交，续读时重新消费）"""
+        with self.cond:
+            self.closed = True
+            self._discard()
+            self.cond.notify_all()
+    
+    def _discard(self):
+        self.items.clear()
+        self.spill_count = 0
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+        self.spill_read = self.spill_write = 0
+    
+    def _spill(self, item):
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(prefix="device_monitor_spill_",
+                                                     dir=self.spill_dir)
+        self.spill_file.seek(self.spill_write)
+        pickle.dump(item, self.spill_file, pickle.HIGHEST_PROTOCOL)
+        self.spill_write = self.spill_file.tell()
+        self.spill_count += 1
+        self.spilled_total += 1
+    
+    def _unspill(self):
+        """从溢出文件读回批次，直到内存队列满或溢出清空"""
+        self.spill_file.seek(self.spill_read)
+        while self.spill_count and len(self.items) < self.maxsize:
+            self.items.append(pickle.load(self.spill_file))
+            self.spill_count -= 1
+        self.spill_read = self.spill_file.tell()
+        if not self.spill_count:
+            self.spill_file.seek(0)
+            self.spill_file.truncate()
+            self.spill_read = self.spill_write = 0
+    
+    def stats(self) -> Dict:
+        with self.cond:
+            return {
+                'depth': self.depth(),
+                'capacity': self.maxsize,
+                'high_water': self.high_water,
+                'policy': self.policy,
+                'batches': self.put_count,
+                'spilled': self.spilled_total,
+                'spill_bytes': self.spill_write - self.spill_read,
+                'blocked_seconds': self.blocked_seconds,
+            }
+
+
+class DeviceStateTable:
+    """单个应用的设备状态表：devSn -> 最近状态与changeTime
+    
+    devSn 经应用级 DeviceIdRegistry 编码为稠密ID，状态按ID存放在 uint64 数组中，
+    值为 (changeTime << 2) | 已知位 | 在线位（0 表示未知设备）；当前在线设备用位图
+    表示。每个设备每个应用只占 8 字节 + 1 位，上线、离线与计数均为 O(1)。
+    changeTime 早于已记录值的事件视为乱序事件被拒绝。在线状态发生变化（含新设备首次上报）时
+    通知 analytics（SessionAnalytics 或 TransitionLog）、history（EventRecorder）与
+    distinct（HourlyDistinctCounter），为 None 时跳过。
+    """
+    
+    __slots__ = ('registry', 'states', 'online', 'known_count', 'stale_count', 'removed', 'dirty',
+                 'analytics', 'history', 'distinct')
+    
+    KNOWN = 2
+    ONLINE = 1
+    
+    def __init__(self, registry: DeviceIdRegistry = None):
+        self.registry = registry if registry is not None else DeviceIdRegistry()
+        self.states = array.array('Q')
+        self.online = DeviceSet(self.registry)
+        self.known_count = 0
+        self.stale_count = 0
+        # 自上次整理输出文件后是否有设备离线
+        self.removed = False
+        # 不为 None 时记录状态被更新过的设备ID（多进程模式下用于生成增量）
+        self.dirty: Optional[Set[int]] = None
+        self.analytics = None
+        self.history = None
+        self.distinct = None
+    
+    def apply(self, dev_sn: str, online: bool, change_time: Optional[int]) -> Optional[int]:
+        """应用一次状态事件
+        
+        返回 1 表示变为在线，-1 表示变为离线，0 表示状态未变，
+        None 表示事件早于已记录的changeTime被拒绝；缺少changeTime时按到达顺序生效。
+        """
+        device_id = self.registry.intern(dev_sn)
+        event_time = change_time or 0
+        states = self.states
+        if device_id >= len(states):
+            # 按倍数扩容，摊还为 O(1)
+            states.frombytes(bytes(8 * max(device_id + 1 - len(states), len(states))))
+        
+        previous = states[device_id]
+        if previous:
+            if change_time is None:
+                change_time = previous >> 2
+            elif change_time < previous >> 2:
+                self.stale_count += 1
+                return None
+        else:
+            self.known_count += 1
+            if change_time is None:
+                change_time = 0
+        
+        states[device_id] = (change_time << 2) | self.KNOWN | online
+        if self.dirty is not None:
+            self.dirty.add(device_id)
+        was_online = previous & self.ONLINE
+        if online and not was_online:
+            self.online.bitmap.add(device_id)
+            self.notify(device_id, True, event_time, previous != 0)
+            return 1
+        if not online and was_online:
+            self.online.bitmap.discard(device_id)
+            self.removed = True
+            self.notify(device_id, False, event_time, True)
+            return -1
+        if not previous:
+            # 新设备首次上报即为离线
+            self.notify(device_id, False, event_time, False)
+        return 0
+    
+    def notify(self, device_id: int, online: bool, change_time: int, known: bool):
+        """把状态变化交给分析、历史记录与去重计数钩子"""
+        if self.analytics is not None:
+            self.analytics.record(device_id, online, change_time, known)
+        if self.history is not None:
+            self.history.record(device_id, online, change_time, known)
+        if self.distinct is not None:
+            self.distinct.record(device_id, online, change_time, known)
+    
+    def load_state(self, device_id: int, state: int) -> int:
+        """直接写入设备的压缩状态值（应用工作进程发来的增量），返回在线状态变化 1/-1/0"""
+        states = self.states
+        if device_id >= len(states):
+            states.frombytes(bytes(8 * max(device_id + 1 - len(states), len(states))))
+        previous = states[device_id]
+        states[device_id] = state
+        if not previous:
+            self.known_count += 1
+        online = state & self.ONLINE
+        was_online = previous & self.ONLINE
+        if online and not was_online:
+            self.online.bitmap.add(device_id)
+            return 1
+        if not online and was_online:
+            self.online.bitmap.discard(device_id)
+            self.removed = True
+            return -1
+        return 0
+    
+    def seed_online(self, devices: Iterable[str]):
+        """以未知changeTime导入一批在线设备（从旧输出文件恢复时使用）"""
+        for dev_sn in devices:
+            self.apply(dev_sn, True, None)
+    
+    def copy(self) -> 'DeviceStateTable':
+        """复制状态（共用编码表）"""
+        table = DeviceStateTable(self.registry)
+        table.states = array.array('Q', self.states)
+        table.online = self.online.copy()
+        table.known_count = self.known_count
+        table.stale_count = self.stale_count
+        return table
+    
+    def merge(self, other: 'DeviceStateTable'):
+        """合并另一个使用同一编码表的状态表，同一设备保留changeTime较新的状态"""
+        states = self.states
+        if len(states) < len(other.states):
+            states.frombytes(bytes(8 * (len(other.states) - len(states))))
+        for device_id, state in enumerate(other.states):
+            current = states[device_id]
+            if state and (not current or state >> 2 >= current >> 2):
+                states[device_id] = state
+        
+        self.online = DeviceSet(self.registry)
+        self.known_count = 0
+        for device_id, state in enumerate(states):
+            if state:
+                self.known_count += 1
+                if state & self.ONLINE:
+                    self.online.bitmap.add(device_id)
+        self.stale_count += other.stale_count
+    
+    def get(self, dev_sn: str) -> Optional[Tuple[bool, int]]:
+        """查询设备状态，返回 (是否在线, changeTime)，未知设备返回 None"""
+        device_id = self.registry.lookup(dev_sn)
+        if device_id is None or device_id >= len(self.states) or not self.states[device_id]:
+            return None
+        state = self.states[device_id]
+        return bool(state & self.ONLINE), state >> 2
+
+
+class LatencyHistogram:
+    """固定分桶的耗时直方图（秒）
+    
+    每个实例只由一个线程写入（分片内或持锁写入），导出时按桶相加合并，热路径无锁。
+    """
+    
+    BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+               0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+    
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+    
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # 最后一个桶为 +Inf
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+    
+    def merge(self, other: 'LatencyHistogram'):
+        for i, value in enumerate(other.counts):
+            self.counts[i] += value
+        self.sum += other.sum
+        self.count += other.count
+    
+    def to_dict(self) -> Dict:
+        """导出为累计桶计数（与Prometheus的le语义一致）"""
+        cumulative = list(itertools.accumulate(self.counts))
+        return {
+            'buckets': {str(bound): count for bound, count in zip(self.buckets, cumulative)},
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class SessionAnalytics:
+    """单个应用的会话与抖动分析，按 changeTime 流式计算
+    
+    由状态表在设备在线状态变化时调用，每次 O(1)，不保存事件历史：
+    上线时记录会话开始时间，离线时把在线时长计入固定分桶直方图；上线/离线切换次数按
+    changeTime 所在的固定时间窗口计数，只保留最近 window_count 个窗口；每个设备在定长
+    环形缓冲区中保留最近 ring_size 次切换时间，缓冲区写满且最早一次距本次不超过
+    flap_window 秒时判定为抖动设备。时间按秒存为 uint32，每个设备占 4 * (ring_size + 2) 字节。
+    缺少 changeTime 的切换只计入累计切换次数。
+    """
+    
+    # 会话时长分桶（秒）: 1分钟 ~ 7天
+    SESSION_BUCKETS = (60, 300, 900, 1800, 3600, 3 * 3600, 6 * 3600, 12 * 3600,
+                       86400, 3 * 86400, 7 * 86400)
+    
+    __slots__ = ('ring_size', 'flap_window', 'window_seconds', 'window_count', 'online_since',
+                 'ring', 'transitions', 'sessions', 'windows', 'flapping', 'transition_total', 'latest')
+    
+    def __init__(self, ring_size: int = 6, flap_window: float = 900.0,
+                 window_seconds: float = 300.0, window_count: int = 12):
+        self.ring_size = max(2, ring_size)
+        self.flap_window = int(flap_window)
+        self.window_seconds = max(1, int(window_seconds))
+        self.window_count = max(1, window_count)
+        self.online_since = array.array('I')    # 设备ID -> 本次上线时间（秒），0 表示不在线或未知
+        self.ring = array.array('I')            # 设备ID * ring_size + 序号 -> 切换时间（秒）
+        self.transitions = array.array('I')     # 设备ID -> 累计切换次数
+        self.sessions = LatencyHistogram(self.SESSION_BUCKETS)
+        self.windows: Dict[int, List[int]] = {}           # 窗口序号 -> [上线切换数, 离线切换数]
+        self.flapping: Dict[int, Tuple[int, int]] = {}    # 设备ID -> (最近判定时间, 最近 ring_size 次切换的跨度秒)
+        self.transition_total = 0
+        self.latest = 0                         # 已见的最大切换时间（秒）
+    
+    def record(self, device_id: int, online: bool, change_time: int, known: bool = True):
+        """记录一次在线状态变化；known 为 False 表示新设备首次上线（只开始会话，不算切换）"""
+        transitions = self.transitions
+        if device_id >= len(transitions):
+            grow = max(device_id + 1 - len(transitions), len(transitions))
+            transitions.frombytes(bytes(4 * grow))
+            self.online_since.frombytes(bytes(4 * grow))
+            self.ring.frombytes(bytes(4 * grow * self.ring_size))
+        
+        now = change_time // 1000
+        if online:
+            self.online_since[device_id] = now
+        else:
+            since = self.online_since[device_id]
+            self.online_since[device_id] = 0
+            if since and now >= since:
+                self.sessions.observe(now - since)
+        
+        if not known:
+            return
+        count = transitions[device_id]
+        transitions[device_id] = count + 1
+        self.transition_total += 1
+        if not now:
+            return
+        
+        window = now // self.window_seconds
+        counts = self.windows.get(window)
+        if counts is None:
+            counts = self.windows[window] = [0, 0]
+            if len(self.windows) > self.window_count:
+                del self.windows[min(self.windows)]
+            self.prune_flapping(now)
+        counts[0 if online else 1] += 1
+        if now > self.latest:
+            self.latest = now
+        
+        # 写入环形缓冲区；写满后下一个待覆盖位置即最早的一次切换
+        size = self.ring_size
+        base = device_id * size
+        ring = self.ring
+        ring[base + count % size] = now
+        if count + 1 >= size:
+            span = now - ring[base + (count + 1) % size]
+            if span <= self.flap_window:
+                self.flapping[device_id] = (now, span)
+    
+    def prune_flapping(self, now: int):
+        """移除最近 flap_window 秒内没有再次判定为抖动的设备（每进入一个新窗口执行一次）"""
+        cutoff = now - self.flap_window
+        for device_id in [device_id for device_id, (flap_time, _) in self.flapping.items()
+                          if flap_time < cutoff]:
+            del self.flapping[device_id]
+    
+    def copy(self) -> 'SessionAnalytics':
+        analytics = SessionAnalytics(self.ring_size, self.flap_window, self.window_seconds, self.window_count)
+        analytics.merge(self)
+        return analytics
+    
+    def merge(self, other: 'SessionAnalytics'):
+        """合并同一应用（共用编码表）在另一分片中的分析结果，用于只读汇总"""
+        transitions = self.transitions
+        if len(transitions) < len(other.transitions):
+            transitions.frombytes(bytes(4 * (len(other.transitions) - len(transitions))))
+        for device_id, count in enumerate(other.transitions):
+            if count:
+                transitions[device_id] += count
+        self.sessions.merge(other.sessions)
+        for window, (online, offline) in list(other.windows.items()):
+            counts = self.windows.setdefault(window, [0, 0])
+            counts[0] += online
+            counts[1] += offline
+        for window in sorted(self.windows)[:-self.window_count]:
+            del self.windows[window]
+        for device_id, flap in list(other.flapping.items()):
+            if flap[0] >= self.flapping.get(device_id, (0, 0))[0]:
+                self.flapping[device_id] = flap
+        self.transition_total += other.transition_total
+        self.latest = max(self.latest, other.latest)
+    
+    def summary(self, names: List[str], top_k: int = 10) -> Dict:
+        """导出切换次数、会话时长直方图、各窗口切换数与切换次数最多的 top_k 个抖动设备"""
+        cutoff = self.latest - self.flap_window
+        flapping = [(device_id, flap_time, span) for device_id, (flap_time, span)
+                    in list(self.flapping.items()) if flap_time >= cutoff]
+        transitions = self.transitions
+        top = heapq.nlargest(top_k, flapping, key=lambda item: (transitions[item[0]], item[1]))
+        return {
+            'transitions': self.transition_total,
+            'sessions': self.sessions.to_dict(),
+            'window_seconds': self.window_seconds,
+            'windows': [{'start': window * self.window_seconds, 'online': online, 'offline': offline}
+                        for window, (online, offline) in sorted(list(self.windows.items()))],
+            'flapping': len(flapping),
+            'top_flapping': [{'devSn': names[device_id], 'transitions': transitions[device_id],
+                              'last_flap': flap_time, 'span': span}
+                             for device_id, flap_time, span in top],
+        }
+
+
+class TransitionLog:
+    """暂存状态切换事件，接口与 SessionAnalytics.record 相同
+    
+    多进程模式的工作进程使用：切换事件随每批增量发给协调进程，由协调进程的 SessionAnalytics 重放。
+    """
+    
+    __slots__ = ('ids', 'times', 'flags')
+    
+    def __init__(self):
+        self.ids = array.array('Q')
+        self.times = array.array('Q')
+        self.flags = bytearray()        # 在线位 | 已知设备位 << 1
+    
+    def record(self, device_id: int, online: bool, change_time: int, known: bool = True):
+        self.ids.append(device_id)
+        self.times.append(change_time)
+        self.flags.append(online | known << 1)
+    
+    def take(self) -> Tuple[bytes, bytes, bytes]:
+        """取出并清空已记录的事件"""
+        data = (self.ids.tobytes(), self.times.tobytes(), bytes(self.flags))
+        self.ids = array.array('Q')
+        self.times = array.array('Q')
+        self.flags = bytearray()
+        return data
+
+
+class HourlyDistinctCounter:
+    """单个应用每小时的去重在线设备数，按 changeTime 流式统计
+    
+    某小时内任意时刻在线过的设备都计入该小时：上线时计入 changeTime 所在的小时，进入新的小时
+    时把仍在线的设备计入新小时（中间跳过的小时同样计入），只保留最近 hour_count 个小时。
+    精确模式每小时一个位图（每设备1位），并保留当前在线位图，内存随设备数增长。
+    近似模式每小时一个 HyperLogLog（2^precision 字节，可跨分片、应用与实例合并），当前在线设备
+    记在可删除的 CountingHyperLogLog 中，进入新小时只复制其寄存器，不重新哈希在线设备；另用容量
+    固定的 Bloom 过滤器记录出现过的设备。近似模式的计数内存只取决于精度、保留小时数与 Bloom 容量，
+    与设备数无关（所属的设备状态表仍随设备数增长）。缺少 changeTime 的事件只更新当前在线设备。
+    """
+    
+    HOUR_MS = 3600 * 1000
+    
+    __slots__ = ('registry', 'approximate', 'precision', 'hour_count', 'online', 'hours', 'current', 'bloom')
+    
+    def __init__(self, registry: DeviceIdRegistry, approximate: bool = False, precision: int = 14,
+                 hour_count: int = 48, bloom: BloomFilter = None):
+        self.registry = registry
+        self.approximate = approximate
+        self.precision = precision
+        self.hour_count = max(1, hour_count)
+        # 当前在线设备: DeviceBitmap（精确）或 CountingHyperLogLog（近似）
+        self.online = CountingHyperLogLog(precision) if approximate else DeviceBitmap()
+        self.hours: Dict[int, object] = {}     # 小时序号 -> DeviceBitmap（精确）或 HyperLogLog（近似）
+        self.current: Optional[int] = None     # 已见的最大小时序号
+        self.bloom = bloom
+    
+    def seed(self, table: DeviceStateTable, online: DeviceBitmap = None):
+        """并入状态表中已有的设备（续读时恢复的状态表）
+        
+        当前在线设备按 online（默认为该表的在线设备，合并到已有状态表时为合并后的在线设备）重建，
+        只在启动时执行一次；表中已知的设备加入 Bloom 过滤器。
+        """
+        online = table.online.bitmap if online is None else online
+        if self.approximate:
+            self.online = CountingHyperLogLog(self.precision)
+            names = self.registry.names
+            for device_id in online:
+                self.online.add_hash(hash64(names[device_id]))
+        else:
+            self.online = online.copy()
+        if self.bloom is not None:
+            names = table.registry.names
+            for device_id, state in enumerate(table.states):
+                if state:
+                    self.bloom.add_hash(hash64(names[device_id]))
+    
+    def new_hour(self):
+        """以当前在线设备初始化一个小时的计数（近似模式只复制 2^precision 个寄存器）"""
+        if not self.approximate:
+            return self.online.copy()
+        return self.online.sketch()
+    
+    def advance(self, hour: int):
+        """进入新的小时：新小时与跳过的小时都以当前在线设备开始，移出保留范围外的小时"""
+        start = hour - self.hour_count + 1
+        first = hour if self.current is None else max(self.current + 1, start)
+        seed = self.new_hour()
+        for index in range(first, hour):
+            self.hours[index] = seed.copy()
+        self.hours[hour] = seed
+        self.current = hour
+        for index in [index for index in self.hours if index < start]:
+            del self.hours[index]
+    
+    def record(self, device_id: int, online: bool, change_time: int, known: bool = True):
+        """记录一次在线状态变化；known 为 False 表示新设备首次上报
+        
+        状态表只在状态翻转时调用：下线且 known 为 True 时设备此前在线，近似模式据此从在线计数中删除。
+        """
+        value = hash64(self.registry.names[device_id]) if self.approximate else None
+        if not known and self.bloom is not None:
+            self.bloom.add_hash(value)
+        if change_time:
+            hour = change_time // self.HOUR_MS
+            if self.current is None or hour > self.current:
+                self.advance(hour)
+            # 早于保留范围的上线事件不再计入
+            counter = self.hours.get(hour) if online else None
+            if counter is not None and self.approximate:
+                counter.add_hash(value)
+            elif counter is not None:
+                counter.add(device_id)
+        if self.approximate:
+            if online:
+                self.online.add_hash(value)
+            elif known:
+                self.online.remove_hash(value)
+        elif online:
+            self.online.add(device_id)
+        else:
+            self.online.discard(device_id)
+    
+    def copy(self) -> 'HourlyDistinctCounter':
+        bloom = self.bloom.copy() if self.bloom is not None else None
+        counter = HourlyDistinctCounter(self.registry, self.approximate, self.precision, self.hour_count, bloom)
+        counter.online = self.online.copy()
+        counter.hours = {hour: value.copy() for hour, value in list(self.hours.items())}
+        counter.current = self.current
+        return counter
+    
+    def merge(self, other: 'HourlyDistinctCounter'):
+        """合并同一应用（共用编码表）在另一分片中的计数，用于只读汇总"""
+        for hour, value in list(other.hours.items()):
+            current = self.hours.get(hour)
+            if current is None:
+                self.hours[hour] = value.copy()
+            elif self.approximate:
+                current.merge(value)
+            else:
+                self.hours[hour] = current.union(value)
+        if self.approximate:
+            self.online.merge(other.online)
+        else:
+            self.online = self.online.union(other.online)
+        if other.current is not None and (self.current is None or other.current > self.current):
+            self.current = other.current
+        for hour in sorted(self.hours)[:-self.hour_count]:
+            del self.hours[hour]
+        if self.bloom is not None and other.bloom is not None:
+            self.bloom.merge(other.bloom)
+    
+    def count(self, value) -> int:
+        return round(value.count()) if self.approximate else len(value)
+    
+    def seen(self, dev_sn: str) -> Optional[bool]:
+        """设备是否在该应用中出现过：近似模式查 Bloom 过滤器（可能误判为出现过），精确模式查编码表"""
+        if not self.approximate:
+            return self.registry.lookup(dev_sn) is not None
+        return dev_sn in self.bloom if self.bloom is not None else None
+    
+    def sketches(self) -> Dict:
+        """导出近似模式的草图（sketches.save_sketches 的单个应用格式，小时键为起始秒）"""
+        hours = {hour * 3600: sketch for hour, sketch in list(self.hours.items())}
+        return {'hours': hours, 'bloom': self.bloom}
+    
+    def summary(self) -> Dict:
+        """导出各小时去重在线设备数、保留的全部小时合并后的去重数与占用内存"""
+        hours = sorted(list(self.hours.items()))
+        total = None
+        for _, value in hours:
+            if total is None:
+                total = value.copy()
+            elif self.approximate:
+                total.merge(value)
+            else:
+                total = total.union(value)
+        memory = sum(value.memory_bytes() for _, value in hours) + self.online.memory_bytes()
+        bloom = None
+        if self.bloom is not None:
+            memory += self.bloom.memory_bytes()
+            bloom = {
+                'bytes': self.bloom.memory_bytes(),
+                'devices': round(self.bloom.approximate_count()),
+                'false_positive_rate': self.bloom.false_positive_rate(),
+            }
+        return {
+            'mode': 'approximate' if self.approximate else 'exact',
+            'standard_error': HyperLogLog.standard_error(self.precision) if self.approximate else 0.0,
+            'hours': [{'start': hour * 3600, 'devices': self.count(value)} for hour, value in hours],
+            'total': self.count(total) if total is not None else 0,
+            'memory_bytes': memory,
+            'bloom': bloom,
+        }
+
+
+class StatsShard:
+    """统计分片：每个消费者线程独占一个分片，热路径更新无需加锁
+    
+    分片内每个应用一张设备状态表；同一应用由多个主题消费时，读取时合并各分片。
+    lock 是批次边界锁：所属线程处理一批消息并提交其位点时持有（无竞争），
+    快照等需要状态与位点一致的操作持有全部分片的锁，期间没有处理到一半的批次。
+    """
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.RLock()
+        self.device_tables: Dict[str, DeviceStateTable] = {}
+        self.online_devices: Dict[str, DeviceSet] = {}  # app_id -> 当前在线设备集合（即状态表的online）
+        self.online_count: Dict[str, int] = {}
+        self.offline_count: Dict[str, int] = {}
+        self.processed_count = 0
+        self.business_msg_count = 0
+        self.system_msg_count = 0
+        self.invalid_msg_count = 0
+        self.topic_messages: Dict[str, int] = {}      # 主题 -> 本分片处理的消息数
+        self.parse_histogram = LatencyHistogram()     # 抽样的单条消息解析耗时
+    
+    def add_app(self, app_id: str, table: DeviceStateTable):
+        """初始化应用在本分片中的统计数据（接管给定的状态表）"""
+        self.device_tables[app_id] = table
+        self.online_devices[app_id] = table.online
+        self.online_count.setdefault(app_id, 0)
+        self.offline_count.setdefault(app_id, 0)
+    
+    @contextlib.contextmanager
+    def rollback_on_error(self):
+        """处理失败的批次回滚本分片的消息计数器，使重新读取的批次只计数一次
+        
+        设备状态不回滚：重放的事件 changeTime 不早于已记录值，状态不变，也不会再通知
+        分析、历史记录与去重计数钩子，钩子对失败批次已应用的部分只记录一次；
+        但被同批更晚事件覆盖过的事件重放时按乱序拒绝，乱序事件数（stale）按至少一次计。
+        失败批次已更新状态但未追加到输出文件的设备，由下次整理按在线集合重写输出文件补上。
+        """
+        counters = (self.processed_count, self.business_msg_count, self.system_msg_count,
+                    self.invalid_msg_count)
+        counts = [(counter, dict(counter)) for counter in (self.topic_messages, self.online_count,
+                                                           self.offline_count)]
+        stale = {app_id: table.stale_count for app_id, table in self.device_tables.items()}
+        try:
+            yield
+        except Exception:
+            (self.processed_count, self.business_msg_count, self.system_msg_count,
+             self.invalid_msg_count) = counters
+            # 原地恢复：失败批次中新登记的应用保留计数项（归零）
+            for counter, before in counts:
+                for key in counter:
+                    counter[key] = before.get(key, 0)
+            for app_id, table in self.device_tables.items():
+                table.stale_count = stale.get(app_id, 0)
+                table.removed = True
+            raise
+
+
+class ControlServer:
+    """守护进程本地控制套接字（Unix域套接字）
+    
+    协议：客户端每个连接发送一行JSON请求 {"cmd": 命令, ...参数}，服务端返回一行JSON应答。
+    请求交给 handler(request) -> dict 处理，只读取内存状态，不访问输出文件。
+    """
+    
+    def __init__(self, socket_path: Path, handler, client_timeout: float = 5.0):
+        self.socket_path = socket_path
+        self.handler = handler
+        self.client_timeout = client_timeout
+        self.server = None
+        self.stop_event = threading.Event()
+        self.thread = None
+    
+    def start(self):
+        """绑定套接字并启动接受连接的线程（清理上次异常退出残留的套接字文件）
+        
+        绑定时临时收紧 umask，套接字文件创建即为 0600（守护进程的 umask 为 0，
+        绑定后再 chmod 会留下其他用户可连接的窗口）。
+        """
+        self.socket_path.unlink(missing_ok=True)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            self.server.bind(str(self.socket_path))
+        finally:
+            os.umask(old_umask)
+        self.server.listen(16)
+        self.server.settimeout(0.5)
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.serve, name="control-server", daemon=True)
+        self.thread.start()
+    
+    def serve(self):
+        while not self.stop_event.is_set():
+            try:
+                conn, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            threading.Thread(target=self.handle_client, args=(conn,), daemon=True).start()
+    
+    def handle_client(self, conn: socket.socket):
+        with conn:
+            conn.settimeout(self.client_timeout)
+            try:
+                request = json.loads(read_socket_line(conn) or b'{}')
+                if not isinstance(request, dict):
+                    raise ValueError("请求须为JSON对象")
+                response = self.handler(request)
+            except Exception as e:
+                # 任何请求错误（含处理器中的 KeyError/TypeError）都只影响本连接，返回错误应答
+                response = {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+            try:
+                conn.sendall(json.dumps(response, ensure_ascii=False).encode('utf-8') + b'\n')
+            except OSError:
+                pass
+    
+    def stop(self):
+        self.stop_event.set()
+        if self.server is not None:
+            self.server.close()
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+        self.socket_path.unlink(missing_ok=True)
+
+
+def read_socket_line(conn: socket.socket, limit: int = 1 << 26) -> bytes:
+    """从套接字读取一行（不含换行符），对端关闭时返回已读内容"""
+    chunks = []
+    size = 0
+    while True:
+        chunk = conn.recv(1 << 16)
+        if not chunk:
+            break
+        end = chunk.find(b'\n')
+        if end != -1:
+            chunks.append(chunk[:end])
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > limit:
+            raise ValueError("控制消息过长")
+    return b''.join(chunks)
+
+
+def query_control(socket_path: Path, request: Dict, timeout: float = 5.0) -> Optional[Dict]:
+    """向运行中的守护进程发送控制请求，套接字不可用时返回 None"""
+    if not socket_path.exists():
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(timeout)
+            conn.connect(str(socket_path))
+            conn.sendall(json.dumps(request, ensure_ascii=False).encode('utf-8') + b'\n')
+            return json.loads(read_socket_line(conn))
+    except (OSError, ValueError):
+        return None
+
+
+def tail_lines(file_path: Path, count: int, block_size: int = 8192) -> List[str]:
+    """从文件末尾向前读取最后 count 行，不读取整个文件"""
+    with open(file_path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        data = b''
+        while end > 0 and data.count(b'\n') <= count:
+            start = max(0, end - block_size)
+            f.seek(start)
+            data = f.read(end - start) + data
+            end = start
+    lines = data.decode('utf-8', errors='replace').splitlines()
+    return lines[-count:]
+
+
+class EventLogLimiter:
+    """逐事件日志限流：每个类别每个时间窗口最多记录 limit 条
+    
+    超出的事件只计数，由调用方定期取出并输出"已省略 N 条"汇总；
+    先判断是否允许再格式化日志，被省略的事件不产生格式化开销。
+    """
+    
+    def __init__(self, limit: int = 20, window: float = 1.0):
+        self.limit = limit                     # 0 表示不限流
+        self.window = window
+        self.lock = threading.Lock()
+        self.windows: Dict[str, List] = {}     # 类别 -> [窗口开始时间, 已记录条数]
+        self.suppressed: Dict[str, int] = {}
+    
+    def allow(self, category: str, count: int = 1) -> int:
+        """申请记录 count 条事件日志，返回允许记录的条数，其余计入省略"""
+        if self.limit <= 0:
+            return count
+        now = time.monotonic()
+        with self.lock:
+            state = self.windows.get(category)
+            if state is None or now - state[0] >= self.window:
+                state = [now, 0]
+                self.windows[category] = state
+            allowed = max(0, min(count, self.limit - state[1]))
+            state[1] += allowed
+            if allowed < count:
+                self.suppressed[category] = self.suppressed.get(category, 0) + count - allowed
+            return allowed
+    
+    def take_suppressed(self) -> Dict[str, int]:
+        """取出并清零各类别的省略条数"""
+        with self.lock:
+            suppressed = self.suppressed
+            self.suppressed = {}
+        return suppressed
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """有界队列日志处理器：队列满时丢弃并计数，不阻塞消费线程"""
+    
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
 
 class DeviceMonitor:
     """设备在线监控器"""
     
-    def __init__(self):
+    # 每 64 条业务消息抽样一次解析耗时
+    PARSE_SAMPLE_MASK = 63
+    
+    def __init__(self, parser_backend: str = "auto"):
         # 配置文件路径
         self.script_dir = Path(__file__).parent.absolute()
         self.pid_file = self.script_dir / "device_monitor.pid"
         self.log_file = self.script_dir / "device_monitor.log"
+        
+        # 日志：队列 + 后台写线程，按大小或时间轮转；逐事件日志按类别限流
+        self.log_max_bytes = 50 * 1024 * 1024
+        self.log_backup_count = 5
+        self.log_rotate_when = None            # 如 'midnight'/'H'，设置后按时间轮转
+        self.log_queue_size = 100000
+        self.log_summary_interval = 30.0
+        self.log_handler = None
+        self.log_listener = None
+        self.event_log = EventLogLimiter()
         self.output_dir = self.script_dir / "device_online_output"
         
         # Kafka配置
@@ -40,52 +2322,344 @@ class DeviceMonitor:
             ("s17_dcs_dev_online_10002", "10002")
         ]
         
-        # 统计数据
-        self.online_devices: Dict[str, Set[str]] = {}  # app_id -> set of device_sn
-        self.online_count: Dict[str, int] = {}
-        self.offline_count: Dict[str, int] = {}
-        self.processed_count = 0
-        self.business_msg_count = 0
+        # 多路复用: 单个消费者订阅主题白名单（topics 中的主题）或正则 topic_pattern，
+        # 按每条记录携带的主题路由到应用ID；console 来源此时使用 kcat（可输出主题名）
+        self.multiplex = False
+        self.topic_pattern = None
+        self.multiplex_client = "kcat"
+        self.topic_refresh_interval = 60.0     # kafka/kcat来源重新解析订阅的间隔秒数
+        self.topic_apps: Dict[str, Optional[str]] = {}  # 主题 -> 应用ID（路由缓存）
+        
+        # 消息解析后端: auto / regex / json / fastjson
+        self.parser_backend = parser_backend
+        self.parser = create_message_parser(parser_backend)
+        
+        # 批量消费配置：每批最多行数、首行最长等待毫秒（batch_size <= 1 时逐条处理）
+        self.batch_size = 1000
+        self.batch_timeout_ms = 200
+        
+        # 输出文件缓冲写入器（刷盘阈值与fsync策略可通过命令行调整）
+        self.output_writer = BufferedOutputWriter()
+        
+        # 统计数据：按消费者线程分片，读取时合并
+        self.shards: List[StatsShard] = []
+        self.shard_local = threading.local()
+        self.app_ids: List[str] = []           # 已知应用ID（按出现顺序）
+        self.app_lock = threading.Lock()       # 仅用于分片注册和新应用注册
+        self.registries: Dict[str, DeviceIdRegistry] = {}  # 应用ID -> devSn编码表（各分片共用）
         
         # 控制标志
         self.running = False
-        self.kafka_processes = []
+        self.message_sources: List[MessageSource] = []
+        # 停止请求: 信号处理器只置位 running/stop_signal，由主线程调用 request_stop 中断来源并
+        # 唤醒重启等待（stop_event）；收尾 stop_monitoring 在全部消费者结束后执行，只执行一次
+        self.stop_event = threading.Event()
+        self.stop_signal = None
+        self.stop_lock = threading.Lock()
+        self.stopped = False
+        
+        # 消息来源: console - kafka-console-consumer.sh子进程, file - 回放录制文件,
+        # kafka - 进程内Kafka客户端(kafka-python)
+        self.source_type = "console"
+        self.replay_path = None        # file来源的文件路径，可包含 {topic} 占位符
+        self.kafka_consumer_factory = None
+        
+        # 消费位点检查点：定时落盘，resume=True 时启动后从检查点续读
+        self.checkpoint_file = self.script_dir / "device_monitor.offsets.json"
+        self.checkpoint_interval = 5.0
+        self.resume = False
+        self.checkpoints = OffsetCheckpointStore(self.checkpoint_file)
+        self.background_stop = threading.Event()
+        self.background_threads: List[threading.Thread] = []
+        self.consumer_threads: List[threading.Thread] = []
+        self.resume_tables: Dict[str, DeviceStateTable] = {}  # 续读时恢复的设备状态表（快照或输出文件）
+        
+        # 输出文件整理间隔：有设备离线时按当前在线集合重写输出文件
+        self.compact_interval = 30.0
+        
+        # 已排序的设备索引（online_devices_{app_id}.idx）重建间隔，供 show 分页/前缀查询与 lookup 二分查找；
+        # 在线集合或计数有变化的应用才重建，0 表示仅退出时生成
+        self.index_interval = 60.0
+        self.index_signatures: Dict[str, Tuple] = {}
+        
+        # 状态快照：定时保存设备集合/计数器/位点，resume=True 时启动后直接加载
+        self.snapshot_file = self.script_dir / "device_monitor.snapshot"
+        self.snapshot_interval = 60.0          # 0 表示关闭定时快照
+        self.snapshots = StateSnapshotStore(self.snapshot_file)
+        self.snapshot_lock = threading.Lock()
+        
+        # 本地控制套接字：status/show/lookup 在守护进程运行时直接查询内存状态
+        self.control_socket = self.script_dir / "device_monitor.sock"
+        self.control_server = None
+        self.start_time = None
+        
+        # 指标导出：定时原子重写 Prometheus 文本文件与 JSON 文件
+        self.metrics_file = self.script_dir / "device_monitor.prom"
+        self.metrics_json_file = self.script_dir / "device_monitor.metrics.json"
+        self.metrics_interval = 15.0           # 0 表示关闭
+        self.metrics_previous = None           # 上次导出时的 (时间, 主题消息数)，用于计算速率
+        self.source_starts: Dict[str, int] = {}  # 主题 -> 来源启动次数
+        
+        # 读取/处理解耦（thread 消费模式与多路复用）: 每个消费者的读取线程把批次放入有界队列，
+        # 由该消费者的处理线程取出处理；队列满时按 pipeline_policy 阻塞或溢出到磁盘。
+        # pipeline_queue_size 为 0 时在读取线程中直接处理
+        self.pipeline_queue_size = 64
+        self.pipeline_policy = "block"
+        self.pipeline_spill_dir = None         # 溢出文件目录（默认系统临时目录）
+        self.pipelines: Dict[str, BatchPipeline] = {}
+        
+        # 消费模式: thread - 各主题为本进程内的线程; async - 各主题为同一事件循环中的协程; process - 各主题为独立的工作进程，
+        # 本进程作为协调进程接收增量并负责输出文件与合并统计
+        self.consumer_mode = "thread"
+        self.worker_queue_size = 256
+        self.worker_stop = None
+        self.worker_mirrors: Dict[str, Dict] = {}  # 主题 -> 工作进程状态镜像（分片、ID映射等）
+        self.worker_times: Dict[str, Dict[str, float]] = {}  # 主题 -> 工作进程退出时报告的运行/CPU秒数与写出字节数
+        self.worker_apply_seconds = 0.0        # 协调进程应用工作进程增量的累计耗时
+        # async - 所有主题在同一个 asyncio 事件循环中以协程消费；解析、聚合与写输出文件
+        # 在单个处理线程中执行（async_executor），事件循环只负责读取与调度
+        self.async_loop = None
+        self.async_stop = None
+        self.async_executor = None
+        
+        # 会话与抖动分析（按 changeTime）: 每个设备保留最近 flap_ring_size 次状态切换时间，
+        # flap_window 秒内切换 flap_ring_size 次判定为抖动；切换次数按 transition_window 秒的
+        # 窗口统计，保留最近 transition_window_count 个窗口。flap_ring_size 为 0 时关闭分析
+        self.flap_ring_size = 6
+        self.flap_window = 900.0
+        self.transition_window = 300.0
+        self.transition_window_count = 12
+        self.analytics_top_k = 10
+        
+        # 事件历史: 设置 history_dir 后把每次状态变化追加写入按UTC日期分区的分段文件
+        # （随消费位点检查点一起落盘），可用 event_store.py 按时间点/时间段查询
+        self.history_dir = None
+        self.event_store = None
+        
+        # 每小时去重在线设备数: exact - 每小时一个位图; approximate - 每小时一个 HyperLogLog
+        # （2^hll_precision 字节）并用 Bloom 过滤器记录出现过的设备，草图随指标导出到 sketch_file，
+        # 可用 sketches.py 跨实例合并。None 表示关闭
+        self.distinct_mode = None
+        self.hll_precision = 14
+        self.distinct_hours = 48
+        self.bloom_capacity = 1000000
+        self.bloom_error = 0.01
+        self.sketch_file = self.script_dir / "device_monitor.sketches"
         
         # 初始化统计数据
         self.init_stats()
     
     def setup_logging(self):
-        """设置日志配置"""
+        """设置日志配置
+        
+        消费线程只把日志记录放入有界队列，由后台线程写文件；日志文件按大小
+        （log_max_bytes）或按时间（log_rotate_when）轮转，保留 log_backup_count 个旧文件。
+        """
         # 清除现有的handlers
+        self.stop_logging()
         for handler in logging.root.handlers[:]:
             logging.root.removeHandler(handler)
         
-        logging.basicConfig(
-            level=logging.INFO,
-            format='[%(asctime)s] %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S',
-            handlers=[
-                logging.FileHandler(self.log_file, encoding='utf-8')
-            ]
-        )
+        if self.log_rotate_when:
+            file_handler = logging.handlers.TimedRotatingFileHandler(
+                self.log_file, when=self.log_rotate_when,
+                backupCount=self.log_backup_count, encoding='utf-8')
+        else:
+            file_handler = logging.handlers.RotatingFileHandler(
+                self.log_file, maxBytes=self.log_max_bytes,
+                backupCount=self.log_backup_count, encoding='utf-8')
+        file_handler.setFormatter(logging.Formatter('[%(asctime)s] %(message)s',
+                                                    datefmt='%Y-%m-%d %H:%M:%S'))
+        
+        self.log_handler = DroppingQueueHandler(queue.Queue(self.log_queue_size))
+        # 入队时只合并消息参数，时间戳等格式由写线程的文件处理器负责
+        self.log_handler.setFormatter(logging.Formatter('%(message)s'))
+        self.log_listener = logging.handlers.QueueListener(self.log_handler.queue, file_handler)
+        self.log_listener.start()
+        
+        logging.basicConfig(level=logging.INFO, handlers=[self.log_handler])
         self.logger = logging.getLogger(__name__)
     
+    def stop_logging(self):
+        """停止后台日志线程，写出队列中剩余的日志"""
+        if self.log_listener is None:
+            return
+        logging.root.removeHandler(self.log_handler)
+        self.log_listener.stop()
+        for handler in self.log_listener.handlers:
+            handler.close()
+        self.log_listener = None
+    
+    def log_suppressed_summary(self):
+        """输出被限流省略与队列满丢弃的日志条数汇总"""
+        suppressed = self.event_log.take_suppressed()
+        dropped = 0
+        if self.log_handler is not None:
+            dropped, self.log_handler.dropped = self.log_handler.dropped, 0
+        if not suppressed and not dropped:
+            return
+        parts = [f"{category} {count} 条" for category, count in suppressed.items()]
+        if dropped:
+            parts.append(f"日志队列已满丢弃 {dropped} 条")
+        self.logger.info(f"已省略日志: {', '.join(parts)}")
+    
     def init_stats(self):
         """初始化统计数据"""
         for topic_name, app_id in self.topics:
-            self.online_devices[app_id] = set()
-            self.online_count[app_id] = 0
-            self.offline_count[app_id] = 0
+            if app_id not in self.app_ids:
+                self.app_ids.append(app_id)
+    
+    def get_shard(self) -> StatsShard:
+        """获取当前线程的统计分片，首次访问时创建并注册"""
+        shard = getattr(self.shard_local, 'shard', None)
+        if shard is None:
+            shard = StatsShard(threading.current_thread().name)
+            with self.app_lock:
+                self.shards.append(shard)
+            self.shard_local.shard = shard
+        return shard
+    
+    @contextlib.contextmanager
+    def batch_boundary(self):
+        """持有全部分片的批次边界锁：期间状态表、计数器与已提交的位点对应同一批次边界"""
+        with contextlib.ExitStack() as stack:
+            locked = 0
+            while True:
+                with self.app_lock:
+                    shards = list(self.shards)
+                if len(shards) == locked:
+                    break
+                # 加锁期间有新分片注册时补上（分片只增不减）
+                for shard in shards[locked:]:
+                    stack.enter_context(shard.lock)
+                locked = len(shards)
+            yield
+    
+    def get_registry(self, app_id: str) -> DeviceIdRegistry:
+        """获取应用的devSn编码表，各分片共用以便合并状态表与位图"""
+        registry = self.registries.get(app_id)
+        if registry is None:
+            with self.app_lock:
+                registry = self.registries.setdefault(app_id, DeviceIdRegistry())
+        return registry
+    
+    def register_app(self, app_id: str):
+        """登记新出现的应用ID，全局首次出现时创建其输出文件
+        
+        输出文件在持有 app_lock 时、应用对其他分片可见之前创建：其他分片登记同一应用时
+        在锁上等待，不会有追加先于创建（rewrite）写入缓冲而被丢弃。
+        """
+        with self.app_lock:
+            if app_id in self.app_ids:
+                return
+            self.create_app_output_file(app_id)
+            self.app_ids.append(app_id)
+    
+    def _merge_counts(self, attr: str) -> Dict[str, int]:
+        """合并各分片中的按应用计数"""
+        merged = {app_id: 0 for app_id in self.app_ids}
+        for shard in list(self.shards):
+            for app_id, count in list(getattr(shard, attr).items()):
+                merged[app_id] = merged.get(app_id, 0) + count
+        return merged
+    
+    @property
+    def online_count(self) -> Dict[str, int]:
+        """合并视图：应用ID -> 在线消息数"""
+        return self._merge_counts('online_count')
+    
+    @property
+    def offline_count(self) -> Dict[str, int]:
+        """合并视图：应用ID -> 离线消息数"""
+        return self._merge_counts('offline_count')
+    
+    @property
+    def processed_count(self) -> int:
+        """合并视图：已处理消息总数"""
+        return sum(shard.processed_count for shard in list(self.shards))
+    
+    @property
+    def business_msg_count(self) -> int:
+        """合并视图：业务消息总数"""
+        return sum(shard.business_msg_count for shard in list(self.shards))
+    
+    def device_table(self, app_id: str) -> DeviceStateTable:
+        """合并视图：应用的设备状态表
+        
+        应用只出现在一个分片时直接返回该分片的状态表（不复制），跨分片时返回合并后的副本。
+        """
+        tables = [shard.device_tables[app_id] for shard in list(self.shards)
+                  if app_id in shard.device_tables]
+        if len(tables) == 1:
+            return tables[0]
+        if not tables:
+            return DeviceStateTable(self.get_registry(app_id))
+        merged = tables[0].copy()
+        for table in tables[1:]:
+            merged.merge(table)
+        return merged
+    
+    @property
+    def online_devices(self) -> Dict[str, DeviceSet]:
+        """合并视图：应用ID -> 当前在线设备集合
+        
+        应用只出现在一个分片时直接返回该分片的集合（不复制），
+        跨分片时返回并集；调用方不应修改返回的集合。
+        """
+        merged = {}
+        shards = list(self.shards)
+        for app_id in list(self.app_ids):
+            sets = [shard.online_devices[app_id] for shard in shards
+                    if app_id in shard.online_devices]
+            if not sets:
+                merged[app_id] = DeviceSet(self.get_registry(app_id))
+            elif len(sets) == 1:
+                merged[app_id] = sets[0]
+            else:
+                merged[app_id] = sets[0].union(*sets[1:])
+        return merged
+    
+    def snapshot_stats(self) -> Dict[str, Dict[str, int]]:
+        """合并各分片的统计快照：应用ID -> {online, offline, devices, known, stale}
+        
+        online/offline 为消息数，devices 为当前在线设备数，known 为已知设备数，
+        stale 为被拒绝的乱序事件数。
+        """
+        online_count = self.online_count
+        offline_count = self.offline_count
+        stats = {}
+        for app_id in online_count:
+            table = self.device_table(app_id)
+            stats[app_id] = {
+                'online': online_count.get(app_id, 0),
+                'offline': offline_count.get(app_id, 0),
+                'devices': len(table.online),
+                'known': table.known_count,
+                'stale': table.stale_count,
+            }
+        return stats
     
     def create_output_files(self):
-        """创建输出文件"""
+        """创建输出文件
+        
+        从快照恢复的应用按快照内容重写输出文件；续读但没有快照时保留已有文件
+        并恢复其中的设备，避免重复追加。
+        """
         self.output_dir.mkdir(exist_ok=True)
         
+        for app_id, table in self.resume_tables.items():
+            self.create_app_output_file(app_id, table.online)
+        
         for topic_name, app_id in self.topics:
             output_file = self.output_dir / f"online_devices_{app_id}.txt"
-            with open(output_file, 'w', encoding='utf-8') as f:
-                f.write(f"# 应用 {app_id} 在线设备列表 (devSn) - 自动生成于 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-                f.write("# 格式: devSn\n")
+            if app_id in self.resume_tables:
+                continue
+            if self.resume and output_file.exists():
+                table = DeviceStateTable(self.get_registry(app_id))
+                table.seed_online(read_device_list(output_file))
+                self.resume_tables[app_id] = table
+            else:
+                self.create_app_output_file(app_id)
     
     def is_running(self) -> bool:
         """检查监控器是否正在运行"""
@@ -152,31 +2726,38 @@ class DeviceMonitor:
             os.dup2(f.fileno(), sys.stderr.fileno())
     
     def signal_handler(self, signum, frame):
-        """信号处理器"""
-        if hasattr(self, 'logger'):
-            self.logger.info(f"收到退出信号 {signum}，正在停止...")
-        self.stop_monitoring()
+        """信号处理器：只置位停止标志并唤醒事件循环
+        
+        中断消息来源、等待消费者结束与收尾都由主线程完成（wait_for_consumers、stop_monitoring）；
+        处理器中不写日志、不获取锁，避免与被信号打断的主线程争用同一把锁。
+        """
+        self.stop_signal = signum
+        self.running = False
+        self.request_async_stop()
     
-    def extract_fields(self, message: str) -> Dict[str, str]:
-        """从JSON消息中提取字段"""
-        fields = {}
+    def request_stop(self):
+        """请求停止（可重复调用）：置位停止标志，中断各消息来源，通知工作进程与事件循环；不做收尾"""
+        if not self.stop_event.is_set():
+            self.stop_event.set()
+            if self.stop_signal is not None and hasattr(self, 'logger'):
+                self.logger.info(f"收到退出信号 {self.stop_signal}，正在停止...")
+        self.running = False
         
-        # 使用正则表达式提取字段
-        patterns = {
-            'devSn': r'"devSn":\s*"([^"]*)"',
-            'onlineStatus': r'"onlineStatus":\s*"([^"]*)"',
-            'changeTime': r'"changeTime":\s*([0-9]+)',
-            'devId': r'"devId":\s*"([^"]*)"',
-            'plateNum': r'"plateNum":\s*"([^"]*)"',
-            'appId': r'"appId":\s*"([^"]*)"'
-        }
+        # 中断所有消息来源（终止Kafka进程/关闭客户端）
+        for source in list(self.message_sources):
+            try:
+                source.stop()
+            except Exception:
+                pass
         
-        for field, pattern in patterns.items():
-            match = re.search(pattern, message)
-            if match:
-                fields[field] = match.group(1)
+        if self.worker_stop is not None:
+            self.worker_stop.value = 1
         
-        return fields
+        self.request_async_stop()
+    
+    def extract_fields(self, message: str) -> Dict[str, str]:
+        """从JSON消息中提取字段"""
+        return self.parser.extract_fields(message)
     
     def determine_app_id(self, fields: Dict[str, str]) -> str:
         """确定应用ID"""
@@ -199,206 +2780,1439 @@ class DeviceMonitor:
     
     def is_system_message(self, message: str) -> bool:
         """判断是否为系统消息"""
-        system_patterns = [
-            r'^Processed a total of',
-            r'^WARNING',
-            r'^INFO',
-            r'^ERROR',
-            r'^\['
-        ]
+        return self.parser.is_system_message(message)
+    
+    def process_message(self, message: str, topic_app_id: str = None):
+        """处理单条消息（逐行消费路径，--batch-size 1）
         
-        for pattern in system_patterns:
-            if re.match(pattern, message):
-                return True
+        按只含一条消息的批处理：系统消息/无效消息的跳过与日志、计数器、设备状态、
+        新增在线设备的追加与日志都与原逐条解析代码相同，原先单独维护的一份逐条
+        解析逻辑因此合并到 aggregate_batch，避免两条路径的统计口径分叉。
+        """
+        self.process_batch([message], topic_app_id)
+    
+    def log_progress(self):
+        """记录业务消息处理进度
         
-        # 检查是否包含JSON格式
-        return not ('{' in message and '}' in message)
+        在消费热路径上调用：当前在线数取自各分片在线位图的并集（整体按位或），
+        不像 snapshot_stats 那样复制合并状态表，已知/乱序数只在快照、控制请求与指标中合并。
+        """
+        online_count = self.online_count
+        offline_count = self.offline_count
+        online_devices = self.online_devices
+        stats = []
+        for app_id in online_count:
+            devices = online_devices.get(app_id)
+            stats.append(f"应用{app_id} - 在线:{online_count[app_id]} "
+                       f"离线:{offline_count.get(app_id, 0)} "
+                       f"当前在线:{len(devices) if devices is not None else 0}")
+        
+        self.logger.info(f"已处理 {self.business_msg_count} 条业务消息, {', '.join(stats)}")
     
-    def process_message(self, message: str, topic_app_id: str = None):
-        """处理单条消息"""
-        self.processed_count += 1
+    def process_batch(self, messages: List[str], topic_app_id: str = None):
+        """批量处理消息
+        
+        计数器按条更新，保持与逐条处理一致；设备状态按changeTime逐条更新，
+        变为在线的设备在批内按devSn去重，批末一次性追加到输出文件。
+        统计数据写入当前线程的分片，热路径不加锁。
+        """
+        shard = self.get_shard()
+        start_business_count = shard.business_msg_count
+        new_devices, offline_devices = self.aggregate_batch(shard, messages, topic_app_id)
+        self.write_batch_changes(new_devices, offline_devices)
+        
+        # 每100条业务消息记录一次日志
+        if shard.business_msg_count // 100 > start_business_count // 100:
+            self.log_progress()
+    
+    def write_batch_changes(self, new_devices: Dict[str, Dict[str, str]],
+                            offline_devices: Dict[str, List[Tuple[str, str]]]):
+        """批末统一追加输出文件并记录设备变化日志（离线设备由定期整理从文件中移除）"""
+        event_log = self.event_log
+        for app_id, devices in offline_devices.items():
+            allowed = event_log.allow("设备离线", len(devices))
+            for dev_sn, plate_num in itertools.islice(devices, allowed):
+                self.logger.info(f"应用{app_id}设备离线: {dev_sn} (车牌: {plate_num})")
+        
+        for app_id, devices in new_devices.items():
+            if not devices:
+                continue
+            self.append_devices_to_output_file(app_id, list(devices))
+            allowed = event_log.allow("新增在线设备", len(devices))
+            for dev_sn, plate_num in itertools.islice(devices.items(), allowed):
+                self.logger.info(f"应用{app_id}新增在线设备: {dev_sn} (车牌: {plate_num})")
+        
+        # 组提交：按策略写盘/fsync
+        self.output_writer.end_batch()
+    
+    def new_state_table(self, app_id: str) -> DeviceStateTable:
+        """为新出现的应用创建设备状态表"""
+        table = DeviceStateTable(self.get_registry(app_id))
+        self.attach_table_hooks(app_id, table)
+        return table
+    
+    def attach_table_hooks(self, app_id: str, table: DeviceStateTable):
+        """为状态表挂上会话分析、事件历史记录与去重计数钩子"""
+        table.analytics = self.new_analytics()
+        if self.event_store is not None:
+            table.history = self.event_store.recorder(app_id, table.registry)
+        table.distinct = self.new_distinct_counter(table)
+        if table.distinct is not None:
+            table.distinct.seed(table)
+    
+    def open_event_store(self):
+        """按 history_dir 打开事件历史存储（未设置时不记录历史）"""
+        if self.history_dir:
+            self.event_store = EventStore(Path(self.history_dir))
+            self.logger.info(f"事件历史目录: {self.history_dir}")
+    
+    def new_analytics(self) -> Optional[SessionAnalytics]:
+        """按配置创建应用的会话与抖动分析（关闭时返回 None）"""
+        if self.flap_ring_size <= 0:
+            return None
+        return SessionAnalytics(self.flap_ring_size, self.flap_window,
+                                self.transition_window, self.transition_window_count)
+    
+    def new_distinct_counter(self, table: DeviceStateTable) -> Optional[HourlyDistinctCounter]:
+        """按 distinct_mode 创建应用的每小时去重计数（关闭时返回 None）"""
+        if not self.distinct_mode:
+            return None
+        approximate = self.distinct_mode == 'approximate'
+        bloom = None
+        if approximate and self.bloom_capacity > 0:
+            bloom = BloomFilter.for_capacity(self.bloom_capacity, self.bloom_error)
+        return HourlyDistinctCounter(table.registry, approximate, self.hll_precision, self.distinct_hours, bloom)
+    
+    def distinct_counter(self, app_id: str) -> Optional[HourlyDistinctCounter]:
+        """合并视图：应用的每小时去重计数（跨分片时返回合并后的副本）"""
+        counters = [shard.device_tables[app_id].distinct for shard in list(self.shards)
+                    if app_id in shard.device_tables and shard.device_tables[app_id].distinct is not None]
+        if len(counters) <= 1:
+            return counters[0] if counters else None
+        merged = counters[0].copy()
+        for other in counters[1:]:
+            merged.merge(other)
+        return merged
+    
+    def distinct_summary(self) -> Dict[str, Dict]:
+        """各应用的每小时去重在线设备数：应用ID -> HourlyDistinctCounter.summary()"""
+        summaries = {}
+        for app_id in list(self.app_ids):
+            counter = self.distinct_counter(app_id)
+            if counter is not None:
+                summaries[app_id] = counter.summary()
+        return summaries
+    
+    def save_distinct_sketches(self):
+        """近似模式下导出各应用的小时草图与 Bloom 过滤器，供 sketches.py 跨实例合并"""
+        if self.distinct_mode != 'approximate':
+            return
+        apps = {}
+        for app_id in list(self.app_ids):
+            counter = self.distinct_counter(app_id)
+            if counter is not None:
+                apps[app_id] = counter.sketches()
+        save_sketches(self.sketch_file, apps)
+    
+    def session_analytics(self, app_id: str) -> Optional[SessionAnalytics]:
+        """合并视图：应用的会话与抖动分析（跨分片时返回合并后的副本）"""
+        analytics = [shard.device_tables[app_id].analytics for shard in list(self.shards)
+                     if app_id in shard.device_tables and shard.device_tables[app_id].analytics is not None]
+        if len(analytics) <= 1:
+            return analytics[0] if analytics else None
+        merged = analytics[0].copy()
+        for other in analytics[1:]:
+            merged.merge(other)
+        return merged
+    
+    def analytics_summary(self, top_k: int = None) -> Dict[str, Dict]:
+        """各应用的会话与抖动分析汇总：应用ID -> SessionAnalytics.summary()"""
+        top_k = self.analytics_top_k if top_k is None else top_k
+        summaries = {}
+        for app_id in list(self.app_ids):
+            analytics = self.session_analytics(app_id)
+            if analytics is not None:
+                summaries[app_id] = analytics.summary(self.get_registry(app_id).names, top_k)
+        return summaries
+    
+    def aggregate_batch(self, shard: StatsShard, messages: List[str], topic_app_id: str = None
+                        ) -> Tuple[Dict[str, Dict[str, str]], Dict[str, List[Tuple[str, str]]]]:
+        """解析一批消息并更新分片的计数与设备状态表（不写输出文件）
+        
+        返回 (本批变为在线的设备 app_id -> {devSn: 车牌号}，
+              本批变为离线的设备 app_id -> [(devSn, 车牌号)])。
+        """
+        is_system_message = self.parser.is_system_message
+        extract_fields = self.parser.extract_fields
+        perf_counter = time.perf_counter
+        device_tables = shard.device_tables
+        online_count = shard.online_count
+        offline_count = shard.offline_count
+        
+        # app_id -> {devSn: 车牌号}，本批变为在线的设备，保持首次出现顺序
+        new_devices: Dict[str, Dict[str, str]] = {}
+        offline_devices: Dict[str, List[Tuple[str, str]]] = {}
+        
+        for message in messages:
+            shard.processed_count += 1
+            
+            # 跳过系统消息
+            if is_system_message(message):
+                shard.system_msg_count += 1
+                if shard.processed_count <= 20:
+                    self.logger.info(f"跳过系统消息{shard.processed_count}: {message[:100]}")
+                continue
+            
+            shard.business_msg_count += 1
+            
+            # 提取字段（抽样记录解析耗时）
+            if shard.business_msg_count & self.PARSE_SAMPLE_MASK:
+                fields = extract_fields(message)
+            else:
+                parse_start = perf_counter()
+                fields = extract_fields(message)
+                shard.parse_histogram.observe(perf_counter() - parse_start)
+            dev_sn = fields.get('devSn', '')
+            online_status = fields.get('onlineStatus', '')
+            plate_num = fields.get('plateNum', '')
+            
+            if not dev_sn or not online_status:
+                shard.invalid_msg_count += 1
+                if shard.business_msg_count <= 20:
+                    self.logger.info(f"跳过无效业务消息{shard.business_msg_count}: {message[:100]}")
+                continue
+            
+            # 确定应用ID - 优先使用主题对应的应用ID
+            if topic_app_id:
+                app_id = topic_app_id
+            else:
+                app_id = self.determine_app_id(fields)
+            
+            # 调试信息（仅前10条业务消息）
+            if shard.business_msg_count <= 10:
+                self.logger.info(f"调试 - 业务消息{shard.business_msg_count}: "
+                               f"devSn={dev_sn}, status={online_status}, app_id={app_id}")
+            
+            # 确保应用ID的统计数据已初始化
+            table = device_tables.get(app_id)
+            if table is None:
+                shard.add_app(app_id, self.new_state_table(app_id))
+                self.register_app(app_id)
+                table = device_tables[app_id]
+            
+            change_time = fields.get('changeTime')
+            if change_time is not None:
+                change_time = int(change_time)
+            
+            # 处理在线状态：按changeTime更新设备状态表，乱序事件被拒绝
+            if online_status == "ONLINE":
+                online_count[app_id] += 1
+                
+                # 变为在线的设备批内去重，批末统一追加到输出文件
+                if table.apply(dev_sn, True, change_time) == 1:
+                    app_new_devices = new_devices.setdefault(app_id, {})
+                    if dev_sn not in app_new_devices:
+                        app_new_devices[dev_sn] = plate_num
+            
+            elif online_status == "OFFLINE":
+                offline_count[app_id] += 1
+                result = table.apply(dev_sn, False, change_time)
+                if result == -1:
+                    app_new_devices = new_devices.get(app_id)
+                    if app_new_devices:
+                        app_new_devices.pop(dev_sn, None)
+                    offline_devices.setdefault(app_id, []).append((dev_sn, plate_num))
+        
+        return new_devices, offline_devices
+    
+    def create_app_output_file(self, app_id: str, devices: Set[str] = None):
+        """创建应用专用输出文件（可同时写入已知的设备列表）"""
+        output_file = self.output_dir / f"online_devices_{app_id}.txt"
+        self.output_writer.rewrite(
+            output_file,
+            f"# 应用 {app_id} 在线设备列表 (devSn) - 自动生成于 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+            "# 格式: devSn\n"
+            + ''.join(f"{dev_sn}\n" for dev_sn in devices or ())
+        )
+    
+    def append_to_output_file(self, app_id: str, dev_sn: str):
+        """追加设备到输出文件"""
+        output_file = self.output_dir / f"online_devices_{app_id}.txt"
+        self.output_writer.append(output_file, f"{dev_sn}\n")
+    
+    def append_devices_to_output_file(self, app_id: str, dev_sns: List[str]):
+        """批量追加设备到输出文件"""
+        if not dev_sns:
+            return
+        output_file = self.output_dir / f"online_devices_{app_id}.txt"
+        self.output_writer.append(output_file, "\n".join(dev_sns) + "\n")
+    
+    def write_final_stats(self):
+        """写入最终统计信息"""
+        # 先按当前在线集合整理输出文件，统计信息追加在设备列表之后
+        self.compact_output_files()
+        
+        for app_id, app_stats in self.snapshot_stats().items():
+            output_file = self.output_dir / f"online_devices_{app_id}.txt"
+            
+            self.logger.info(f"应用{app_id} - 在线: {app_stats['online']} 条，"
+                           f"离线: {app_stats['offline']} 条，"
+                           f"当前在线设备: {app_stats['devices']} 个, "
+                           f"已知设备: {app_stats['known']} 个, "
+                           f"乱序事件: {app_stats['stale']} 条")
+            
+            # 写入统计信息到文件末尾（排在已缓冲的设备之后）
+            self.output_writer.append(
+                output_file,
+                "\n"
+                "# 统计信息:\n"
+                f"# 应用ID: {app_id}\n"
+                f"# 在线消息数: {app_stats['online']}\n"
+                f"# 离线消息数: {app_stats['offline']}\n"
+                f"# 当前在线设备数: {app_stats['devices']}\n"
+                f"# 已知设备数: {app_stats['known']}\n"
+                f"# 乱序事件数: {app_stats['stale']}\n"
+                f"# 统计时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+            )
+        
+        for app_id, data in self.analytics_summary().items():
+            self.logger.info(f"应用{app_id} - 状态切换: {data['transitions']} 次, "
+                           f"已结束会话: {data['sessions']['count']} 个, "
+                           f"抖动设备: {data['flapping']} 个")
+        
+        for app_id, data in self.distinct_summary().items():
+            latest = data['hours'][-1] if data['hours'] else None
+            self.logger.info(f"应用{app_id} - 最近 {len(data['hours'])} 小时去重在线设备: {data['total']} 个"
+                           + (f", 最近一小时: {latest['devices']} 个" if latest else "")
+                           + (" (近似)" if data['mode'] == 'approximate' else ""))
+        self.save_distinct_sketches()
+        
+        # 统计信息需要立即可见，写出全部缓冲
+        self.output_writer.flush()
+    
+    def create_message_source(self, topic_name: str, start_offsets: Dict[int, int] = None,
+                              asynchronous: bool = False) -> MessageSource:
+        """按配置创建主题的消息来源（asynchronous: 供 asyncio 引擎使用）"""
+        if self.source_type == "console":
+            source_class = AsyncConsoleConsumerSource if asynchronous else ConsoleConsumerSource
+            return source_class(topic_name, self.kafka_client, self.bootstrap_servers,
+                                start_offsets)
+        if self.source_type == "file":
+            return FileReplaySource(topic_name, Path(str(self.replay_path).format(topic=topic_name)))
+        if self.source_type == "kafka":
+            return KafkaClientSource(topic_name, self.bootstrap_servers, self.kafka_consumer_factory,
+                                     start_offsets)
+        raise ValueError(f"未知的消息来源: {self.source_type}")
+    
+    def topic_subscription(self) -> TopicSubscription:
+        """多路复用消费的订阅：配置了 topic_pattern 时按正则，否则为 topics 中的主题白名单"""
+        return TopicSubscription([topic for topic, _ in self.topics], self.topic_pattern)
+    
+    def create_multiplexed_source(self, subscription: TopicSubscription,
+                                  start_offsets: Dict[str, Dict[int, int]]) -> MessageSource:
+        """按配置创建订阅全部主题的单个消息来源"""
+        if self.source_type == "console":
+            return MultiplexConsoleSource(subscription, self.multiplex_client, self.bootstrap_servers,
+                                          start_offsets, self.topic_refresh_interval)
+        if self.source_type == "file":
+            return MultiplexFileSource(subscription, Path(self.replay_path), start_offsets)
+        if self.source_type == "kafka":
+            return MultiplexKafkaSource(subscription, self.bootstrap_servers, self.kafka_consumer_factory,
+                                        start_offsets, self.topic_refresh_interval)
+        raise ValueError(f"未知的消息来源: {self.source_type}")
+    
+    def seed_resume_devices(self, app_id: str):
+        """续读模式：把恢复的设备状态表交给当前线程的分片，避免重复追加"""
+        shard = self.get_shard()
+        with shard.lock:
+            table = self.resume_tables.pop(app_id, None)
+            if table is None:
+                return
+            if app_id in shard.device_tables:
+                merged = shard.device_tables[app_id]
+                merged.merge(table)
+                shard.online_devices[app_id] = merged.online
+                if merged.distinct is not None:
+                    merged.distinct.seed(table, merged.online.bitmap)
+            else:
+                self.attach_table_hooks(app_id, table)
+                shard.add_app(app_id, table)
+    
+    def compact_output_files(self):
+        """整理输出文件：有设备离线的应用按当前在线集合原子重写输出文件
+        
+        在线集合的取得与重写都在批次边界上、持有输出写入器的锁完成：已应用到状态表的设备
+        其追加也已进入缓冲（重写丢弃的缓冲追加都已包含在在线集合中），之后的追加只属于
+        重写之后的批次，不会重复或丢失。重写成功后才清除离线标记，失败时下次整理重试。
+        """
+        for app_id in list(self.app_ids):
+            with self.batch_boundary(), self.output_writer.lock:
+                tables = [shard.device_tables[app_id] for shard in list(self.shards)
+                          if app_id in shard.device_tables]
+                if not any(table.removed for table in tables):
+                    continue
+                online = self.device_table(app_id).online
+                self.create_app_output_file(app_id, online)
+                for table in tables:
+                    table.removed = False
+                device_count = len(online)
+            self.logger.info(f"已整理应用{app_id}输出文件: 当前在线 {device_count} 个设备")
+    
+    def index_file(self, app_id: str) -> Path:
+        return self.output_dir / f"online_devices_{app_id}.idx"
+    
+    def write_device_indexes(self):
+        """为在线集合或计数有变化的应用重建已排序的设备索引文件"""
+        for app_id, app_stats in self.snapshot_stats().items():
+            signature = tuple(app_stats.values())
+            output_file = self.output_dir / f"online_devices_{app_id}.txt"
+            if self.index_signatures.get(app_id) == signature and is_fresh_index(self.index_file(app_id), output_file):
+                continue
+            start = time.monotonic()
+            stats = dict(app_stats, app_id=app_id, generated=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            # 复制位图后在副本上排序写出，不与消费线程争用
+            online = self.device_table(app_id).online.copy()
+            count = write_device_index(self.index_file(app_id), online, stats)
+            self.index_signatures[app_id] = signature
+            self.logger.info(f"已生成应用{app_id}设备索引: {count} 个在线设备, "
+                             f"耗时 {(time.monotonic() - start) * 1000:.0f} 毫秒")
+    
+    def collect_state(self) -> Dict:
+        """收集当前状态用于快照
+        
+        位点、计数器与状态表在同一批次边界上取得（持有全部分片的批次边界锁）：
+        续读时从快照位点开始的消息都未计入快照中的计数，不会重复计数。
+        """
+        with self.batch_boundary():
+            offsets = self.checkpoints.copy()
+            online_count = self.online_count
+            offline_count = self.offline_count
+            apps = {}
+            for app_id in online_count:
+                table = self.device_table(app_id).copy()
+                # 尚未被消费线程认领的恢复状态表
+                pending = self.resume_tables.get(app_id)
+                if pending is not None:
+                    table.merge(pending)
+                apps[app_id] = {
+                    'online': online_count.get(app_id, 0),
+                    'offline': offline_count.get(app_id, 0),
+                    'table': table,
+                }
+            processed = self.processed_count
+            business = self.business_msg_count
+        return {
+            'processed': processed,
+            'business': business,
+            'apps': apps,
+            'offsets': offsets,
+        }
+    
+    def save_snapshot(self):
+        """保存状态快照"""
+        with self.snapshot_lock:
+            start = time.monotonic()
+            state = self.collect_state()
+            size = self.snapshots.save(state)
+            elapsed = (time.monotonic() - start) * 1000
+        device_total = sum(app_state['table'].known_count for app_state in state['apps'].values())
+        self.logger.info(f"已保存状态快照: {len(state['apps'])} 个应用, {device_total} 个设备, "
+                         f"{size} 字节, 耗时 {elapsed:.0f} 毫秒")
+    
+    def load_state_snapshot(self) -> bool:
+        """加载状态快照：计数器放入独立的恢复分片，设备集合待消费线程认领"""
+        start = time.monotonic()
+        state = self.snapshots.load()
+        if state is None:
+            return False
+        
+        restored = StatsShard("snapshot")
+        restored.processed_count = state['processed']
+        restored.business_msg_count = state['business']
+        topic_apps = {app_id for _, app_id in self.topics}
+        for app_id, app_state in state['apps'].items():
+            restored.online_count[app_id] = app_state['online']
+            restored.offline_count[app_id] = app_state['offline']
+            # 快照中的编码表成为该应用的编码表，后续分片的状态表与之共用
+            self.registries[app_id] = app_state['table'].registry
+            if app_id in topic_apps:
+                self.resume_tables[app_id] = app_state['table']
+            else:
+                # 没有对应主题的应用不会再有消费线程认领，状态表直接留在恢复分片
+                restored.device_tables[app_id] = app_state['table']
+                restored.online_devices[app_id] = app_state['table'].online
+            if app_id not in self.app_ids:
+                self.app_ids.append(app_id)
+        
+        with self.app_lock:
+            self.shards.append(restored)
+        for topic, partitions in state['offsets'].items():
+            self.checkpoints.update(topic, partitions)
+        
+        elapsed = (time.monotonic() - start) * 1000
+        device_total = sum(app_state['table'].known_count for app_state in state['apps'].values())
+        self.logger.info(f"已加载状态快照: {self.snapshot_file}, {len(state['apps'])} 个应用, "
+                         f"{device_total} 个设备, 耗时 {elapsed:.0f} 毫秒")
+        return True
+    
+    def save_checkpoint(self):
+        """保存消费位点检查点
         
-        # 跳过系统消息
-        if self.is_system_message(message):
-            if self.processed_count <= 20:
-                self.logger.info(f"跳过系统消息{self.processed_count}: {message[:100]}")
+        先取位点快照再写出输出文件缓冲与事件历史，保证落盘的位点不超过已写入的数据。
+        """
+        offsets = self.checkpoints.snapshot()
+        if self.event_store is not None:
+            self.event_store.flush()
+        if offsets is None:
             return
+        self.output_writer.flush()
+        self.checkpoints.save(offsets)
+    
+    def start_periodic_task(self, name: str, interval: float, task, description: str):
+        """启动后台定时任务线程，stop_monitoring 时随 background_stop 一起结束并等待其退出"""
+        def loop():
+            while not self.background_stop.wait(interval):
+                try:
+                    task()
+                except Exception as e:
+                    self.logger.error(f"{description}失败: {e}")
+        
+        thread = threading.Thread(target=loop, name=name)
+        thread.daemon = True
+        thread.start()
+        self.background_threads.append(thread)
+    
+    def start_background_tasks(self):
+        """启动检查点、状态快照与输出文件整理的定时线程"""
+        self.background_stop.clear()
+        self.start_periodic_task("offset-checkpointer", self.checkpoint_interval,
+                                 self.save_checkpoint, "保存消费位点检查点")
+        if self.snapshot_interval > 0:
+            self.start_periodic_task("state-snapshotter", self.snapshot_interval,
+                                     self.save_snapshot, "保存状态快照")
+        if self.compact_interval > 0:
+            self.start_periodic_task("output-compactor", self.compact_interval,
+                                     self.compact_output_files, "整理输出文件")
+        if self.index_interval > 0:
+            self.start_periodic_task("device-indexer", self.index_interval,
+                                     self.write_device_indexes, "生成设备索引")
+        if self.log_summary_interval > 0:
+            self.start_periodic_task("log-summary", self.log_summary_interval,
+                                     self.log_suppressed_summary, "输出日志省略汇总")
+        if self.metrics_interval > 0:
+            self.start_periodic_task("metrics-exporter", self.metrics_interval,
+                                     self.write_metrics, "导出指标")
+    
+    def handle_control(self, request: Dict) -> Dict:
+        """处理控制套接字请求，只读取内存状态
+        
+        命令: status - 运行计数与各应用统计; metrics - 全部指标; lookup - 按devSn查询各应用中的状态;
+        devices - 分页列出应用的在线设备（参数 app_id/limit/prefix，按 offset 或 cursor 分页：
+        offset 分页的应答带 offset 与 total，cursor 分页（0 为从头开始）的应答带 next_cursor，没有下一页时为 null）;
+        analytics - 各应用的会话时长直方图、切换次数与抖动设备（参数 app_id/top）;
+        distinct - 各应用每小时的去重在线设备数（参数 app_id）; seen - 设备是否在各应用中出现过（参数 devSn）。
+        """
+        cmd = request.get('cmd')
+        if cmd == 'status':
+            return {
+                'ok': True,
+                'pid': os.getpid(),
+                'uptime': time.time() - self.start_time if self.start_time else 0.0,
+                'source': self.source_type,
+                'parser': self.parser.name,
+                'processed': self.processed_count,
+                'business': self.business_msg_count,
+                'apps': self.snapshot_stats(),
+                'pipelines': {name: pipeline.stats() for name, pipeline in list(self.pipelines.items())},
+            }
+        
+        if cmd == 'metrics':
+            return {'ok': True, 'metrics': self.collect_metrics()}
+        
+        if cmd == 'lookup':
+            dev_sn = str(request.get('devSn', ''))
+            app_ids = [request['app_id']] if request.get('app_id') else list(self.app_ids)
+            states = {}
+            for app_id in app_ids:
+                state = self.device_table(app_id).get(dev_sn)
+                states[app_id] = None if state is None else {'online': state[0], 'changeTime': state[1]}
+            return {'ok': True, 'devSn': dev_sn, 'apps': states}
+        
+        if cmd == 'devices':
+            app_id = str(request.get('app_id', ''))
+            if app_id not in self.app_ids:
+                return {'ok': False, 'error': f"未知的应用ID: {app_id}"}
+            offset = max(0, int(request.get('offset', 0)))
+            limit = max(0, int(request.get('limit', 100)))
+            prefix = str(request.get('prefix') or '')
+            cursor = request.get('cursor')
+            # 在线位图的并集（不合并状态表）；内存中的在线集合按设备ID排列
+            online = self.online_devices[app_id]
+            names = online.registry.names
+            # 游标为下一页起始的设备ID，续读时从该ID所在字节开始遍历，不再从头跳过 offset 个设备
+            start, skip = (0, offset) if cursor is None else (max(0, int(cursor)), 0)
+            devices = []
+            next_cursor = None
+            for device_id in online.bitmap.iter_from(start):
+                dev_sn = names[device_id]
+                if prefix and not dev_sn.startswith(prefix):
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                if len(devices) >= limit:
+                    next_cursor = device_id
+                    break
+                devices.append(dev_sn)
+            if cursor is None:
+                response = {'ok': True, 'app_id': app_id, 'offset': offset, 'devices': devices}
+            else:
+                response = {'ok': True, 'app_id': app_id, 'devices': devices, 'next_cursor': next_cursor}
+            if not start:
+                # 总数只在从头读取时计算（前缀过滤时需遍历一次）
+                response['total'] = (sum(1 for dev_sn in online if dev_sn.startswith(prefix))
+                                     if prefix else len(online))
+            return response
+        
+        if cmd == 'analytics':
+            top_k = max(0, int(request.get('top', self.analytics_top_k)))
+            summaries = self.analytics_summary(top_k)
+            app_id = request.get('app_id')
+            if app_id:
+                if str(app_id) not in summaries:
+                    return {'ok': False, 'error': f"应用{app_id}没有会话分析数据"}
+                summaries = {str(app_id): summaries[str(app_id)]}
+            return {'ok': True, 'apps': summaries}
+        
+        if cmd == 'distinct':
+            if not self.distinct_mode:
+                return {'ok': False, 'error': "未开启每小时去重计数（--distinct-counts）"}
+            summaries = self.distinct_summary()
+            app_id = request.get('app_id')
+            if app_id:
+                if str(app_id) not in summaries:
+                    return {'ok': False, 'error': f"应用{app_id}没有去重计数数据"}
+                summaries = {str(app_id): summaries[str(app_id)]}
+            return {'ok': True, 'apps': summaries}
+        
+        if cmd == 'seen':
+            if not self.distinct_mode:
+                return {'ok': False, 'error': "未开启每小时去重计数（--distinct-counts）"}
+            dev_sn = str(request.get('devSn', ''))
+            apps = {}
+            for app_id in list(self.app_ids):
+                counter = self.distinct_counter(app_id)
+                if counter is not None:
+                    apps[app_id] = counter.seen(dev_sn)
+            return {'ok': True, 'devSn': dev_sn, 'mode': self.distinct_mode, 'apps': apps}
+        
+        return {'ok': False, 'error': f"未知命令: {cmd}"}
+    
+    def collect_metrics(self) -> Dict:
+        """汇总各分片与写入器的指标；速率按与上次导出之间的差值计算"""
+        now = time.time()
+        shards = list(self.shards)
+        
+        topic_messages: Dict[str, int] = {}
+        parse_histogram = LatencyHistogram()
+        for shard in shards:
+            for topic, count in list(shard.topic_messages.items()):
+                topic_messages[topic] = topic_messages.get(topic, 0) + count
+            parse_histogram.merge(shard.parse_histogram)
+        
+        rates = {}
+        if self.metrics_previous is not None:
+            previous_time, previous_messages = self.metrics_previous
+            elapsed = now - previous_time
+            if elapsed > 0:
+                rates = {topic: (count - previous_messages.get(topic, 0)) / elapsed
+                         for topic, count in topic_messages.items()}
+        
+        write_histogram = LatencyHistogram()
+        with self.output_writer.lock:
+            write_histogram.merge(self.output_writer.write_histogram)
         
-        self.business_msg_count += 1
+        opened = {source.topic_name: source.opened_at for source in list(self.message_sources)
+                  if source.opened_at is not None}
+        for topic, mirror in list(self.worker_mirrors.items()):
+            if mirror.get('opened_at'):
+                opened[topic] = mirror['opened_at']
+        sources = {}
+        if self.multiplex:
+            source_names = [self.topic_subscription().describe()]
+        else:
+            source_names = [topic for topic, _ in self.topics]
+        for topic in source_names:
+            starts = self.source_starts.get(topic, 0)
+            sources[topic] = {
+                'starts': starts,
+                'restarts': max(0, starts - 1),
+                'uptime': now - opened[topic] if topic in opened else 0.0,
+            }
+        
+        processed = sum(shard.processed_count for shard in shards)
+        return {
+            'timestamp': now,
+            'uptime': now - self.start_time if self.start_time else 0.0,
+            'messages': {
+                'processed': processed,
+                'business': sum(shard.business_msg_count for shard in shards),
+                'system': sum(shard.system_msg_count for shard in shards),
+                'invalid': sum(shard.invalid_msg_count for shard in shards),
+            },
+            'topics': {topic: {'messages': count, 'per_second': rates.get(topic, 0.0)}
+                       for topic, count in topic_messages.items()},
+            'sources': sources,
+            'pipelines': {name: pipeline.stats() for name, pipeline in list(self.pipelines.items())},
+            'apps': self.snapshot_stats(),
+            'analytics': self.analytics_summary(),
+            'distinct': self.distinct_summary(),
+            'parse_seconds': parse_histogram.to_dict(),
+            'write_seconds': write_histogram.to_dict(),
+        }
+    
+    @staticmethod
+    def format_prometheus(metrics: Dict) -> str:
+        """按 Prometheus 文本格式输出指标"""
+        lines = []
+        
+        def metric(name: str, kind: str, help_text: str, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        
+        def histogram(name: str, help_text: str, series):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, data in series:
+                prefix = "".join(f'{key}="{val}",' for key, val in labels.items())
+                suffix = f"{{{prefix[:-1]}}}" if prefix else ""
+                for bound, count in data['buckets'].items():
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {data["count"]}')
+                lines.append(f"{name}_sum{suffix} {data['sum']:.6f}")
+                lines.append(f"{name}_count{suffix} {data['count']}")
+        
+        messages = metrics['messages']
+        metric("device_monitor_uptime_seconds", "gauge", "监控器运行时长",
+               [({}, f"{metrics['uptime']:.1f}")])
+        metric("device_monitor_messages_total", "counter", "按类型统计的消息数",
+               [({'type': kind}, count) for kind, count in messages.items()])
+        metric("device_monitor_topic_messages_total", "counter", "各主题处理的消息数",
+               [({'topic': topic}, data['messages']) for topic, data in metrics['topics'].items()])
+        metric("device_monitor_topic_messages_per_second", "gauge", "各主题最近一个导出周期的消息速率",
+               [({'topic': topic}, f"{data['per_second']:.2f}") for topic, data in metrics['topics'].items()])
+        metric("device_monitor_source_restarts_total", "counter", "消息来源（消费者子进程）重启次数",
+               [({'topic': topic}, data['restarts']) for topic, data in metrics['sources'].items()])
+        metric("device_monitor_source_uptime_seconds", "gauge", "当前消息来源（消费者子进程）运行时长",
+               [({'topic': topic}, f"{data['uptime']:.1f}") for topic, data in metrics['sources'].items()])
+        pipelines = metrics['pipelines']
+        metric("device_monitor_pipeline_depth", "gauge", "读取/处理队列中排队的批次数（含溢出）",
+               [({'topic': name}, data['depth']) for name, data in pipelines.items()])
+        metric("device_monitor_pipeline_high_water", "gauge", "读取/处理队列深度的高水位",
+               [({'topic': name}, data['high_water']) for name, data in pipelines.items()])
+        metric("device_monitor_pipeline_spilled_batches_total", "counter", "溢出到磁盘的批次数",
+               [({'topic': name}, data['spilled']) for name, data in pipelines.items()])
+        metric("device_monitor_pipeline_spill_bytes", "gauge", "溢出文件中尚未读回的字节数",
+               [({'topic': name}, data['spill_bytes']) for name, data in pipelines.items()])
+        metric("device_monitor_pipeline_blocked_seconds_total", "counter", "队列满时读取线程阻塞的累计秒数",
+               [({'topic': name}, f"{data['blocked_seconds']:.3f}") for name, data in pipelines.items()])
+        metric("device_monitor_online_devices", "gauge", "各应用当前在线设备数",
+               [({'app_id': app_id}, data['devices']) for app_id, data in metrics['apps'].items()])
+        metric("device_monitor_known_devices", "gauge", "各应用已知设备数",
+               [({'app_id': app_id}, data['known']) for app_id, data in metrics['apps'].items()])
+        metric("device_monitor_status_events_total", "counter", "各应用上线/离线消息数",
+               [({'app_id': app_id, 'status': status}, data[status])
+                for app_id, data in metrics['apps'].items() for status in ('online', 'offline')])
+        metric("device_monitor_stale_events_total", "counter", "各应用被拒绝的乱序事件数",
+               [({'app_id': app_id}, data['stale']) for app_id, data in metrics['apps'].items()])
+        analytics = metrics['analytics']
+        metric("device_monitor_state_transitions_total", "counter", "各应用设备上线/离线状态切换次数",
+               [({'app_id': app_id}, data['transitions']) for app_id, data in analytics.items()])
+        metric("device_monitor_flapping_devices", "gauge", "各应用当前判定为抖动的设备数",
+               [({'app_id': app_id}, data['flapping']) for app_id, data in analytics.items()])
+        histogram("device_monitor_session_seconds", "各应用设备在线会话时长（按changeTime）",
+                  [({'app_id': app_id}, data['sessions']) for app_id, data in analytics.items()])
+        distinct = metrics['distinct']
+        metric("device_monitor_hourly_distinct_devices", "gauge",
+               "各应用最近两个小时内在线过的去重设备数（approximate 模式为 HyperLogLog 估计值）",
+               [({'app_id': app_id, 'hour': label}, hour['devices'])
+                for app_id, data in distinct.items()
+                for label, hour in zip(('current', 'previous'), reversed(data['hours'][-2:]))])
+        metric("device_monitor_distinct_counter_bytes", "gauge", "各应用每小时去重计数占用的内存",
+               [({'app_id': app_id, 'mode': data['mode']}, data['memory_bytes']) for app_id, data in distinct.items()])
+        histogram("device_monitor_parse_seconds", "抽样的单条消息解析耗时", [({}, metrics['parse_seconds'])])
+        histogram("device_monitor_output_write_seconds", "输出文件写盘耗时", [({}, metrics['write_seconds'])])
+        return "\n".join(lines) + "\n"
+    
+    def write_metrics(self):
+        """导出指标：Prometheus 文本文件与 JSON 文件均以临时文件 + rename 原子替换"""
+        metrics = self.collect_metrics()
+        self.metrics_previous = (metrics['timestamp'],
+                                 {topic: data['messages'] for topic, data in metrics['topics'].items()})
+        for path, text in ((self.metrics_file, self.format_prometheus(metrics)),
+                           (self.metrics_json_file, json.dumps(metrics, ensure_ascii=False, indent=2))):
+            tmp_path = path.with_name(path.name + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+        self.save_distinct_sketches()
+    
+    def start_control_server(self):
+        """启动本地控制套接字，失败时只记录日志，不影响监控"""
+        try:
+            self.control_server = ControlServer(self.control_socket, self.handle_control)
+            self.control_server.start()
+            self.logger.info(f"控制套接字: {self.control_socket}")
+        except OSError as e:
+            self.control_server = None
+            self.logger.error(f"启动控制套接字失败: {e}")
+    
+    def log_consumer_start(self, topic_name: str, app_id: str, start_offsets: Dict[int, int]):
+        """记录消费者启动/重启（含续读位点）"""
+        if start_offsets:
+            offsets_desc = ", ".join(f"{partition}:{offset}"
+                                     for partition, offset in sorted(start_offsets.items()))
+            self.logger.info(f"启动/重启Kafka消费者 - 主题: {topic_name}, 应用ID: {app_id}, "
+                             f"续读位点: {offsets_desc}")
+        else:
+            self.logger.info(f"启动/重启Kafka消费者 - 主题: {topic_name}, 应用ID: {app_id}")
+    
+    def source_opened(self, topic_name: str, source: MessageSource):
+        """登记已打开的来源（停止时中断、导出运行时长与启动次数）"""
+        self.logger.info(f"已打开消息来源: {source.describe()}")
+        source.opened_at = time.time()
+        self.source_starts[topic_name] = self.source_starts.get(topic_name, 0) + 1
+        self.message_sources.append(source)
+    
+    def source_closed(self, source: MessageSource):
+        if source in self.message_sources:
+            self.message_sources.remove(source)
+    
+    def consume_batch(self, topic_name: str, app_id: Optional[str], positions: Dict[int, int],
+                      batch: List[str]):
+        """处理一个主题的一批消息，处理完成后记录该主题的位点（持有分片的批次边界锁）
         
-        # 每100条业务消息记录一次日志
-        if self.business_msg_count % 100 == 0:
-            stats = []
-            for app_id in self.online_count:
-                stats.append(f"应用{app_id} - 在线:{self.online_count[app_id]} "
-                           f"离线:{self.offline_count[app_id]} "
-                           f"去重设备:{len(self.online_devices[app_id])}")
-            
-            self.logger.info(f"已处理 {self.business_msg_count} 条业务消息, {', '.join(stats)}")
+        处理失败时不记录位点并回滚计数器，重新读取的批次只计数一次。
+        """
+        shard = self.get_shard()
+        with shard.lock, shard.rollback_on_error():
+            shard.topic_messages[topic_name] = shard.topic_messages.get(topic_name, 0) + len(batch)
+            self.process_batch(batch, app_id)
+            if positions:
+                self.checkpoints.update(topic_name, positions)
+    
+    def consume_routed_batch(self, groups: Dict[Optional[str], List[str]], positions: Dict[str, Dict[int, int]]):
+        """处理多路复用来源的一批消息：按记录所属主题分组，各组路由到主题对应的应用ID"""
+        with self.get_shard().lock:
+            for topic_name, messages in groups.items():
+                if topic_name is None:
+                    # 没有元数据前缀的行（客户端日志等），按系统消息计数
+                    self.process_batch(messages)
+                elif messages:
+                    self.consume_batch(topic_name, self.route_topic(topic_name),
+                                       positions.get(topic_name), messages)
+    
+    def route_topic(self, topic_name: str) -> Optional[str]:
+        """主题 -> 应用ID：优先使用 topics 中的配置，否则从主题名末尾的数字推断，
+        都没有时返回 None（按每条消息的 appId 确定应用）
+        """
+        try:
+            return self.topic_apps[topic_name]
+        except KeyError:
+            pass
+        app_id = dict(self.topics).get(topic_name)
+        if app_id is None:
+            match = TOPIC_APP_PATTERN.search(topic_name)
+            app_id = match.group(1) if match else None
+            self.logger.info(f"发现新主题: {topic_name} -> "
+                             f"{'应用' + app_id if app_id else '按消息appId确定应用'}")
+        self.topic_apps[topic_name] = app_id
+        return app_id
+    
+    def restart_delay(self, topic_name: str, source: MessageSource, exit_code: int) -> Optional[float]:
+        """来源结束后的重启等待秒数；回放类来源读完即结束，返回 None"""
+        self.logger.info(f"Kafka消费者退出 - 主题: {topic_name} (来源: {source.name}, 退出码: {exit_code})")
         
-        # 提取字段
-        fields = self.extract_fields(message)
-        dev_sn = fields.get('devSn', '')
-        online_status = fields.get('onlineStatus', '')
-        plate_num = fields.get('plateNum', '')
+        if not source.restartable:
+            self.logger.info(f"主题 {topic_name} 回放结束: {source.describe()}")
+            return None
         
-        if not dev_sn or not online_status:
-            if self.business_msg_count <= 20:
-                self.logger.info(f"跳过无效业务消息{self.business_msg_count}: {message[:100]}")
-            return
+        if source.reassigned:
+            self.logger.info(f"{topic_name} 的主题/分区有变化，按新的分配立即重启")
+            return 0
         
-        # 确定应用ID - 优先使用主题对应的应用ID
-        if topic_app_id:
-            app_id = topic_app_id
-        else:
-            app_id = self.determine_app_id(fields)
-        
-        # 调试信息（仅前10条业务消息）
-        if self.business_msg_count <= 10:
-            self.logger.info(f"调试 - 业务消息{self.business_msg_count}: "
-                           f"devSn={dev_sn}, status={online_status}, app_id={app_id}")
-        
-        # 确保应用ID的统计数据已初始化
-        if app_id not in self.online_count:
-            self.online_devices[app_id] = set()
-            self.online_count[app_id] = 0
-            self.offline_count[app_id] = 0
-            self.create_app_output_file(app_id)
+        # 根据退出码决定等待时间
+        if exit_code == 0:
+            self.logger.info(f"主题 {topic_name} 正常退出，等待30秒后重启以监听新消息...")
+            return 30
+        self.logger.info(f"主题 {topic_name} 异常退出，等待10秒后重启...")
+        return 10
+    
+    def start_pipeline(self, name: str, handle, on_commit, setup=None
+                       ) -> Tuple[Optional[BatchPipeline], Optional[threading.Thread]]:
+        """读取/处理解耦时创建消费者的批次队列并启动处理线程；未开启时返回 (None, None)
         
-        # 处理在线状态
-        if online_status == "ONLINE":
-            self.online_count[app_id] += 1
-            
-            # 添加到对应应用的在线设备集合（自动去重）
-            if dev_sn not in self.online_devices[app_id]:
-                self.online_devices[app_id].add(dev_sn)
-                
-                # 实时更新对应应用的输出文件
-                self.append_to_output_file(app_id, dev_sn)
-                
-                self.logger.info(f"应用{app_id}新增在线设备: {dev_sn} (车牌: {plate_num})")
+        setup 在处理批次的线程中、第一批之前执行（如把续读状态交给该线程的分片），
+        未开启解耦时在当前线程立即执行。
+        """
+        if self.pipeline_queue_size <= 0:
+            if setup is not None:
+                setup()
+            return None, None
+        pipeline = BatchPipeline(name, self.pipeline_queue_size, self.pipeline_policy,
+                                 self.pipeline_spill_dir, on_commit)
+        self.pipelines[name] = pipeline
+        worker = threading.Thread(target=self.run_pipeline_worker, args=(pipeline, handle, setup),
+                                  name=f"batch-worker-{name}", daemon=True)
+        worker.start()
+        self.logger.info(f"读取/处理解耦 - {name}: 队列 {pipeline.maxsize} 批, 背压策略: {pipeline.policy}")
+        return pipeline, worker
+    
+    def run_pipeline_worker(self, pipeline: BatchPipeline, handle, setup=None):
+        """处理线程：取出批次处理并提交位点；停止后队列中剩余的批次不再处理
         
-        elif online_status == "OFFLINE":
-            self.offline_count[app_id] += 1
-            self.logger.info(f"应用{app_id}设备离线: {dev_sn} (车牌: {plate_num})")
+        处理与位点提交在分片的批次边界锁内完成，快照看到的位点与状态一致。
+        处理失败的批次不提交位点、回滚计数器（见 StatsShard.rollback_on_error），
+        由读取线程关闭来源后从已提交的位点重新读取。
+        """
+        shard = self.get_shard()
+        if setup is not None:
+            setup()
+        while self.running:
+            item = pipeline.get(timeout=0.5)
+            if item is None:
+                if pipeline.closed:
+                    break
+                continue
+            batch, positions = item
+            with shard.lock:
+                try:
+                    with shard.rollback_on_error():
+                        handle(batch)
+                except Exception as e:
+                    self.logger.error(f"批次处理异常 - {pipeline.name}: {e}")
+                    pipeline.fail(e)
+                    continue
+                pipeline.done(positions)
     
-    def create_app_output_file(self, app_id: str):
-        """创建应用专用输出文件"""
-        output_file = self.output_dir / f"online_devices_{app_id}.txt"
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write(f"# 应用 {app_id} 在线设备列表 (devSn) - 自动生成于 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write("# 格式: devSn\n")
+    def drain_pipeline(self, pipeline: Optional[BatchPipeline]):
+        """等待队列中的批次处理完成（停止时不等待）"""
+        if pipeline is not None:
+            while self.running and not pipeline.wait_drained(0.5):
+                pass
     
-    def append_to_output_file(self, app_id: str, dev_sn: str):
-        """追加设备到输出文件"""
-        output_file = self.output_dir / f"online_devices_{app_id}.txt"
-        with open(output_file, 'a', encoding='utf-8') as f:
-            f.write(f"{dev_sn}\n")
+    def stop_pipeline(self, pipeline: Optional[BatchPipeline], worker: Optional[threading.Thread]):
+        if pipeline is None:
+            return
+        self.drain_pipeline(pipeline)
+        pipeline.close()
+        # 处理线程处理完手中的批次即退出，等待它结束后才算消费者结束
+        worker.join()
     
-    def write_final_stats(self):
-        """写入最终统计信息"""
-        for app_id in self.online_count:
-            output_file = self.output_dir / f"online_devices_{app_id}.txt"
-            
-            self.logger.info(f"应用{app_id} - 在线: {self.online_count[app_id]} 条，"
-                           f"离线: {self.offline_count[app_id]} 条，"
-                           f"去重在线设备: {len(self.online_devices[app_id])} 个")
-            
-            # 写入统计信息到文件末尾
-            with open(output_file, 'a', encoding='utf-8') as f:
-                f.write("\n")
-                f.write("# 统计信息:\n")
-                f.write(f"# 应用ID: {app_id}\n")
-                f.write(f"# 在线消息数: {self.online_count[app_id]}\n")
-                f.write(f"# 离线消息数: {self.offline_count[app_id]}\n")
-                f.write(f"# 去重在线设备数: {len(self.online_devices[app_id])}\n")
-                f.write(f"# 统计时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+    def source_batches(self, source: MessageSource) -> Iterator[List[str]]:
+        """按 batch_size 读取来源：大于1时按批读取，否则逐行读取、每条消息作为单条批次处理（同 process_message）"""
+        if self.batch_size > 1:
+            return source.batches(self.batch_size, self.batch_timeout_ms)
+        return ([message] for message in source.lines())
     
     def start_single_kafka_consumer(self, topic_name: str, app_id: str):
         """启动单个主题的Kafka消费者"""
+        pipeline, worker = self.start_pipeline(
+            topic_name,
+            lambda batch: self.consume_batch(topic_name, app_id, None, batch),
+            lambda positions: self.checkpoints.update(topic_name, positions),
+            lambda: self.seed_resume_devices(app_id))
+        
         while self.running:
             try:
-                self.logger.info(f"启动/重启Kafka消费者 - 主题: {topic_name}, 应用ID: {app_id}")
+                if pipeline is not None:
+                    pipeline.reset()
                 
-                # 启动Kafka消费者进程
-                cmd = [
-                    self.kafka_client,
-                    "--bootstrap-server", self.bootstrap_servers,
-                    "--topic", topic_name,
-                    "--from-beginning"
-                ]
+                # 从检查点续读（首次运行且未开启续读时从头消费）
+                start_offsets = self.checkpoints.get(topic_name)
+                self.log_consumer_start(topic_name, app_id, start_offsets)
                 
-                process = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    universal_newlines=True,
-                    bufsize=1
-                )
-                
-                self.kafka_processes.append(process)
+                # 打开消息来源
+                source = self.create_message_source(topic_name, start_offsets)
+                source.open()
+                self.source_opened(topic_name, source)
                 
                 # 读取并处理消息
-                for line in process.stdout:
-                    if not self.running:
-                        break
+                try:
+                    for batch in self.source_batches(source):
+                        if not self.running:
+                            break
+                        if pipeline is None:
+                            self.consume_batch(topic_name, app_id, source.positions, batch)
+                        else:
+                            pipeline.put(batch, dict(source.positions))
+                            pipeline.check()
+                finally:
+                    # 等待来源结束
+                    exit_code = source.close()
+                    self.source_closed(source)
+                
+                # 已读取的批次处理完成后再重启，续读位点才是最新的
+                self.drain_pipeline(pipeline)
+                
+                if not self.running:
+                    break
+                
+                delay = self.restart_delay(topic_name, source, exit_code)
+                if delay is None:
+                    break
+                self.stop_event.wait(delay)
                     
-                    line = line.strip()
-                    if line:
-                        self.process_message(line, app_id)
+            except Exception as e:
+                self.logger.error(f"Kafka消费者异常 - 主题: {topic_name}, 错误: {e}")
+                if self.running:
+                    self.stop_event.wait(10)
+        
+        self.stop_pipeline(pipeline, worker)
+    
+    def start_multiplexed_consumer(self):
+        """多路复用模式：单个消费者订阅全部主题，按每条记录携带的主题路由到应用ID"""
+        subscription = self.topic_subscription()
+        label = subscription.describe()
+        pipeline, worker = self.start_pipeline(
+            label,
+            lambda groups: self.consume_routed_batch(groups, {}),
+            lambda positions: [self.checkpoints.update(topic_name, topic_positions)
+                               for topic_name, topic_positions in positions.items()],
+            lambda: [self.seed_resume_devices(app_id) for _, app_id in self.topics])
+        
+        while self.running:
+            try:
+                if pipeline is not None:
+                    pipeline.reset()
+                
+                # 各主题从各自的检查点续读
+                start_offsets = self.checkpoints.copy()
+                self.logger.info(f"启动/重启多路复用消费者 - 订阅: {label}, "
+                                 f"有检查点的主题: {len(start_offsets)} 个")
+                
+                source = self.create_multiplexed_source(subscription, start_offsets)
+                source.open()
+                self.source_opened(label, source)
+                
+                try:
+                    for groups in source.batches(self.batch_size, self.batch_timeout_ms):
+                        if not self.running:
+                            break
+                        if pipeline is None:
+                            self.consume_routed_batch(groups, source.topic_positions)
+                        else:
+                            # 只需带上本批涉及主题的位点，其余主题由各自的批次按序提交
+                            topic_positions = source.topic_positions
+                            pipeline.put(groups, {topic_name: dict(topic_positions[topic_name])
+                                                  for topic_name in groups if topic_name in topic_positions})
+                            pipeline.check()
+                finally:
+                    exit_code = source.close()
+                    self.source_closed(source)
                 
-                # 等待进程结束
-                exit_code = process.wait()
+                self.drain_pipeline(pipeline)
                 
                 if not self.running:
                     break
                 
-                self.logger.info(f"Kafka消费者退出 - 主题: {topic_name} (退出码: {exit_code})")
+                delay = self.restart_delay(label, source, exit_code)
+                if delay is None:
+                    break
+                self.stop_event.wait(delay)
+            
+            except Exception as e:
+                self.logger.error(f"多路复用消费者异常 - 订阅: {label}, 错误: {e}")
+                if self.running:
+                    self.stop_event.wait(10)
+        
+        self.stop_pipeline(pipeline, worker)
+    
+    async def run_async_consumer(self, topic_name: str, app_id: str):
+        """asyncio 引擎中单个主题的消费协程（行为与 start_single_kafka_consumer 一致）
+        
+        读取、重启等待均为可取消的 await，停止时由 run_async_consumers 取消。
+        批次交给 async_executor 的处理线程执行（含写盘与 fsync），各主题的批次共用该线程的分片。
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.async_executor, self.seed_resume_devices, app_id)
+        
+        while self.running:
+            try:
+                start_offsets = self.checkpoints.get(topic_name)
+                self.log_consumer_start(topic_name, app_id, start_offsets)
                 
-                # 根据退出码决定等待时间
-                if exit_code == 0:
-                    self.logger.info(f"主题 {topic_name} 正常退出，等待30秒后重启以监听新消息...")
-                    time.sleep(30)
-                else:
-                    self.logger.info(f"主题 {topic_name} 异常退出，等待10秒后重启...")
-                    time.sleep(10)
-                    
+                source = self.create_message_source(topic_name, start_offsets, asynchronous=True)
+                await source.open_async()
+                self.source_opened(topic_name, source)
+                
+                batches = source.abatches(self.batch_size, self.batch_timeout_ms)
+                try:
+                    async for batch in batches:
+                        if not self.running:
+                            break
+                        future = loop.run_in_executor(self.async_executor, self.consume_batch,
+                                                      topic_name, app_id, dict(source.positions), batch)
+                        try:
+                            await asyncio.shield(future)
+                        except asyncio.CancelledError:
+                            # 被取消时本批仍在处理线程中执行，等它完成后再关闭来源
+                            await asyncio.wait([future])
+                            raise
+                finally:
+                    await batches.aclose()
+                    exit_code = await source.aclose()
+                    self.source_closed(source)
+                
+                if not self.running:
+                    break
+                
+                delay = self.restart_delay(topic_name, source, exit_code)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+            
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 self.logger.error(f"Kafka消费者异常 - 主题: {topic_name}, 错误: {e}")
                 if self.running:
-                    time.sleep(10)
+                    await asyncio.sleep(10)
+    
+    async def run_async_consumers(self):
+        """在一个事件循环中运行所有主题的消费协程，收到停止请求后取消并等待它们清理完毕
+        
+        运行期间退出信号由事件循环处理（add_signal_handler），回调在循环中请求停止；
+        全部协程取消并清理完毕后本协程才返回，收尾由 start_monitoring 在 asyncio.run 之后完成。
+        """
+        loop = asyncio.get_running_loop()
+        self.async_loop = loop
+        self.async_stop = asyncio.Event()
+        use_pidfd_child_watcher(loop)
+        if not self.running:
+            return
+        self.async_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                                     thread_name_prefix="async-batch")
+        
+        handled = []
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                previous = signal.getsignal(signum)
+                try:
+                    loop.add_signal_handler(signum, self.async_signal_received, signum)
+                except (NotImplementedError, RuntimeError, ValueError):
+                    continue
+                handled.append((signum, previous))
+        
+        try:
+            consumers = [asyncio.ensure_future(self.run_async_consumer(topic_name, app_id))
+                         for topic_name, app_id in self.topics]
+            for topic_name, app_id in self.topics:
+                self.logger.info(f"已启动消费协程: {topic_name} -> 应用{app_id}")
+            
+            stopper = asyncio.ensure_future(self.async_stop.wait())
+            pending = set(consumers)
+            while pending and not stopper.done():
+                _, pending = await asyncio.wait(pending | {stopper}, return_when=asyncio.FIRST_COMPLETED)
+                pending.discard(stopper)
+            
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*consumers, return_exceptions=True)
+            stopper.cancel()
+        finally:
+            # 恢复原来的信号处理器（remove_signal_handler 会把信号重置为默认处理）
+            for signum, previous in handled:
+                loop.remove_signal_handler(signum)
+                signal.signal(signum, previous)
+            self.async_executor.shutdown(wait=True)
+    
+    def async_signal_received(self, signum: int):
+        """asyncio 引擎运行期间的退出信号回调（在事件循环中执行，可以记录日志并中断来源）"""
+        self.stop_signal = signum
+        self.request_stop()
+    
+    def request_async_stop(self):
+        """通知 asyncio 引擎停止：经 call_soon_threadsafe 在事件循环中设置停止事件（可在其他线程或信号处理器中调用）"""
+        loop = self.async_loop
+        if loop is not None and self.async_stop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self.async_stop.set)
+            except RuntimeError:
+                pass
+    
+    def worker_settings(self) -> Dict:
+        """传给工作进程的配置（须可序列化）"""
+        return {
+            'parser_backend': self.parser_backend,
+            'source_type': self.source_type,
+            'replay_path': self.replay_path,
+            'kafka_client': self.kafka_client,
+            'bootstrap_servers': self.bootstrap_servers,
+            'batch_size': self.batch_size,
+            'batch_timeout_ms': self.batch_timeout_ms,
+            'flap_ring_size': self.flap_ring_size,
+            'history_dir': self.history_dir,
+            'distinct_mode': self.distinct_mode,
+        }
+    
+    def start_worker_processes(self):
+        """多进程模式：每个主题由独立的工作进程消费、解析与聚合
+        
+        工作进程按批发回增量（新登记的devSn、状态有变化的设备ID与压缩状态值、
+        计数器、新增在线/离线设备与本批之后的消费位点）；本进程按到达顺序应用，
+        负责输出文件、合并统计、检查点与快照。
+        """
+        context = multiprocessing.get_context('spawn')
+        delta_queue = context.Queue(self.worker_queue_size)
+        # 停止标志用共享内存值而非 Event：已退出进程遗留的等待者会让 Event.set() 阻塞
+        self.worker_stop = context.Value('b', 0, lock=False)
+        
+        workers = {}
+        for topic_name, app_id in self.topics:
+            # 本进程中的镜像分片；续读时恢复的状态表同时交给工作进程
+            registry = self.get_registry(app_id)
+            table = self.resume_tables.pop(app_id, None) or DeviceStateTable(registry)
+            self.attach_table_hooks(app_id, table)
+            shard = StatsShard(f"worker-{topic_name}")
+            shard.add_app(app_id, table)
+            with self.app_lock:
+                self.shards.append(shard)
+            self.worker_mirrors[topic_name] = {
+                'shard': shard,
+                # 应用ID -> 工作进程设备ID到本进程设备ID的映射
+                'translate': {app_id: array.array('Q', range(len(registry)))},
+                'opened_at': None,
+            }
+            payload = {
+                'names': list(registry.names),
+                'states': table.states.tobytes(),
+                'bits': bytes(table.online.bitmap.bits),
+                'known': table.known_count,
+                'stale': table.stale_count,
+            }
+            
+            process = context.Process(
+                target=run_consumer_worker,
+                args=(self.worker_settings(), topic_name, app_id, self.checkpoints.get(topic_name),
+                      payload, delta_queue, self.worker_stop),
+                name=f"consumer-{topic_name}",
+                daemon=True
+            )
+            process.start()
+            workers[topic_name] = process
+            self.logger.info(f"已启动消费者进程: {topic_name} -> 应用{app_id} (PID: {process.pid})")
+        
+        running = set(workers)
+        stop_deadline = None
+        while running:
+            if not self.running and stop_deadline is None:
+                # 信号处理器只置位停止标志，由本循环通知工作进程停止
+                self.request_stop()
+                stop_deadline = time.monotonic() + 10
+            try:
+                item = delta_queue.get(timeout=0.5)
+            except queue.Empty:
+                running = {topic for topic in running if workers[topic].is_alive()}
+                if stop_deadline is not None and time.monotonic() > stop_deadline:
+                    break
+                continue
+            self.handle_worker_item(item, running)
+        
+        # 工作进程退出前要把队列中的数据送完：等待期间继续取出并应用，超时仍未退出的强制终止
+        deadline = time.monotonic() + 5
+        while any(process.is_alive() for process in workers.values()) and time.monotonic() < deadline:
+            try:
+                item = delta_queue.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            self.handle_worker_item(item, running)
+        for process in workers.values():
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        
+        # 工作进程已全部结束：应用队列中剩余的增量（含位点）后再交给 stop_monitoring 收尾
+        self.drain_worker_queue(delta_queue, running)
+    
+    def handle_worker_item(self, item, running: Set[str]):
+        """处理工作进程发来的一项：日志记录、批次增量或退出通知"""
+        if isinstance(item, logging.LogRecord):
+            self.logger.handle(item)
+        elif item[0] == 'delta':
+            start = time.perf_counter()
+            self.apply_worker_delta(item[1], item[2])
+            self.worker_apply_seconds += time.perf_counter() - start
+        elif item[0] == 'exit':
+            running.discard(item[1])
+            self.worker_times[item[1]] = item[2]
+            self.logger.info(f"消费者进程退出: {item[1]} (运行 {item[2]['seconds']:.2f}s, "
+                             f"CPU {item[2]['cpu_seconds']:.2f}s)")
+    
+    def drain_worker_queue(self, delta_queue, running: Set[str]):
+        """取出并应用队列中剩余的各项；被强制终止的进程可能留下不完整的数据，读取出错时停止"""
+        while True:
+            try:
+                item = delta_queue.get(timeout=0.2)
+            except queue.Empty:
+                break
+            except Exception as e:
+                self.logger.error(f"读取工作进程增量失败: {e}")
+                break
+            self.handle_worker_item(item, running)
+    
+    def apply_worker_delta(self, topic_name: str, delta: Dict):
+        """把工作进程的批次增量应用到镜像分片、追加输出文件并记录位点（持有镜像分片的批次边界锁）"""
+        mirror = self.worker_mirrors[topic_name]
+        shard = mirror['shard']
+        with shard.lock:
+            start_business_count = self.business_msg_count
+            
+            shard.processed_count = delta['processed']
+            shard.business_msg_count = delta['business']
+            shard.system_msg_count = delta['system']
+            shard.invalid_msg_count = delta['invalid']
+            shard.topic_messages[topic_name] = delta['messages']
+            shard.parse_histogram.counts, shard.parse_histogram.sum, shard.parse_histogram.count = delta['parse']
+            self.source_starts[topic_name] = delta['starts']
+            mirror['opened_at'] = delta['opened_at']
+            
+            for app_id, (names, ids, states, online, offline, known, stale, transitions) in delta['apps'].items():
+                table = shard.device_tables.get(app_id)
+                if table is None:
+                    shard.add_app(app_id, self.new_state_table(app_id))
+                    self.register_app(app_id)
+                    table = shard.device_tables[app_id]
+                translate = mirror['translate'].setdefault(app_id, array.array('Q'))
+                if names:
+                    intern = table.registry.intern
+                    translate.extend(intern(dev_sn) for dev_sn in names)
+                
+                device_ids = array.array('Q')
+                device_ids.frombytes(ids)
+                state_values = array.array('Q')
+                state_values.frombytes(states)
+                load_state = table.load_state
+                for device_id, state in zip(device_ids, state_values):
+                    load_state(translate[device_id], state)
+                
+                # 按原顺序把工作进程本批的状态变化重放给分析、历史记录与去重计数钩子
+                hooks = [hook for hook in (table.analytics, table.history, table.distinct) if hook is not None]
+                if transitions and hooks:
+                    event_ids = array.array('Q')
+                    event_ids.frombytes(transitions[0])
+                    event_times = array.array('Q')
+                    event_times.frombytes(transitions[1])
+                    for device_id, change_time, flags in zip(event_ids, event_times, transitions[2]):
+                        for hook in hooks:
+                            hook.record(translate[device_id], flags & 1, change_time, flags >> 1)
+                
+                table.known_count = known
+                table.stale_count = stale
+                shard.online_count[app_id] = online
+                shard.offline_count[app_id] = offline
+            
+            self.write_batch_changes(delta['new_devices'], delta['offline_devices'])
+            # 本批之后的位点与状态在同一批次边界生效
+            if delta['offsets']:
+                self.checkpoints.update(topic_name, delta['offsets'])
+            
+            if self.business_msg_count // 100 > start_business_count // 100:
+                self.log_progress()
+        
+    def check_source_ready(self) -> bool:
+        """检查消息来源的前置条件"""
+        if self.source_type == "console" and self.multiplex:
+            # 多路复用使用 kcat（可为命令名，按 PATH 查找）
+            if shutil.which(self.multiplex_client) is None:
+                self.logger.error(f"未找到多路复用消费客户端 (kcat): {self.multiplex_client}")
+                return False
+            self.logger.info(f"多路复用消费客户端验证通过: {self.multiplex_client}")
+        
+        elif self.source_type == "console":
+            # 检查Kafka客户端是否存在
+            if not os.path.exists(self.kafka_client):
+                self.logger.error(f"未找到Kafka客户端: {self.kafka_client}")
+                return False
+            self.logger.info(f"Kafka客户端路径验证通过: {self.kafka_client}")
+        
+        elif self.source_type == "file":
+            if not self.replay_path:
+                self.logger.error("file来源需要指定回放文件 (--replay)")
+                return False
+            if self.multiplex and not Path(self.replay_path).exists():
+                self.logger.error(f"未找到回放文件: {self.replay_path}")
+                return False
+            for topic_name, app_id in ([] if self.multiplex else self.topics):
+                replay_file = Path(str(self.replay_path).format(topic=topic_name))
+                if not replay_file.exists():
+                    self.logger.error(f"未找到回放文件: {replay_file}")
+                    return False
+        
+        elif self.source_type == "kafka" and self.kafka_consumer_factory is None:
+            try:
+                import kafka  # noqa: F401
+            except ImportError:
+                self.logger.error("kafka来源需要安装 kafka-python: pip install kafka-python")
+                return False
+        
+        return True
     
     def start_kafka_consumers(self):
         """启动所有Kafka消费者"""
-        # 检查Kafka客户端是否存在
-        if not os.path.exists(self.kafka_client):
-            self.logger.error(f"未找到Kafka客户端: {self.kafka_client}")
+        if not self.check_source_ready():
             return False
         
-        self.logger.info(f"Kafka客户端路径验证通过: {self.kafka_client}")
+        if self.multiplex:
+            # 单个消费者，不区分消费模式
+            if self.consumer_mode != "thread":
+                self.logger.info(f"多路复用模式只有一个消费者，忽略消费模式: {self.consumer_mode}")
+            consumers = [("multiplex", self.start_multiplexed_consumer, ())]
+        elif self.consumer_mode == "process":
+            self.start_worker_processes()
+            return True
+        elif self.consumer_mode == "async":
+            try:
+                asyncio.run(self.run_async_consumers())
+            finally:
+                self.async_loop = None
+                self.async_stop = None
+                self.async_executor = None
+            return True
+        else:
+            # 为每个主题启动独立的线程
+            consumers = [(topic_name, self.start_single_kafka_consumer, (topic_name, app_id))
+                         for topic_name, app_id in self.topics]
         
-        # 为每个主题启动独立的线程
-        threads = []
-        for topic_name, app_id in self.topics:
-            thread = threading.Thread(
-                target=self.start_single_kafka_consumer,
-                args=(topic_name, app_id),
-                name=f"kafka-consumer-{topic_name}"
-            )
+        threads = self.consumer_threads
+        for name, target, args in consumers:
+            thread = threading.Thread(target=target, args=args, name=f"kafka-consumer-{name}")
             thread.daemon = True
             thread.start()
             threads.append(thread)
-            self.logger.info(f"已启动消费者线程: {topic_name} -> 应用{app_id}")
+            if self.multiplex:
+                self.logger.info(f"已启动多路复用消费者线程: {self.topic_subscription().describe()}")
+            else:
+                self.logger.info(f"已启动消费者线程: {name} -> 应用{args[1]}")
         
         # 等待所有线程结束
         try:
-            for thread in threads:
-                thread.join()
+            self.wait_for_consumers()
         except KeyboardInterrupt:
             self.logger.info("收到中断信号，正在停止所有消费者...")
-            self.running = False
-            for thread in threads:
-                thread.join(timeout=5)
+            self.request_stop()
+            self.wait_for_consumers()
+    
+    def wait_for_consumers(self):
+        """等待消费者线程全部结束；停止标志被置位（信号处理器）后由本线程中断各消息来源"""
+        for thread in self.consumer_threads:
+            while thread.is_alive():
+                thread.join(0.5)
+                if not self.running:
+                    self.request_stop()
     
     def start_monitoring(self, daemon=True):
         """启动监控"""
@@ -415,9 +4229,9 @@ class DeviceMonitor:
             print("")
             print("功能说明:")
             print(f"  - 监听多个主题: {topic_list}")
-            print("  - 统计所有 onlineStatus=ONLINE 的设备")
-            print("  - 按应用ID分别输出到不同文件")
-            print("  - 自动去重设备序列号 (devSn)")
+            print("  - 按 changeTime 维护每个设备 (devSn) 的最新在线状态")
+            print("  - 按应用ID分别输出当前在线设备到不同文件")
+            print("  - 自动拒绝乱序的状态事件")
             print("  - 实时写入到输出文件")
             print("  - 智能重启机制，持续监控新消息")
             print("")
@@ -436,8 +4250,18 @@ class DeviceMonitor:
         # 设置日志（守护进程模式下重新设置）
         self.setup_logging()
         
+        # 续读模式：优先加载状态快照（含位点），没有快照时加载消费位点检查点
+        if self.resume:
+            if self.load_state_snapshot():
+                pass
+            elif self.checkpoints.load():
+                self.logger.info(f"已加载消费位点检查点: {self.checkpoint_file}")
+            else:
+                self.logger.info(f"未找到可用的消费位点检查点，将从头消费: {self.checkpoint_file}")
+        
         # 创建输出目录和文件
         self.create_output_files()
+        self.open_event_store()
         
         # 构建主题列表和应用ID映射
         topic_list = ",".join([topic for topic, _ in self.topics])
@@ -446,18 +4270,32 @@ class DeviceMonitor:
         self.logger.info("启动设备在线监控器")
         self.logger.info(f"输出目录: {self.output_dir}")
         self.logger.info(f"监听主题: {topic_list}")
+        if self.multiplex:
+            self.logger.info(f"多路复用消费: 单个消费者订阅 {self.topic_subscription().describe()}")
         self.logger.info(f"应用ID映射: {app_id_map}")
         self.logger.info(f"Kafka服务器: {self.bootstrap_servers}")
+        self.logger.info(f"消息来源: {self.source_type}")
+        self.logger.info(f"消息解析后端: {self.parser.name}")
+        self.logger.info(f"输出文件刷盘: 阈值 {self.output_writer.flush_bytes} 字节/"
+                         f"{self.output_writer.flush_interval} 秒, fsync策略: {self.output_writer.fsync_policy}")
+        if self.batch_size > 1:
+            self.logger.info(f"批量消费: 每批最多 {self.batch_size} 条, 最长等待 {self.batch_timeout_ms} 毫秒")
+        else:
+            self.logger.info("批量消费: 关闭（逐条处理）")
         
         # 保存PID
         self.save_pid()
         
-        # 设置信号处理器
+        # 先置位运行标志再设置信号处理器，之后收到的信号都不会被覆盖
+        self.running = True
         signal.signal(signal.SIGINT, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
         
         # 启动监控
-        self.running = True
+        self.start_time = time.time()
+        self.output_writer.start_flusher()
+        self.start_background_tasks()
+        self.start_control_server()
         
         try:
             self.start_kafka_consumers()
@@ -469,25 +4307,78 @@ class DeviceMonitor:
         return True
     
     def stop_monitoring(self):
-        """停止监控"""
-        self.running = False
+        """停止监控并收尾，只执行一次（重复调用直接返回）
+        
+        由主线程在消费者线程、协程或工作进程全部结束之后调用；仍有消费者线程在运行时
+        （直接调用）先请求停止并等待它们结束。随后停止控制套接字与后台定时任务，
+        再保存检查点、整理输出文件、保存快照、导出指标、写出输出缓冲并生成设备索引。
+        """
+        with self.stop_lock:
+            if self.stopped:
+                return
+            self.stopped = True
+        
+        self.request_stop()
+        self.wait_for_consumers()
+        
+        if self.control_server is not None:
+            self.control_server.stop()
+            self.control_server = None
+        
+        # 停止后台定时任务并等待正在执行的任务完成，之后的收尾步骤不再与它们并发
+        self.background_stop.set()
+        for thread in self.background_threads:
+            thread.join()
+        self.background_threads.clear()
+        
+        # 保存最终的消费位点
+        try:
+            self.save_checkpoint()
+        except Exception as e:
+            if hasattr(self, 'logger'):
+                self.logger.error(f"保存消费位点检查点失败: {e}")
         
-        # 终止所有Kafka进程
-        for process in self.kafka_processes:
+        # 输出文件与当前在线集合保持一致
+        if hasattr(self, 'logger'):
             try:
-                process.terminate()
-                process.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                process.kill()
-                process.wait()
-            except Exception:
-                pass
+                self.compact_output_files()
+            except Exception as e:
+                self.logger.error(f"整理输出文件失败: {e}")
+        
+        # 保存最终的状态快照
+        if self.snapshot_interval > 0 and hasattr(self, 'logger'):
+            try:
+                self.save_snapshot()
+            except Exception as e:
+                self.logger.error(f"保存状态快照失败: {e}")
+        
+        # 导出最终指标
+        if self.metrics_interval > 0 and hasattr(self, 'logger'):
+            try:
+                self.write_metrics()
+            except Exception as e:
+                self.logger.error(f"导出指标失败: {e}")
+        
+        # 写出输出文件缓冲，确保退出时不丢失设备
+        try:
+            self.output_writer.close()
+        except Exception as e:
+            if hasattr(self, 'logger'):
+                self.logger.error(f"写出输出文件缓冲失败: {e}")
+        
+        # 设备索引在输出文件写出之后生成，不早于输出文件才会被 show/lookup 使用
+        if hasattr(self, 'logger'):
+            try:
+                self.write_device_indexes()
+            except Exception as e:
+                self.logger.error(f"生成设备索引失败: {e}")
         
-        self.kafka_processes.clear()
         self.remove_pid()
         
         if hasattr(self, 'logger'):
+            self.log_suppressed_summary()
             self.logger.info("设备在线监控器已停止")
+            self.stop_logging()
     
     def stop(self):
         """停止监控器"""
@@ -532,7 +4423,7 @@ class DeviceMonitor:
             return False
     
     def status(self):
-        """查看监控器状态"""
+        """查看监控器状态（守护进程运行时通过控制套接字查询内存状态）"""
         if not self.is_running():
             print("状态: 未运行")
             return False
@@ -544,35 +4435,70 @@ class DeviceMonitor:
         print(f"日志文件: {self.log_file}")
         print(f"输出目录: {self.output_dir}")
         
+        live = query_control(self.control_socket, {'cmd': 'status'})
+        if live and live.get('ok'):
+            print(f"运行时长: {live['uptime']:.0f} 秒, 消息来源: {live['source']}, 解析后端: {live['parser']}")
+            print(f"已处理消息: {live['processed']} 条, 业务消息: {live['business']} 条")
+            print("\n实时统计:")
+            for app_id, app_stats in live['apps'].items():
+                print(f"  应用{app_id}: {app_stats['devices']} 个在线设备, "
+                      f"已知设备 {app_stats['known']} 个, "
+                      f"上线消息 {app_stats['online']} 条, 离线消息 {app_stats['offline']} 条, "
+                      f"乱序事件 {app_stats['stale']} 条")
+            if live.get('pipelines'):
+                print("\n读取/处理队列:")
+                for name, data in live['pipelines'].items():
+                    print(f"  {name}: 深度 {data['depth']}/{data['capacity']}, 高水位 {data['high_water']}, "
+                          f"策略 {data['policy']}, 溢出 {data['spilled']} 批, "
+                          f"阻塞 {data['blocked_seconds']:.1f} 秒")
+            analytics = query_control(self.control_socket, {'cmd': 'analytics', 'top': 3})
+            if analytics and analytics.get('ok') and analytics['apps']:
+                print("\n会话与抖动:")
+                for app_id, data in analytics['apps'].items():
+                    top = ", ".join(f"{item['devSn']}({item['transitions']}次)" for item in data['top_flapping'])
+                    print(f"  应用{app_id}: 状态切换 {data['transitions']} 次, "
+                          f"已结束会话 {data['sessions']['count']} 个, 抖动设备 {data['flapping']} 个"
+                          + (f" ({top})" if top else ""))
+            distinct = query_control(self.control_socket, {'cmd': 'distinct'})
+            if distinct and distinct.get('ok') and distinct['apps']:
+                print("\n每小时去重在线设备:")
+                for app_id, data in distinct['apps'].items():
+                    recent = ", ".join(f"{datetime.fromtimestamp(hour['start']).strftime('%H:00')} {hour['devices']}"
+                                       for hour in data['hours'][-3:])
+                    print(f"  应用{app_id} ({data['mode']}): {recent}")
+        
         # 显示最近的日志
         if self.log_file.exists():
             print("\n最近日志:")
             try:
-                with open(self.log_file, 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-                    for line in lines[-5:]:
-                        print(line.rstrip())
+                for line in tail_lines(self.log_file, 5):
+                    print(line.rstrip())
             except Exception as e:
                 print(f"读取日志文件失败: {e}")
         
-        # 显示输出文件统计
-        if self.output_dir.exists():
+        # 控制套接字不可用时显示输出文件统计
+        if not (live and live.get('ok')) and self.output_dir.exists():
             print("\n输出文件统计:")
             for output_file in self.output_dir.glob("online_devices_*.txt"):
                 if output_file.is_file():
                     app_id = output_file.stem.replace("online_devices_", "")
                     try:
-                        with open(output_file, 'r', encoding='utf-8') as f:
-                            count = sum(1 for line in f if line.strip() and not line.startswith('#'))
+                        count = count_device_list(output_file)
                         print(f"  应用{app_id} ({output_file.name}): {count} 个在线设备")
                     except Exception as e:
                         print(f"  应用{app_id} ({output_file.name}): 读取失败 - {e}")
         
         return True
     
-    def show_devices(self, app_id: str = "10001"):
-        """显示在线设备列表"""
+    def show_devices(self, app_id: str = "10001", offset: int = 0, limit: int = None, prefix: str = None):
+        """显示在线设备列表（守护进程运行时从内存分页读取，否则优先读取已排序的设备索引，再退回输出文件）"""
+        if self.is_running() and self.show_live_devices(app_id, offset, limit, prefix):
+            return True
+        
         output_file = self.output_dir / f"online_devices_{app_id}.txt"
+        index_file = self.index_file(app_id)
+        if is_fresh_index(index_file, output_file):
+            return self.show_indexed_devices(app_id, index_file, offset, limit, prefix)
         
         if not output_file.exists():
             print(f"输出文件不存在: {output_file}")
@@ -587,22 +4513,22 @@ class DeviceMonitor:
         print("=" * 50)
         
         try:
-            device_count = 0
-            with open(output_file, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if line and not line.startswith('#'):
-                        device_count += 1
-                        print(f"{device_count}. {line}")
+            devices = read_device_list(output_file)
+            if prefix:
+                devices = [dev_sn for dev_sn in devices if dev_sn.startswith(prefix)]
+            device_count = len(devices)
+            end = offset + limit if limit is not None else None
+            for i, dev_sn in enumerate(devices[offset:end], offset + 1):
+                print(f"{i}. {dev_sn}")
             
             print("=" * 50)
-            print(f"总计: {device_count} 个在线设备")
+            print(f"总计: {device_count} 个在线设备" + (f"（前缀 {prefix}）" if prefix else ""))
             
             # 显示统计信息
             print("\n统计信息:")
             with open(output_file, 'r', encoding='utf-8') as f:
                 stats_lines = [line.rstrip() for line in f if line.startswith('# ')]
-                for line in stats_lines[-6:]:
+                for line in stats_lines[-8:]:
                     print(line)
             
             return True
@@ -610,19 +4536,510 @@ class DeviceMonitor:
         except Exception as e:
             print(f"读取文件失败: {e}")
             return False
+    
+    def show_indexed_devices(self, app_id: str, index_file: Path, offset: int = 0, limit: int = None,
+                             prefix: str = None) -> bool:
+        """从已排序的设备索引分页显示（按 devSn 排序），只读取本页的设备与文件头中的统计信息"""
+        try:
+            with DeviceIndex(index_file) as index:
+                total, devices = index.page(offset, limit, prefix)
+                stats = index.stats
+        except (OSError, ValueError, struct.error) as e:
+            print(f"读取设备索引失败: {e}")
+            return False
+        
+        print(f"应用{app_id} 在线设备列表 ({index_file}, 按devSn排序):")
+        print("=" * 50)
+        for i, dev_sn in enumerate(devices, offset + 1):
+            print(f"{i}. {dev_sn}")
+        print("=" * 50)
+        print(f"总计: {total} 个在线设备" + (f"（前缀 {prefix}）" if prefix else ""))
+        
+        print("\n统计信息:")
+        print(f"# 应用ID: {app_id}")
+        print(f"# 在线消息数: {stats.get('online', 0)}")
+        print(f"# 离线消息数: {stats.get('offline', 0)}")
+        print(f"# 当前在线设备数: {stats.get('devices', len(devices))}")
+        print(f"# 已知设备数: {stats.get('known', 0)}")
+        print(f"# 乱序事件数: {stats.get('stale', 0)}")
+        print(f"# 统计时间: {stats.get('generated', '-')}")
+        return True
+    
+    def show_live_devices(self, app_id: str, offset: int = 0, limit: int = None, prefix: str = None,
+                          page_size: int = 10000) -> bool:
+        """通过控制套接字分页读取在线设备，套接字不可用时返回 False
+        
+        从头列出时按游标续读；指定 offset 时按偏移分页（每页都需从头跳过 offset 个设备）。
+        """
+        shown = 0
+        total = None
+        position = offset
+        cursor = None if offset else 0
+        while limit is None or shown < limit:
+            count = page_size if limit is None else min(page_size, limit - shown)
+            request = {'cmd': 'devices', 'app_id': app_id, 'limit': count}
+            if cursor is None:
+                request['offset'] = position
+            else:
+                request['cursor'] = cursor
+            if prefix:
+                request['prefix'] = prefix
+            page = query_control(self.control_socket, request)
+            if not page:
+                if total is None:
+                    return False
+                print("控制套接字连接中断")
+                break
+            if not page.get('ok'):
+                print(page.get('error', '查询失败'))
+                return True
+            if total is None:
+                total = page['total']
+                print(f"应用{app_id} 在线设备列表 (实时):")
+                print("=" * 50)
+            for dev_sn in page['devices']:
+                position += 1
+                print(f"{position}. {dev_sn}")
+            shown += len(page['devices'])
+            if cursor is None:
+                if len(page['devices']) < count:
+                    break
+            else:
+                cursor = page['next_cursor']
+                if cursor is None:
+                    break
+        
+        print("=" * 50)
+        print(f"总计: {total} 个在线设备" + (f"（前缀 {prefix}）" if prefix else ""))
+        return True
+    
+    def show_analytics(self, app_id: str = None, top_k: int = None) -> bool:
+        """显示会话时长分布、各窗口切换次数与抖动最严重的设备（需要守护进程运行）"""
+        request = {'cmd': 'analytics', 'top': self.analytics_top_k if top_k is None else top_k}
+        if app_id:
+            request['app_id'] = app_id
+        live = query_control(self.control_socket, request) if self.is_running() else None
+        if not live:
+            print("监控器未运行或控制套接字不可用，会话分析只保存在守护进程内存中")
+            return False
+        if not live.get('ok'):
+            print(live.get('error', '查询失败'))
+            return False
+        
+        for app_id, data in live['apps'].items():
+            print(f"应用{app_id} 会话与抖动分析:")
+            print("=" * 50)
+            sessions = data['sessions']
+            print(f"状态切换: {data['transitions']} 次, 已结束会话: {sessions['count']} 个"
+                  + (f", 平均时长 {sessions['sum'] / sessions['count']:.0f} 秒" if sessions['count'] else ""))
+            
+            print("\n会话时长分布:")
+            previous = 0
+            for bound, count in sessions['buckets'].items():
+                print(f"  <= {float(bound):>8.0f} 秒: {count - previous}")
+                previous = count
+            print(f"  >  {float(bound):>8.0f} 秒: {sessions['count'] - previous}")
+            
+            print(f"\n最近窗口切换次数（每 {data['window_seconds']} 秒）:")
+            for window in data['windows']:
+                start = datetime.fromtimestamp(window['start']).strftime('%Y-%m-%d %H:%M:%S')
+                print(f"  {start}: 上线 {window['online']}, 离线 {window['offline']}")
+            
+            print(f"\n抖动设备: {data['flapping']} 个")
+            for rank, item in enumerate(data['top_flapping'], 1):
+                last_flap = datetime.fromtimestamp(item['last_flap']).strftime('%Y-%m-%d %H:%M:%S')
+                print(f"  {rank}. {item['devSn']}: 累计切换 {item['transitions']} 次, "
+                      f"最近 {self.flap_ring_size} 次切换用时 {item['span']} 秒, 最近一次 {last_flap}")
+            print()
+        return True
+    
+    def show_distinct(self, app_id: str = None) -> bool:
+        """显示各小时去重在线设备数（需要守护进程运行）"""
+        request = {'cmd': 'distinct'}
+        if app_id:
+            request['app_id'] = app_id
+        live = query_control(self.control_socket, request) if self.is_running() else None
+        if not live:
+            print("监控器未运行或控制套接字不可用，去重计数只保存在守护进程内存中"
+                  f"（近似模式的草图文件: {self.sketch_file}，可用 sketches.py merge 查看）")
+            return False
+        if not live.get('ok'):
+            print(live.get('error', '查询失败'))
+            return False
+        
+        for app_id, data in live['apps'].items():
+            approximate = data['mode'] == 'approximate'
+            print(f"应用{app_id} 每小时去重在线设备"
+                  + (f"（近似，相对标准误差 {data['standard_error']:.2%}）:" if approximate else "（精确）:"))
+            print("=" * 50)
+            for hour in data['hours']:
+                start = datetime.fromtimestamp(hour['start']).strftime('%Y-%m-%d %H:00')
+                print(f"  {start}: {hour['devices']}")
+            print(f"最近 {len(data['hours'])} 小时合计: {data['total']} 个设备, "
+                  f"占用内存 {format_bytes(data['memory_bytes'])}")
+            if data['bloom']:
+                bloom = data['bloom']
+                print(f"已见设备(Bloom): 约 {bloom['devices']} 个, {format_bytes(bloom['bytes'])}, "
+                      f"误判率约 {bloom['false_positive_rate']:.3%}")
+            print()
+        return True
+    
+    def device_seen(self, dev_sn: str) -> bool:
+        """查询设备是否在各应用中出现过（近似模式按 Bloom 过滤器，可能误判为出现过）"""
+        live = query_control(self.control_socket, {'cmd': 'seen', 'devSn': dev_sn}) \
+            if self.is_running() else None
+        if not live:
+            print("监控器未运行或控制套接字不可用"
+                  f"（近似模式可用 sketches.py seen 查询草图文件: {self.sketch_file}）")
+            return False
+        if not live.get('ok'):
+            print(live.get('error', '查询失败'))
+            return False
+        seen = False
+        print(f"设备 {dev_sn}:")
+        for app_id, result in live['apps'].items():
+            seen = seen or bool(result)
+            if result is None:
+                print(f"  应用{app_id}: 未记录")
+            elif live['mode'] == 'approximate':
+                print(f"  应用{app_id}: {'可能出现过' if result else '未出现过'}")
+            else:
+                print(f"  应用{app_id}: {'出现过' if result else '未出现过'}")
+        return seen
+    
+    def lookup_device(self, dev_sn: str) -> bool:
+        """查询单个设备在各应用中的状态（守护进程运行时查询内存，否则查找输出文件）"""
+        live = query_control(self.control_socket, {'cmd': 'lookup', 'devSn': dev_sn}) \
+            if self.is_running() else None
+        if live and live.get('ok'):
+            print(f"设备 {dev_sn} (实时):")
+            for app_id, state in live['apps'].items():
+                if state is None:
+                    print(f"  应用{app_id}: 未知")
+                else:
+                    change_time = state['changeTime']
+                    status = "在线" if state['online'] else "离线"
+                    print(f"  应用{app_id}: {status}" + (f", changeTime: {change_time}" if change_time else ""))
+            return True
+        
+        print(f"设备 {dev_sn} (输出文件):")
+        found = False
+        for output_file in sorted(self.output_dir.glob("online_devices_*.txt")):
+            app_id = output_file.stem.replace("online_devices_", "")
+            index_file = self.index_file(app_id)
+            if is_fresh_index(index_file, output_file):
+                # 已排序的设备索引上二分查找，不读取整个设备列表
+                with DeviceIndex(index_file) as index:
+                    online = dev_sn in index
+            else:
+                online = dev_sn in read_device_list(output_file)
+            found = found or online
+            print(f"  应用{app_id}: {'在线' if online else '不在在线列表中'}")
+        return found
+
+
+class WorkerCheckpoints:
+    """工作进程内的消费位点：起始位点来自协调进程，推进的位点随批次增量发回协调进程落盘"""
+    
+    def __init__(self, topic_name: str, start_offsets: Optional[Dict[int, int]]):
+        self.offsets = {topic_name: dict(start_offsets or {})}
+    
+    def get(self, topic: str) -> Dict[int, int]:
+        return dict(self.offsets.get(topic, {}))
+    
+    def update(self, topic: str, positions: Dict[int, int]):
+        self.offsets[topic] = dict(positions)
+
+
+class ConsumerWorker(DeviceMonitor):
+    """多进程模式的工作进程：消费单个主题、解析并聚合，每批把增量发回协调进程
+    
+    复用 DeviceMonitor 的消费循环与聚合逻辑，但不写输出文件；日志记录经同一队列
+    发给协调进程写入日志文件。
+    """
+    
+    def __init__(self, settings: Dict, topic_name: str, start_offsets: Optional[Dict[int, int]],
+                 delta_queue):
+        super().__init__(parser_backend=settings['parser_backend'])
+        for key, value in settings.items():
+            setattr(self, key, value)
+        self.topic_name = topic_name
+        self.delta_queue = delta_queue
+        self.checkpoints = WorkerCheckpoints(topic_name, start_offsets)
+        self.batch_positions: Optional[Dict[int, int]] = None   # 正在处理的批次之后的位点
+        self.shipped_names: Dict[str, int] = {}   # 应用ID -> 已发送的devSn登记数
+        # 输出文件由协调进程写入，工作进程内读取与处理不拆分线程（状态表只在一个分片中）
+        self.pipeline_queue_size = 0
+        
+        handler = logging.handlers.QueueHandler(delta_queue)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger = logging.getLogger(f"{__name__}.worker")
+        self.logger.addHandler(handler)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+    
+    def load_payload(self, app_id: str, payload: Dict):
+        """按协调进程发来的编码表与状态表初始化（续读时含已恢复的设备状态）"""
+        registry = DeviceIdRegistry.from_names(payload['names'])
+        self.registries[app_id] = registry
+        table = DeviceStateTable(registry)
+        table.states.frombytes(payload['states'])
+        table.online = DeviceSet(registry, bitmap=DeviceBitmap(bytearray(payload['bits'])))
+        table.known_count = payload['known']
+        table.stale_count = payload['stale']
+        table.dirty = set()
+        table.analytics = self.new_analytics()
+        self.resume_tables[app_id] = table
+        self.shipped_names[app_id] = len(registry)
+    
+    def new_state_table(self, app_id: str) -> DeviceStateTable:
+        table = super().new_state_table(app_id)
+        table.dirty = set()
+        return table
+    
+    def new_analytics(self) -> Optional[TransitionLog]:
+        """工作进程只暂存状态变化事件，分析、历史记录与去重计数由协调进程完成"""
+        return TransitionLog() if self.flap_ring_size > 0 or self.history_dir or self.distinct_mode else None
+    
+    def new_distinct_counter(self, table: DeviceStateTable) -> None:
+        return None
+    
+    def register_app(self, app_id: str):
+        """工作进程不创建输出文件，新应用随增量交给协调进程登记"""
+        with self.app_lock:
+            if app_id not in self.app_ids:
+                self.app_ids.append(app_id)
+    
+    def consume_batch(self, topic_name: str, app_id: Optional[str], positions: Dict[int, int],
+                      batch: List[str]):
+        """本批之后的位点随本批增量一起发送，协调进程在同一批次边界应用状态与位点"""
+        self.batch_positions = dict(positions) if positions else None
+        super().consume_batch(topic_name, app_id, positions, batch)
+    
+    def process_batch(self, messages: List[str], topic_app_id: str = None):
+        """聚合一批消息并发送增量：新登记的devSn按ID顺序发送一次，状态只发送本批有变化的设备"""
+        shard = self.get_shard()
+        new_devices, offline_devices = self.aggregate_batch(shard, messages, topic_app_id)
+        
+        apps = {}
+        for app_id, table in shard.device_tables.items():
+            names = table.registry.names
+            start = self.shipped_names.get(app_id, 0)
+            new_names = names[start:]
+            self.shipped_names[app_id] = start + len(new_names)
+            
+            dirty = sorted(table.dirty)
+            table.dirty.clear()
+            device_ids = array.array('Q', dirty)
+            state_values = array.array('Q', [table.states[device_id] for device_id in dirty])
+            apps[app_id] = (new_names, device_ids.tobytes(), state_values.tobytes(),
+                            shard.online_count[app_id], shard.offline_count[app_id],
+                            table.known_count, table.stale_count,
+                            table.analytics.take() if table.analytics is not None else None)
+        
+        sources = list(self.message_sources)
+        histogram = shard.parse_histogram
+        self.delta_queue.put(('delta', self.topic_name, {
+            'processed': shard.processed_count,
+            'business': shard.business_msg_count,
+            'system': shard.system_msg_count,
+            'invalid': shard.invalid_msg_count,
+            'messages': shard.topic_messages.get(self.topic_name, 0),
+            'parse': (list(histogram.counts), histogram.sum, histogram.count),
+            'starts': self.source_starts.get(self.topic_name, 0),
+            'opened_at': sources[0].opened_at if sources else None,
+            'apps': apps,
+            'new_devices': new_devices,
+            'offline_devices': offline_devices,
+            'offsets': self.batch_positions,
+        }))
+        self.batch_positions = None
+
+
+def read_io_counters() -> Optional[Dict[str, int]]:
+    """读取本进程的 I/O 计数（Linux /proc/self/io），不可用时返回 None"""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            return {key: int(value) for key, value in
+                    (line.split(':', 1) for line in f if ':' in line)}
+    except OSError:
+        return None
+
+
+def run_consumer_worker(settings: Dict, topic_name: str, app_id: str,
+                        start_offsets: Optional[Dict[int, int]], payload: Dict,
+                        delta_queue, stop_flag):
+    """多进程模式工作进程入口：消费主题直到来源结束或协调进程置位停止标志"""
+    # 终端 Ctrl+C 会发给整个进程组，停止由协调进程统一通知
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    
+    worker = ConsumerWorker(settings, topic_name, start_offsets, delta_queue)
+    worker.load_payload(app_id, payload)
+    
+    def wait_for_stop():
+        while not stop_flag.value:
+            time.sleep(0.2)
+        worker.request_stop()
+    
+    threading.Thread(target=wait_for_stop, name="worker-stop", daemon=True).start()
+    worker.running = True
+    try:
+        worker.start_single_kafka_consumer(topic_name, app_id)
+    finally:
+        # wchar 含经队列管道发给协调进程的字节
+        io = read_io_counters()
+        delta_queue.put(('exit', topic_name, {'seconds': time.perf_counter() - started,
+                                              'cpu_seconds': time.process_time() - cpu_started,
+                                              'write_bytes': io['wchar'] if io else None}))
 
 
 def main():
     """主函数"""
     parser = argparse.ArgumentParser(description="设备在线监控器")
-    parser.add_argument('command', choices=['start', 'stop', 'status', 'show'],
+    parser.add_argument('command', choices=['start', 'stop', 'status', 'show', 'lookup', 'analytics',
+                                            'distinct', 'seen'],
                        help='操作命令')
-    parser.add_argument('app_id', nargs='?', default='10001',
-                       help='应用ID (仅用于show命令)')
+    parser.add_argument('app_id', nargs='?', default=None,
+                       help='应用ID (用于show命令，默认10001；analytics/distinct命令，默认全部) '
+                            '或设备序列号 (用于lookup/seen命令)')
+    parser.add_argument('--offset', type=int, default=0,
+                       help='show命令跳过的设备数（默认0）')
+    parser.add_argument('--limit', type=int, default=None,
+                       help='show命令最多显示的设备数（默认全部）')
+    parser.add_argument('--prefix', default=None,
+                       help='show命令只显示以该前缀开头的设备')
+    parser.add_argument('--parser', default='auto',
+                       choices=['auto'] + list(PARSER_BACKENDS),
+                       help='消息解析后端（默认auto: 优先orjson/ujson，否则标准库json）')
+    
+    parser.add_argument('--batch-size', type=int, default=1000,
+                       help='批量消费每批最多消息条数（默认1000，设为1时逐条处理）')
+    parser.add_argument('--batch-timeout-ms', type=int, default=200,
+                       help='批量消费时首条消息最长等待毫秒数（默认200）')
+    parser.add_argument('--flush-bytes', type=int, default=64 * 1024,
+                       help='输出文件缓冲达到该字节数时写盘（默认65536）')
+    parser.add_argument('--flush-interval', type=float, default=1.0,
+                       help='输出文件缓冲最长停留秒数（默认1.0）')
+    parser.add_argument('--fsync', default='none', choices=BufferedOutputWriter.FSYNC_POLICIES,
+                       help='fsync策略: none-不fsync, periodic-定期fsync, batch-每批fsync（默认none）')
+    
+    parser.add_argument('--source', default='console', choices=SOURCE_TYPES,
+                       help='消息来源: console-kafka-console-consumer.sh子进程, '
+                            'file-回放录制文件, kafka-进程内Kafka客户端（默认console）')
+    parser.add_argument('--replay',
+                       help='file来源的回放文件路径，可用 {topic} 占位符区分主题')
+    
+    parser.add_argument('--consumer-mode', default='thread', choices=CONSUMER_MODES,
+                       help='消费模式: thread-各主题为线程, async-所有主题在一个asyncio事件循环中'
+                            '（适合大量主题）, process-各主题为独立工作进程，可利用多核（默认thread）')
+    
+    parser.add_argument('--topics', type=parse_topic_list, default=None,
+                       help='监听的主题列表，格式 主题[:应用ID],...（省略应用ID时取主题名末尾的数字，'
+                            '默认 s17_dcs_dev_online_10001,s17_dcs_dev_online_10002）')
+    parser.add_argument('--multiplex', action='store_true',
+                       help='多路复用: 单个消费者订阅全部主题，按记录所属主题路由到应用ID'
+                            '（console来源使用kcat）')
+    parser.add_argument('--topic-pattern', default=None,
+                       help='多路复用时按正则订阅主题（代替 --topics 白名单），'
+                            '新主题的应用ID取主题名末尾的数字')
+    parser.add_argument('--multiplex-client', default='kcat',
+                       help='多路复用console来源使用的kcat命令或路径（默认kcat）')
+    
+    parser.add_argument('--pipeline-queue', type=int, default=64,
+                       help='读取线程与处理线程之间的队列容量（批次数，默认64，0表示在读取线程中直接处理）')
+    parser.add_argument('--backpressure', default='block', choices=BatchPipeline.POLICIES,
+                       help='队列满时的背压策略: block-读取线程阻塞, spill-溢出到磁盘（默认block）')
+    parser.add_argument('--spill-dir', default=None,
+                       help='spill策略的溢出文件目录（默认系统临时目录）')
+    
+    parser.add_argument('--resume', action='store_true',
+                       help='从状态快照/消费位点检查点续读，并保留已有的输出文件（默认从头消费）')
+    parser.add_argument('--compact-interval', type=float, default=30.0,
+                       help='有设备离线时按当前在线集合重写输出文件的间隔秒数（默认30.0，0表示仅退出时整理）')
+    parser.add_argument('--index-interval', type=float, default=60.0,
+                       help='重建已排序设备索引（online_devices_*.idx，供show分页/前缀查询与lookup）的间隔秒数'
+                            '（默认60.0，0表示仅退出时生成）')
+    parser.add_argument('--snapshot-interval', type=float, default=60.0,
+                       help='状态快照保存间隔秒数（默认60.0，0表示关闭）')
+    parser.add_argument('--checkpoint-interval', type=float, default=5.0,
+                       help='消费位点检查点保存间隔秒数（默认5.0）')
+    parser.add_argument('--log-max-bytes', type=int, default=50 * 1024 * 1024,
+                       help='日志文件按大小轮转的字节数（默认50MB）')
+    parser.add_argument('--log-backup-count', type=int, default=5,
+                       help='保留的轮转日志文件数（默认5）')
+    parser.add_argument('--log-rotate-when', default=None,
+                       help='按时间轮转日志（如 midnight、H），设置后不再按大小轮转')
+    parser.add_argument('--log-events-per-second', type=int, default=20,
+                       help='每类逐设备事件日志每秒最多条数，超出部分定期汇总（默认20，0表示不限）')
+    parser.add_argument('--flap-threshold', type=int, default=6,
+                       help='抖动判定的切换次数，即每个设备环形缓冲区保留的切换时间个数（默认6，0表示关闭会话分析）')
+    parser.add_argument('--flap-window', type=float, default=900.0,
+                       help='在该秒数内切换 --flap-threshold 次判定为抖动设备（默认900.0）')
+    parser.add_argument('--transition-window', type=float, default=300.0,
+                       help='统计状态切换次数的时间窗口秒数（默认300.0，保留最近12个窗口）')
+    parser.add_argument('--top', type=int, default=10,
+                       help='发布/显示的抖动设备个数（默认10）')
+    parser.add_argument('--history-dir', default=None,
+                       help='事件历史目录：记录每次设备状态变化，供 event_store.py 按时间点/时间段查询（默认不记录）')
+    parser.add_argument('--distinct-counts', default=None, choices=['exact', 'approximate'],
+                       help='统计每小时去重在线设备数: exact-每小时一个位图, approximate-每小时一个'
+                            'HyperLogLog并用Bloom过滤器记录出现过的设备（计数内存与设备数无关，'
+                            '设备状态表仍随设备数增长；默认关闭）')
+    parser.add_argument('--hll-precision', type=int, default=14,
+                       help='HyperLogLog 精度，每小时每应用占 2^精度 字节，相对标准误差约 1.04/sqrt(2^精度)'
+                            '（默认14: 16KB，约0.81%%）；当前在线设备的计数表每应用另占 '
+                            '2^精度×(66-精度)×4 字节（默认约3.3MB）')
+    parser.add_argument('--distinct-hours', type=int, default=48,
+                       help='保留的小时数（默认48）')
+    parser.add_argument('--bloom-capacity', type=int, default=1000000,
+                       help='每个应用 Bloom 过滤器的设计容量（默认1000000，0表示关闭）')
+    parser.add_argument('--bloom-error', type=float, default=0.01,
+                       help='Bloom 过滤器在设计容量内的误判率（默认0.01）')
+    parser.add_argument('--metrics-interval', type=float, default=15.0,
+                       help='指标文件（device_monitor.prom / device_monitor.metrics.json）'
+                            '导出间隔秒数（默认15.0，0表示关闭）')
     
     args = parser.parse_args()
     
-    monitor = DeviceMonitor()
+    monitor = DeviceMonitor(parser_backend=args.parser)
+    monitor.resume = args.resume
+    monitor.checkpoint_interval = args.checkpoint_interval
+    monitor.snapshot_interval = args.snapshot_interval
+    monitor.compact_interval = args.compact_interval
+    monitor.index_interval = args.index_interval
+    monitor.metrics_interval = args.metrics_interval
+    monitor.log_max_bytes = args.log_max_bytes
+    monitor.log_backup_count = args.log_backup_count
+    monitor.log_rotate_when = args.log_rotate_when
+    monitor.event_log.limit = args.log_events_per_second
+    monitor.source_type = args.source
+    monitor.consumer_mode = args.consumer_mode
+    if args.topics:
+        monitor.topics = args.topics
+    monitor.multiplex = args.multiplex or bool(args.topic_pattern)
+    monitor.topic_pattern = args.topic_pattern
+    monitor.multiplex_client = args.multiplex_client
+    monitor.replay_path = args.replay
+    monitor.pipeline_queue_size = args.pipeline_queue
+    monitor.pipeline_policy = args.backpressure
+    monitor.pipeline_spill_dir = args.spill_dir
+    monitor.flap_ring_size = args.flap_threshold
+    monitor.flap_window = args.flap_window
+    monitor.transition_window = args.transition_window
+    monitor.analytics_top_k = args.top
+    monitor.history_dir = os.path.abspath(args.history_dir) if args.history_dir else None
+    monitor.distinct_mode = args.distinct_counts
+    monitor.hll_precision = args.hll_precision
+    monitor.distinct_hours = args.distinct_hours
+    monitor.bloom_capacity = args.bloom_capacity
+    monitor.bloom_error = args.bloom_error
+    monitor.batch_size = args.batch_size
+    monitor.batch_timeout_ms = args.batch_timeout_ms
+    monitor.output_writer.flush_bytes = args.flush_bytes
+    monitor.output_writer.flush_interval = args.flush_interval
+    monitor.output_writer.fsync_policy = args.fsync
     
     if args.command == 'start':
         if monitor.start_monitoring(daemon=True):
@@ -640,7 +5057,29 @@ def main():
             sys.exit(1)
     
     elif args.command == 'show':
-        if not monitor.show_devices(args.app_id):
+        if not monitor.show_devices(args.app_id or '10001', args.offset, args.limit, args.prefix):
+            sys.exit(1)
+    
+    elif args.command == 'lookup':
+        if not args.app_id:
+            print("请指定要查询的设备序列号")
+            sys.exit(1)
+        if not monitor.lookup_device(args.app_id):
+            sys.exit(1)
+    
+    elif args.command == 'analytics':
+        if not monitor.show_analytics(args.app_id):
+            sys.exit(1)
+    
+    elif args.command == 'distinct':
+        if not monitor.show_distinct(args.app_id):
+            sys.exit(1)
+    
+    elif args.command == 'seen':
+        if not args.app_id:
+            print("请指定要查询的设备序列号")
+            sys.exit(1)
+        if not monitor.device_seen(args.app_id):
             sys.exit(1)
 
 
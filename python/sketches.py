@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+sketches.py - 固定内存的近似去重计数
+HyperLogLog 估计去重设备数、Bloom 过滤器判断设备是否出现过，二者都可按应用、时间窗口与
+监控器实例合并（哈希只取决于 devSn，不同进程/机器的结果可直接合并），供设备监控器的近似
+计数模式与跨实例汇总使用
+
+误差:
+  HyperLogLog 占 2^precision 字节，相对标准误差约 1.04/sqrt(2^precision)
+  （precision=14 时 16KB、约0.81%；precision=12 时 4KB、约1.6%），估计值落在
+  真实值 ±3 倍标准误差内的概率约 99.7%；使用 Ertl 改进的估计公式，小基数时同样无偏
+  可删除的 CountingHyperLogLog 与同精度的 HyperLogLog 误差相同，计数表占
+  2^precision×(66-precision)×4 字节（precision=14 时约3.3MB）
+  Bloom 过滤器按容量 n 与目标误判率 p 分配 -n*ln(p)/ln(2)^2 位，从不漏判；
+  插入数不超过容量时误判率不超过 p，超过后按填充率估计实际误判率
+  以上误差上限与监控器近似/精确模式的对比由 test_sketches.py 检查
+
+使用示例:
+  python3 sketches.py merge host1/device_monitor.sketches host2/device_monitor.sketches
+  python3 sketches.py seen 0012AB34CD host1/device_monitor.sketches host2/device_monitor.sketches
+"""
+
+import sys
+import math
+import json
+import array
+import base64
+import random
+import struct
+import hashlib
+import operator
+import argparse
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Iterable
+
+
+def hash64(text: str) -> int:
+    """devSn 的64位哈希（与进程无关，可跨实例合并）"""
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class HyperLogLog:
+    """HyperLogLog 去重计数：2^precision 个6位寄存器（按字节存放），按寄存器取最大值合并"""
+    
+    MAGIC = b'HLL1'
+    
+    __slots__ = ('precision', 'registers', 'shift', 'mask')
+    
+    def __init__(self, precision: int = 14, registers: bytearray = None):
+        if not 4 <= precision <= 18:
+            raise ValueError(f"precision 应在 4~18 之间: {precision}")
+        self.precision = precision
+        self.shift = 64 - precision
+        self.mask = (1 << self.shift) - 1
+        self.registers = registers if registers is not None else bytearray(1 << precision)
+    
+    @staticmethod
+    def standard_error(precision: int) -> float:
+        """相对标准误差"""
+        return 1.04 / math.sqrt(1 << precision)
+    
+    def add_hash(self, value: int):
+        """加入一个64位哈希值：高 precision 位选寄存器，其余位的前导零个数+1 为秩"""
+        index = value >> self.shift
+        rank = self.shift - (value & self.mask).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+    
+    def add(self, text: str):
+        self.add_hash(hash64(text))
+    
+    def update(self, items: Iterable[str]):
+        add_hash = self.add_hash
+        for text in items:
+            add_hash(hash64(text))
+    
+    def count(self) -> float:
+        """估计去重数（Ertl 2017 改进估计，整个基数范围内无需偏差修正表）"""
+        m = len(self.registers)
+        q = self.shift
+        counts = [self.registers.count(k) for k in range(q + 2)]
+        
+        def sigma(x: float) -> float:
+            if x == 1.0:
+                return math.inf
+            y, z = 1.0, x
+            while True:
+                x *= x
+                previous = z
+                z += x * y
+                y += y
+                if z == previous:
+                    return z
+        
+        def tau(x: float) -> float:
+            if x == 0.0 or x == 1.0:
+                return 0.0
+            y, z = 1.0, 1.0 - x
+            while True:
+                x = math.sqrt(x)
+                previous = z
+                y *= 0.5
+                z -= (1.0 - x) ** 2 * y
+                if z == previous:
+                    return z / 3
+        
+        z = m * tau(1.0 - counts[q + 1] / m)
+        for k in range(q, 0, -1):
+            z = 0.5 * (z + counts[k])
+        z += m * sigma(counts[0] / m)
+        if math.isinf(z):
+            return 0.0
+        return m * m / (2 * math.log(2) * z)
+    
+    def merge(self, other: 'HyperLogLog'):
+        """并入另一个同精度的草图（结果等于对两组数据的并集计数）"""
+        if other.precision != self.precision:
+            raise ValueError(f"精度不同的 HyperLogLog 无法合并: {self.precision} != {other.precision}")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+    
+    def copy(self) -> 'HyperLogLog':
+        return HyperLogLog(self.precision, bytearray(self.registers))
+    
+    def to_bytes(self) -> bytes:
+        return self.MAGIC + bytes([self.precision]) + bytes(self.registers)
+    
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'HyperLogLog':
+        if data[:4] != cls.MAGIC:
+            raise ValueError("不是 HyperLogLog 数据")
+        precision = data[4]
+        registers = bytearray(data[5:])
+        if len(registers) != 1 << precision:
+            raise ValueError("HyperLogLog 数据长度不符")
+        return cls(precision, registers)
+    
+    def memory_bytes(self) -> int:
+        return len(self.registers)
+
+
+class CountingHyperLogLog:
+    """可删除元素的 HyperLogLog：每个寄存器按秩记录哈希个数，寄存器取仍有计数的最大秩
+    
+    用于随时间增减的集合（如当前在线设备）：加入与删除都是 O(1)，sketch() 以 O(2^precision)
+    导出与同一集合直接构建完全相同的 HyperLogLog，不需要重新哈希集合中的元素。
+    计数表大小只取决于精度，与元素个数无关；只能删除此前加入过的哈希值。
+    """
+    
+    __slots__ = ('precision', 'shift', 'mask', 'ranks', 'counts', 'registers')
+    
+    def __init__(self, precision: int = 14):
+        if not 4 <= precision <= 18:
+            raise ValueError(f"precision 应在 4~18 之间: {precision}")
+        self.precision = precision
+        self.shift = 64 - precision
+        self.mask = (1 << self.shift) - 1
+        # 秩的取值为 0 ~ shift+1
+        self.ranks = self.shift + 2
+        self.counts = array.array('I', [0]) * ((1 << precision) * self.ranks)
+        self.registers = bytearray(1 << precision)
+    
+    def add_hash(self, value: int):
+        index = value >> self.shift
+        rank = self.shift - (value & self.mask).bit_length() + 1
+        self.counts[index * self.ranks + rank] += 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+    
+    def remove_hash(self, value: int):
+        """删除一个此前加入过的哈希值（没有对应计数时忽略）"""
+        index = value >> self.shift
+        rank = self.shift - (value & self.mask).bit_length() + 1
+        counts = self.counts
+        base = index * self.ranks
+        if not counts[base + rank]:
+            return
+        counts[base + rank] -= 1
+        if not counts[base + rank] and rank == self.registers[index]:
+            while rank > 0 and not counts[base + rank]:
+                rank -= 1
+            self.registers[index] = rank
+    
+    def sketch(self) -> HyperLogLog:
+        """当前集合的 HyperLogLog"""
+        return HyperLogLog(self.precision, bytearray(self.registers))
+    
+    def count(self) -> float:
+        return self.sketch().count()
+    
+    def merge(self, other: 'CountingHyperLogLog'):
+        """并入另一个同精度的计数草图（计数相加）"""
+        if other.precision != self.precision:
+            raise ValueError(f"精度不同的 HyperLogLog 无法合并: {self.precision} != {other.precision}")
+        self.counts = array.array('I', map(operator.add, self.counts, other.counts))
+        self.registers = bytearray(map(max, self.registers, other.registers))
+    
+    def copy(self) -> 'CountingHyperLogLog':
+        sketch = CountingHyperLogLog(self.precision)
+        sketch.counts = array.array('I', self.counts)
+        sketch.registers = bytearray(self.registers)
+        return sketch
+    
+    def memory_bytes(self) -> int:
+        return len(self.counts) * self.counts.itemsize + len(self.registers)
+
+
+class BloomFilter:
+    """Bloom 过滤器：bits 位、hashes 个哈希（由64位哈希按双重哈希派生），按位或合并"""
+    
+    MAGIC = b'BLM1'
+    HEADER = struct.Struct('<QB')
+    
+    __slots__ = ('size', 'hashes', 'bits')
+    
+    def __init__(self, size: int, hashes: int, bits: bytearray = None):
+        self.size = max(8, size)
+        self.hashes = max(1, hashes)
+        self.bits = bits if bits is not None else bytearray((self.size + 7) // 8)
+    
+    @classmethod
+    def for_capacity(cls, capacity: int, error_rate: float = 0.01) -> 'BloomFilter':
+        """按预计元素数与目标误判率分配位数与哈希个数"""
+        capacity = max(1, capacity)
+        size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        hashes = max(1, round(size / capacity * math.log(2)))
+        return cls(size, hashes)
+    
+    def positions(self, value: int) -> List[int]:
+        low = value & 0xFFFFFFFF
+        high = (value >> 32) | 1
+        size = self.size
+        return [(low + i * high) % size for i in range(self.hashes)]
+    
+    def add_hash(self, value: int) -> bool:
+        """加入哈希值，返回此前是否（可能）已存在"""
+        bits = self.bits
+        present = True
+        for position in self.positions(value):
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                present = False
+                bits[position >> 3] |= mask
+        return present
+    
+    def contains_hash(self, value: int) -> bool:
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self.positions(value))
+    
+    def add(self, text: str) -> bool:
+        return self.add_hash(hash64(text))
+    
+    def __contains__(self, text: str) -> bool:
+        return self.contains_hash(hash64(text))
+    
+    def fill_ratio(self) -> float:
+        ones = int.from_bytes(self.bits, 'little').bit_count() if self.bits else 0
+        return ones / self.size
+    
+    def false_positive_rate(self) -> float:
+        """按当前填充率估计的误判率"""
+        return self.fill_ratio() ** self.hashes
+    
+    def approximate_count(self) -> float:
+        """按填充率估计已插入的元素数"""
+        fill = self.fill_ratio()
+        if fill >= 1.0:
+            return math.inf
+        return -self.size / self.hashes * math.log(1.0 - fill)
+    
+    def merge(self, other: 'BloomFilter'):
+        if (other.size, other.hashes) != (self.size, self.hashes):
+            raise ValueError("参数不同的 Bloom 过滤器无法合并")
+        value = int.from_bytes(self.bits, 'little') | int.from_bytes(other.bits, 'little')
+        self.bits = bytearray(value.to_bytes(len(self.bits), 'little'))
+    
+    def copy(self) -> 'BloomFilter':
+        return BloomFilter(self.size, self.hashes, bytearray(self.bits))
+    
+    def to_bytes(self) -> bytes:
+        return self.MAGIC + self.HEADER.pack(self.size, self.hashes) + bytes(self.bits)
+    
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'BloomFilter':
+        if data[:4] != cls.MAGIC:
+            raise ValueError("不是 Bloom 过滤器数据")
+        size, hashes = cls.HEADER.unpack_from(data, 4)
+        bits = bytearray(data[4 + cls.HEADER.size:])
+        if len(bits) != (size + 7) // 8:
+            raise ValueError("Bloom 过滤器数据长度不符")
+        return cls(size, hashes, bits)
+    
+    def memory_bytes(self) -> int:
+        return len(self.bits)
+
+
+def save_sketches(path: Path, apps: Dict[str, Dict]):
+    """保存各应用的小时草图与 Bloom 过滤器（JSON + base64，临时文件 + rename）
+    
+    apps: 应用ID -> {'hours': {小时起始秒: HyperLogLog}, 'bloom': BloomFilter 或 None}
+    """
+    encode = lambda data: base64.b64encode(data).decode('ascii')
+    document = {
+        'version': 1,
+        'apps': {
+            app_id: {
+                'hours': {str(hour): encode(sketch.to_bytes()) for hour, sketch in data['hours'].items()},
+                'bloom': encode(data['bloom'].to_bytes()) if data.get('bloom') is not None else None,
+            }
+            for app_id, data in apps.items()
+        },
+    }
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(document, f)
+    tmp_path.replace(path)
+
+
+def load_sketches(path: Path) -> Dict[str, Dict]:
+    """读取 save_sketches 保存的文件"""
+    with open(path, 'r', encoding='utf-8') as f:
+        document = json.load(f)
+    apps = {}
+    for app_id, data in document['apps'].items():
+        apps[app_id] = {
+            'hours': {int(hour): HyperLogLog.from_bytes(base64.b64decode(text))
+                      for hour, text in data['hours'].items()},
+            'bloom': BloomFilter.from_bytes(base64.b64decode(data['bloom'])) if data.get('bloom') else None,
+        }
+    return apps
+
+
+def merge_sketch_files(paths: List[Path]) -> Dict[str, Dict]:
+    """合并多个实例的草图文件：同一应用同一小时的 HyperLogLog 与同一应用的 Bloom 过滤器分别合并"""
+    merged: Dict[str, Dict] = {}
+    for path in paths:
+        for app_id, data in load_sketches(path).items():
+            target = merged.setdefault(app_id, {'hours': {}, 'bloom': None})
+            for hour, sketch in data['hours'].items():
+                if hour in target['hours']:
+                    target['hours'][hour].merge(sketch)
+                else:
+                    target['hours'][hour] = sketch
+            if data['bloom'] is not None:
+                if target['bloom'] is None:
+                    target['bloom'] = data['bloom']
+                else:
+                    target['bloom'].merge(data['bloom'])
+    return merged
+
+
+def synthetic_devices(count: int, seed: int, prefix: str = "") -> List[str]:
+    """测试用的不重复 devSn"""
+    rng = random.Random(seed)
+    return [f"{prefix}{value:012X}" for value in rng.sample(range(1 << 44), count)]
+
+
+def print_merged(apps: Dict[str, Dict]):
+    """输出合并后各应用每小时的近似去重数，以及跨小时、跨应用的合并结果"""
+    all_hours: Dict[int, HyperLogLog] = {}
+    for app_id, data in sorted(apps.items()):
+        print(f"应用{app_id}:")
+        total = None
+        for hour, sketch in sorted(data['hours'].items()):
+            label = datetime.fromtimestamp(hour).strftime('%Y-%m-%d %H:00')
+            print(f"  {label}: 约 {sketch.count():.0f} 个设备")
+            if total is None:
+                total = sketch.copy()
+            else:
+                total.merge(sketch)
+            if hour in all_hours:
+                all_hours[hour].merge(sketch)
+            else:
+                all_hours[hour] = sketch.copy()
+        if total is not None:
+            print(f"  全部小时: 约 {total.count():.0f} 个设备")
+        if data['bloom'] is not None:
+            print(f"  Bloom: 约 {data['bloom'].approximate_count():.0f} 个已见设备, "
+                  f"误判率约 {data['bloom'].false_positive_rate():.3%}")
+    if len(apps) > 1:
+        print("全部应用:")
+        for hour, sketch in sorted(all_hours.items()):
+            label = datetime.fromtimestamp(hour).strftime('%Y-%m-%d %H:00')
+            print(f"  {label}: 约 {sketch.count():.0f} 个设备")
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="近似去重计数草图（HyperLogLog / Bloom 过滤器）")
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    merge_parser = commands.add_parser('merge', help='合并多个实例的草图文件并输出近似计数')
+    merge_parser.add_argument('files', nargs='+', help='device_monitor.sketches 文件')
+    merge_parser.add_argument('--output', default=None, help='保存合并后的草图文件')
+    
+    seen_parser = commands.add_parser('seen', help='按 Bloom 过滤器判断设备是否在任一实例中出现过')
+    seen_parser.add_argument('dev_sn', help='设备序列号')
+    seen_parser.add_argument('files', nargs='+', help='device_monitor.sketches 文件')
+    
+    args = parser.parse_args()
+    
+    merged = merge_sketch_files([Path(path) for path in args.files])
+    if args.command == 'merge':
+        print_merged(merged)
+        if args.output:
+            save_sketches(Path(args.output), merged)
+            print(f"✓ 已保存合并后的草图: {args.output}")
+    
+    elif args.command == 'seen':
+        found = False
+        for app_id, data in sorted(merged.items()):
+            if data['bloom'] is None:
+                continue
+            seen = args.dev_sn in data['bloom']
+            found = found or seen
+            print(f"  应用{app_id}: {'可能出现过' if seen else '未出现过'}")
+        sys.exit(0 if found else 1)
+
+
+if __name__ == "__main__":
+    main()
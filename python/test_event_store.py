@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+test_event_store.py - 事件历史存储在写入端合并/封存期间的查询测试
+
+运行:
+  python3 -m pytest -q test_event_store.py
+"""
+
+from event_store import (
+    BASE_NAME,
+    RECORD,
+    EventStore,
+    day_name,
+    open_segments,
+    write_segment,
+)
+
+
+def write_records(path, *events):
+    """events: (设备编号, changeTime, 是否在线)，应用编号固定为 0"""
+    write_segment(path, sorted(RECORD.pack(0, device, change_time, online)
+                               for device, change_time, online in events))
+
+
+def segment_paths(day_dir):
+    return [path for _, _, path in EventStore.list_segments(day_dir)]
+
+
+def test_open_segments_relists_when_merge_deletes_listed_segments(tmp_path):
+    day_dir = tmp_path / day_name(1)
+    day_dir.mkdir()
+    write_records(day_dir / "seg-0-00000001.dseg", (1, 100, True), (2, 100, True))
+    write_records(day_dir / "seg-0-00000002.dseg", (1, 200, False))
+    listings = []
+
+    def list_paths():
+        paths = segment_paths(day_dir)
+        if not listings:
+            # 列出之后、打开之前写入端完成了合并
+            EventStore.merge_segments(paths, day_dir / "seg-1-00000003.dseg")
+        listings.append(paths)
+        return paths
+
+    segments = open_segments(list_paths)
+    try:
+        assert [segment.path.name for segment in segments] == ["seg-1-00000003.dseg"]
+        assert sum(segment.count for segment in segments) == 3
+    finally:
+        for segment in segments:
+            segment.close()
+
+
+def test_open_segments_relists_when_base_is_invalidated_after_open(tmp_path):
+    day_dir = tmp_path / day_name(1)
+    day_dir.mkdir()
+    write_records(day_dir / BASE_NAME, (1, 100, True))
+    write_records(day_dir / "seg-0-00000001.dseg", (1, 90000000, False))
+    calls = []
+
+    def list_paths():
+        base = day_dir / BASE_NAME
+        if len(calls) == 1:
+            # 打开之后、重新列出之前写入端写入了更早日期的事件，删除了已失效的基线
+            base.unlink()
+        paths = segment_paths(day_dir) + ([base] if base.exists() else [])
+        calls.append(paths)
+        return paths
+
+    segments = open_segments(list_paths)
+    try:
+        assert [segment.path.name for segment in segments] == ["seg-0-00000001.dseg"]
+        assert len(calls) == 4
+    finally:
+        for segment in segments:
+            segment.close()
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+test_monitor_device_online.py - 设备监控器消息来源与消费路径的端到端测试
+
+运行:
+  python3 -m pytest -q test_monitor_device_online.py
+"""
+
+import re
+import time
+import zlib
+import threading
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Set
+
+import pytest
+
+from device_files import read_device_list
+from message_generator import DEFAULT_TOPICS, MessageGenerator
+from monitor_device_online import (
+    BatchPipeline,
+    DeviceMonitor,
+    OffsetCheckpointStore,
+    StateSnapshotStore,
+    TopicPartition,
+)
+
+
+PARTITIONS = 3
+
+DEV_SN_PATTERN = re.compile(r'"devSn": "([^"]*)"')
+
+
+def message_partition(message: str, partitions: int) -> int:
+    """按 devSn 分区（与以设备为key的生产者一致），没有 devSn 的行进入 0 号分区"""
+    match = DEV_SN_PATTERN.search(message)
+    return zlib.crc32(match.group(1).encode('utf-8')) % partitions if match else 0
+
+
+class SourceRecord(NamedTuple):
+    """单条Kafka记录（字段与 kafka-python 的 ConsumerRecord 一致）"""
+    topic: str
+    partition: int
+    offset: int
+    key: Optional[bytes]
+    value: bytes
+
+
+class StubKafkaConsumer:
+    """内存中的Kafka消费者替身，接口与 kafka-python 的 KafkaConsumer 一致
+
+    用于在没有Kafka集群时驱动 KafkaClientSource；topics 为 主题 -> 消息列表，
+    消息按 message_partition 分配分区（同一设备的消息在同一分区内保持顺序）。
+    消息耗尽后 stop_when_drained=True 时 poll 返回 None 表示流结束，否则返回空结果。
+    """
+
+    def __init__(self, topics: Dict[str, List[str]], partitions: int = 1,
+                 stop_when_drained: bool = True):
+        self.records: Dict[TopicPartition, List[SourceRecord]] = {}
+        for topic_name, messages in topics.items():
+            for partition in range(partitions):
+                self.records[TopicPartition(topic_name, partition)] = []
+            for message in messages:
+                topic_partition = TopicPartition(topic_name, message_partition(message, partitions))
+                partition_records = self.records[topic_partition]
+                partition_records.append(SourceRecord(topic_name, topic_partition.partition,
+                                                      len(partition_records), None,
+                                                      message.encode('utf-8')))
+        self.positions: Dict[TopicPartition, int] = {}
+        self.stop_when_drained = stop_when_drained
+        self.closed = False
+
+    def topics(self) -> Set[str]:
+        return {tp.topic for tp in self.records}
+
+    def partitions_for_topic(self, topic: str) -> Set[int]:
+        return {tp.partition for tp in self.records if tp.topic == topic}
+
+    def assign(self, partitions):
+        self.positions = {TopicPartition(tp.topic, tp.partition): 0 for tp in partitions}
+
+    def seek(self, partition, offset: int):
+        self.positions[TopicPartition(partition.topic, partition.partition)] = offset
+
+    def seek_to_beginning(self, *partitions):
+        for tp in partitions:
+            self.positions[TopicPartition(tp.topic, tp.partition)] = 0
+
+    def poll(self, timeout_ms: int = 0, max_records: int = 500):
+        result: Dict[TopicPartition, List[SourceRecord]] = {}
+        remaining = max_records
+        for topic_partition, position in self.positions.items():
+            if remaining <= 0:
+                break
+            chunk = self.records[topic_partition][position:position + remaining]
+            if chunk:
+                result[topic_partition] = chunk
+                self.positions[topic_partition] = position + len(chunk)
+                remaining -= len(chunk)
+
+        if not result and self.stop_when_drained:
+            return None
+        return result
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture(scope='module')
+def topic_messages() -> Dict[str, List[str]]:
+    """每个默认主题 3000 行合成消息（含噪声行、乱序与无效消息）"""
+    generator = MessageGenerator(devices=200, seed=7)
+    return {topic_name: list(generator.messages(app_id, 3000, topic_name))
+            for topic_name, app_id in DEFAULT_TOPICS}
+
+
+def write_replay_files(work_dir: Path, topic_messages: Dict[str, List[str]]) -> str:
+    """每个主题写一个回放文件，返回带 {topic} 占位符的路径"""
+    for topic_name, messages in topic_messages.items():
+        (work_dir / f"{topic_name}.txt").write_text("\n".join(messages) + "\n", encoding='utf-8')
+    return str(work_dir / "{topic}.txt")
+
+
+def write_multiplexed_file(work_dir: Path, topic_messages: Dict[str, List[str]]) -> str:
+    """按 StubKafkaConsumer 的分区分配写出带 Topic/Partition/Offset 前缀的多路复用回放文件"""
+    lines = []
+    for topic_name, messages in topic_messages.items():
+        offsets = [0] * PARTITIONS
+        for message in messages:
+            partition = message_partition(message, PARTITIONS)
+            lines.append(f"Topic:{topic_name}\tPartition:{partition}\tOffset:{offsets[partition]}\t{message}")
+            offsets[partition] += 1
+    path = work_dir / "multiplexed.txt"
+    path.write_text("\n".join(lines) + "\n", encoding='utf-8')
+    return str(path)
+
+
+def run_monitor(work_dir: Path, inspect=None, **settings) -> Dict:
+    """在工作目录中端到端运行一次 DeviceMonitor，返回统计、落盘位点与输出文件内容
+
+    inspect(monitor) 在消费结束、停止之前调用，返回值放在结果的 inspected 中。
+    """
+    work_dir.mkdir(parents=True, exist_ok=True)
+    monitor = DeviceMonitor()
+    monitor.pid_file = work_dir / "device_monitor.pid"
+    monitor.output_dir = work_dir / "output"
+    monitor.log_file = work_dir / "device_monitor.log"
+    monitor.checkpoint_file = work_dir / "device_monitor.offsets.json"
+    monitor.checkpoints = OffsetCheckpointStore(monitor.checkpoint_file)
+    monitor.snapshots = StateSnapshotStore(work_dir / "device_monitor.snapshot")
+    monitor.control_socket = work_dir / "device_monitor.sock"
+    monitor.metrics_interval = 0
+    monitor.batch_size = 100
+    for name, value in settings.items():
+        setattr(monitor, name, value)
+
+    monitor.setup_logging()
+    monitor.create_output_files()
+    monitor.running = True
+    monitor.start_time = time.time()
+    monitor.output_writer.start_flusher()
+    monitor.start_kafka_consumers()
+
+    processed = monitor.processed_count
+    stats = monitor.snapshot_stats()
+    inspected = inspect(monitor) if inspect is not None else None
+    monitor.stop_monitoring()
+
+    checkpoints = OffsetCheckpointStore(monitor.checkpoint_file)
+    checkpoints.load()
+    return {
+        'processed': processed,
+        'stats': stats,
+        'inspected': inspected,
+        'offsets': checkpoints.copy(),
+        'outputs': {path.name: sorted(read_device_list(path))
+                    for path in sorted(monitor.output_dir.glob("*.txt"))},
+    }
+
+
+def stub_factory(topic_messages: Dict[str, List[str]]):
+    def factory(**config):
+        return StubKafkaConsumer(topic_messages, partitions=PARTITIONS)
+    return factory
+
+
+def expected_offsets(topic_messages: Dict[str, List[str]]) -> Dict[str, Dict[int, int]]:
+    offsets = {}
+    for topic_name, messages in topic_messages.items():
+        partitions = [message_partition(message, PARTITIONS) for message in messages]
+        offsets[topic_name] = {partition: partitions.count(partition) for partition in range(PARTITIONS)}
+    return offsets
+
+
+def test_kafka_client_source_matches_file_source(tmp_path, topic_messages):
+    replay_path = write_replay_files(tmp_path, topic_messages)
+    from_file = run_monitor(tmp_path / "file", source_type="file", replay_path=replay_path)
+    from_kafka = run_monitor(tmp_path / "kafka", source_type="kafka",
+                             kafka_consumer_factory=stub_factory(topic_messages))
+
+    assert from_file['processed'] == sum(len(messages) for messages in topic_messages.values())
+    assert from_kafka['processed'] == from_file['processed']
+    assert from_kafka['stats'] == from_file['stats']
+    assert from_kafka['outputs'] == from_file['outputs']
+    assert from_kafka['offsets'] == expected_offsets(topic_messages)
+
+
+def test_multiplexed_kafka_source_matches_multiplexed_file_source(tmp_path, topic_messages):
+    replay_path = write_multiplexed_file(tmp_path, topic_messages)
+    from_file = run_monitor(tmp_path / "file", source_type="file", multiplex=True,
+                            replay_path=replay_path)
+    from_kafka = run_monitor(tmp_path / "kafka", source_type="kafka", multiplex=True,
+                             kafka_consumer_factory=stub_factory(topic_messages))
+
+    assert from_file['processed'] == sum(len(messages) for messages in topic_messages.values())
+    assert from_kafka['processed'] == from_file['processed']
+    assert from_kafka['stats'] == from_file['stats']
+    assert from_kafka['outputs'] == from_file['outputs']
+    # 多路复用来源按记录自带的主题/分区/offset推进位点，两种来源落盘的位点一致
+    assert from_file['offsets'] == expected_offsets(topic_messages)
+    assert from_kafka['offsets'] == from_file['offsets']
+
+
+def test_devices_control_paging(tmp_path, topic_messages):
+    app_id = DEFAULT_TOPICS[0][1]
+
+    def page_through(monitor):
+        by_offset = monitor.handle_control({'cmd': 'devices', 'app_id': app_id, 'offset': 5, 'limit': 7})
+        pages = [monitor.handle_control({'cmd': 'devices', 'app_id': app_id, 'cursor': 0, 'limit': 40})]
+        while pages[-1]['next_cursor'] is not None:
+            pages.append(monitor.handle_control({'cmd': 'devices', 'app_id': app_id,
+                                                 'cursor': pages[-1]['next_cursor'], 'limit': 40}))
+        return by_offset, pages
+
+    replay_path = write_replay_files(tmp_path, topic_messages)
+    result = run_monitor(tmp_path / "run", source_type="file", replay_path=replay_path,
+                         inspect=page_through)
+    by_offset, pages = result['inspected']
+    total = result['stats'][app_id]['devices']
+
+    # 偏移分页只带 offset，游标分页只带 next_cursor；总数只在从头读取时给出
+    assert set(by_offset) == {'ok', 'app_id', 'offset', 'devices', 'total'}
+    assert by_offset['offset'] == 5 and by_offset['total'] == total
+    assert set(pages[0]) == {'ok', 'app_id', 'devices', 'next_cursor', 'total'}
+    assert all(set(page) == {'ok', 'app_id', 'devices', 'next_cursor'} for page in pages[1:])
+
+    listed = [dev_sn for page in pages for dev_sn in page['devices']]
+    assert len(listed) == total == pages[0]['total']
+    assert by_offset['devices'] == listed[5:12]
+
+
+@pytest.mark.parametrize('consumer_mode', ['process', 'async'])
+def test_consumer_mode_matches_thread_mode(tmp_path, topic_messages, consumer_mode):
+    replay_path = write_replay_files(tmp_path, topic_messages)
+    threaded = run_monitor(tmp_path / "thread", source_type="file", replay_path=replay_path)
+    other = run_monitor(tmp_path / consumer_mode, source_type="file", replay_path=replay_path,
+                        consumer_mode=consumer_mode)
+
+    assert other['processed'] == threaded['processed']
+    assert other['stats'] == threaded['stats']
+    assert other['outputs'] == threaded['outputs']
+    assert other['offsets'] == threaded['offsets']
+
+
+def test_batch_pipeline_block_policy_waits_for_room():
+    pipeline = BatchPipeline("block", maxsize=2)
+    pipeline.put(["a"], {0: 1})
+    pipeline.put(["b"], {0: 2})
+    writer = threading.Thread(target=pipeline.put, args=(["c"], {0: 3}))
+    writer.start()
+    writer.join(0.2)
+    # 队列满时读取线程阻塞，不溢出
+    assert writer.is_alive()
+    assert pipeline.depth() == 2
+
+    assert pipeline.get(timeout=1) == (["a"], {0: 1})
+    writer.join(1)
+    assert not writer.is_alive()
+    assert [pipeline.get(timeout=1) for _ in range(2)] == [(["b"], {0: 2}), (["c"], {0: 3})]
+    stats = pipeline.stats()
+    assert stats['spilled'] == 0 and stats['high_water'] == 2
+    assert stats['blocked_seconds'] > 0
+
+
+def test_batch_pipeline_spill_round_trip_keeps_order(tmp_path):
+    pipeline = BatchPipeline("spill", maxsize=2, policy='spill', spill_dir=tmp_path)
+    items = [([f"message-{index}", "其他"], {0: index, 1: index * 2}) for index in range(10)]
+    for batch, positions in items[:6]:
+        pipeline.put(batch, positions)
+    # 读取线程不阻塞，超出容量的批次写入溢出文件
+    assert pipeline.depth() == 6 and pipeline.stats()['spilled'] == 4
+
+    received = [pipeline.get(timeout=1) for _ in range(3)]
+    # 溢出未清空时新批次也进入溢出文件，保持先进先出
+    for batch, positions in items[6:]:
+        pipeline.put(batch, positions)
+    while pipeline.depth():
+        received.append(pipeline.get(timeout=1))
+
+    assert received == items
+    stats = pipeline.stats()
+    assert stats['spilled'] == 8 and stats['spill_bytes'] == 0
+    assert pipeline.get(timeout=0) is None
+
+
+def test_batch_pipeline_failure_commits_nothing_and_discards_queue():
+    committed = []
+    pipeline = BatchPipeline("fail", maxsize=4, on_commit=committed.append)
+    for index in range(3):
+        pipeline.put([str(index)], {0: index + 1})
+
+    batch, positions = pipeline.get(timeout=1)
+    pipeline.done(positions)
+    pipeline.get(timeout=1)
+    pipeline.fail(ValueError("boom"))
+
+    # 失败批次的位点不提交，排队的批次丢弃，读取线程得知失败后从已提交的位点重新读取
+    assert committed == [{0: 1}]
+    assert pipeline.depth() == 0 and pipeline.wait_drained(0)
+    with pytest.raises(RuntimeError):
+        pipeline.check()
+    pipeline.put(["ignored"], {0: 9})
+    assert pipeline.depth() == 0
+
+    pipeline.reset()
+    pipeline.check()
+    pipeline.put(["2"], {0: 3})
+    assert pipeline.get(timeout=1) == (["2"], {0: 3})
+
+
+def new_monitor(work_dir: Path) -> DeviceMonitor:
+    work_dir.mkdir(parents=True, exist_ok=True)
+    monitor = DeviceMonitor()
+    monitor.pid_file = work_dir / "device_monitor.pid"
+    monitor.output_dir = work_dir / "output"
+    monitor.log_file = work_dir / "device_monitor.log"
+    monitor.checkpoint_file = work_dir / "device_monitor.offsets.json"
+    monitor.checkpoints = OffsetCheckpointStore(monitor.checkpoint_file)
+    monitor.setup_logging()
+    monitor.create_output_files()
+    return monitor
+
+
+def test_failed_batch_rolls_back_counters_and_replays_once(tmp_path, topic_messages):
+    topic_name, app_id = DEFAULT_TOPICS[0]
+    messages = topic_messages[topic_name]
+    first, second = messages[:1500], messages[1500:]
+
+    clean = new_monitor(tmp_path / "clean")
+    clean.consume_batch(topic_name, app_id, {0: 1500}, first)
+    clean.consume_batch(topic_name, app_id, {0: 3000}, second)
+
+    monitor = new_monitor(tmp_path / "failed")
+    monitor.consume_batch(topic_name, app_id, {0: 1500}, first)
+    before = (monitor.processed_count, monitor.snapshot_stats())
+
+    def fail_write(new_devices, offline_devices):
+        raise OSError("disk full")
+
+    monitor.write_batch_changes = fail_write
+    with pytest.raises(OSError):
+        monitor.consume_batch(topic_name, app_id, {0: 3000}, second)
+    # 设备状态已更新，但计数器与位点都停留在失败批次之前
+    assert monitor.checkpoints.get(topic_name) == {0: 1500}
+    assert monitor.processed_count == before[0]
+    stats = monitor.snapshot_stats()
+    assert {key: stats[app_id][key] for key in ('online', 'offline', 'stale')} == \
+        {key: before[1][app_id][key] for key in ('online', 'offline', 'stale')}
+
+    # 从已提交的位点重新读取：消息计数只增加一次，设备状态与没有失败时一致；
+    # 乱序事件数按至少一次计（被同批更晚事件覆盖的事件重放时计为乱序）
+    del monitor.write_batch_changes
+    monitor.consume_batch(topic_name, app_id, {0: 3000}, second)
+    assert monitor.processed_count == clean.processed_count
+    stats, expected = monitor.snapshot_stats()[app_id], clean.snapshot_stats()[app_id]
+    assert stats['stale'] >= expected['stale']
+    assert dict(stats, stale=0) == dict(expected, stale=0)
+    assert sorted(monitor.device_table(app_id).online) == sorted(clean.device_table(app_id).online)
+    assert monitor.checkpoints.get(topic_name) == {0: 3000}
+
+    # 失败批次未追加的在线设备由整理输出文件补上
+    monitor.compact_output_files()
+    monitor.output_writer.flush()
+    output_file = monitor.output_dir / f"online_devices_{app_id}.txt"
+    assert sorted(read_device_list(output_file)) == sorted(monitor.device_table(app_id).online)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+test_sketches.py - 近似去重计数草图与每小时去重计数的测试
+
+运行:
+  python3 -m pytest -q test_sketches.py
+"""
+
+import random
+
+import pytest
+
+from device_ids import DeviceIdRegistry
+from message_generator import MessageGenerator, write_topic_files
+from monitor_device_online import (
+    DeviceMonitor,
+    HourlyDistinctCounter,
+    OffsetCheckpointStore,
+    StateSnapshotStore,
+)
+from sketches import (
+    BloomFilter,
+    CountingHyperLogLog,
+    HyperLogLog,
+    hash64,
+    load_sketches,
+    synthetic_devices,
+)
+
+
+HOUR_MS = HourlyDistinctCounter.HOUR_MS
+
+
+@pytest.mark.parametrize('precision', [10, 14])
+@pytest.mark.parametrize('count', [10, 1000, 50000])
+def test_hyperloglog_error_within_three_standard_errors(precision, count):
+    devices = synthetic_devices(count, seed=count)
+    sketch = HyperLogLog(precision)
+    sketch.update(devices)
+    sketch.update(devices[:count // 2])
+    error = abs(sketch.count() - count) / count
+    assert error <= 3 * HyperLogLog.standard_error(precision)
+
+
+def test_hyperloglog_merge_equals_union():
+    left = synthetic_devices(20000, seed=1, prefix="L")
+    right = synthetic_devices(20000, seed=2, prefix="R") + left[:5000]
+    a, b, union = HyperLogLog(12), HyperLogLog(12), HyperLogLog(12)
+    a.update(left)
+    b.update(right)
+    union.update(left + right)
+    a.merge(b)
+    assert a.registers == union.registers
+    exact = len(set(left) | set(right))
+    assert abs(a.count() - exact) / exact <= 3 * HyperLogLog.standard_error(12)
+
+
+def test_hyperloglog_merge_rejects_different_precision():
+    with pytest.raises(ValueError):
+        HyperLogLog(12).merge(HyperLogLog(14))
+
+
+def test_hyperloglog_serialization_round_trip():
+    sketch = HyperLogLog(10)
+    sketch.update(synthetic_devices(1000, seed=5))
+    restored = HyperLogLog.from_bytes(sketch.to_bytes())
+    assert restored.precision == 10
+    assert restored.registers == sketch.registers
+
+
+def test_bloom_filter_false_positive_rate():
+    capacity, error_rate = 20000, 0.01
+    bloom = BloomFilter.for_capacity(capacity, error_rate)
+    members = synthetic_devices(capacity, seed=7, prefix="M")
+    for dev_sn in members:
+        bloom.add(dev_sn)
+    assert all(dev_sn in bloom for dev_sn in members)
+    probes = synthetic_devices(capacity, seed=8, prefix="P")
+    false_positive = sum(dev_sn in bloom for dev_sn in probes) / len(probes)
+    # 抽样波动余量 1.5 倍
+    assert false_positive <= error_rate * 1.5
+    assert bloom.false_positive_rate() <= error_rate * 1.5
+
+
+def test_bloom_filter_merge_contains_both_sides():
+    a = BloomFilter.for_capacity(1000)
+    b = BloomFilter.for_capacity(1000)
+    left = synthetic_devices(500, seed=1, prefix="L")
+    right = synthetic_devices(500, seed=2, prefix="R")
+    for dev_sn in left:
+        a.add(dev_sn)
+    for dev_sn in right:
+        b.add(dev_sn)
+    a.merge(b)
+    assert all(dev_sn in a for dev_sn in left + right)
+    with pytest.raises(ValueError):
+        a.merge(BloomFilter.for_capacity(10))
+
+
+def test_counting_hyperloglog_matches_rebuilt_sketch_after_removals():
+    rng = random.Random(3)
+    counting = CountingHyperLogLog(10)
+    present = set()
+    devices = synthetic_devices(5000, seed=9)
+    for _ in range(30000):
+        dev_sn = rng.choice(devices)
+        if dev_sn in present:
+            counting.remove_hash(hash64(dev_sn))
+            present.discard(dev_sn)
+        else:
+            counting.add_hash(hash64(dev_sn))
+            present.add(dev_sn)
+    rebuilt = HyperLogLog(10)
+    rebuilt.update(present)
+    assert counting.sketch().registers == rebuilt.registers
+
+    for dev_sn in list(present):
+        counting.remove_hash(hash64(dev_sn))
+    assert not any(counting.registers)
+    assert counting.count() == 0.0
+
+
+def test_counting_hyperloglog_merge():
+    left = synthetic_devices(3000, seed=1, prefix="L")
+    right = synthetic_devices(3000, seed=2, prefix="R")
+    a, b = CountingHyperLogLog(10), CountingHyperLogLog(10)
+    for dev_sn in left:
+        a.add_hash(hash64(dev_sn))
+    for dev_sn in right:
+        b.add_hash(hash64(dev_sn))
+    merged = a.copy()
+    merged.merge(b)
+    for dev_sn in left:
+        merged.remove_hash(hash64(dev_sn))
+    assert merged.registers == b.registers
+    # 合并的是副本
+    assert a.registers != merged.registers
+
+
+def hour_counts(counter: HourlyDistinctCounter):
+    return {hour['start'] // 3600: hour['devices'] for hour in counter.summary()['hours']}
+
+
+@pytest.mark.parametrize('approximate', [False, True])
+def test_hourly_distinct_rollover(approximate):
+    registry = DeviceIdRegistry()
+    counter = HourlyDistinctCounter(registry, approximate, precision=10, hour_count=3)
+    a, b, c, d = (registry.intern(dev_sn) for dev_sn in ("A", "B", "C", "D"))
+    start = 1000 * HOUR_MS
+
+    counter.record(a, True, start + 1, known=False)
+    counter.record(b, True, start + 2, known=False)
+    counter.record(b, False, start + 3)
+    assert hour_counts(counter) == {1000: 2}
+
+    # 进入新小时时仍在线的设备计入新小时
+    counter.record(c, True, start + HOUR_MS + 5, known=False)
+    assert hour_counts(counter) == {1000: 2, 1001: 2}
+
+    # 跳过的小时同样以当前在线设备开始，超出保留范围的小时被移出
+    counter.record(a, False, start + 3 * HOUR_MS + 1)
+    assert hour_counts(counter) == {1001: 2, 1002: 2, 1003: 2}
+    assert counter.summary()['total'] == 2
+
+    # 早于保留范围的上线事件不计入小时，但设备仍在线
+    counter.record(d, True, start + 5, known=False)
+    counter.record(b, True, start + 4 * HOUR_MS, known=True)
+    assert hour_counts(counter) == {1002: 2, 1003: 2, 1004: 3}
+
+
+def test_hourly_distinct_approximate_matches_exact_sets():
+    registry = DeviceIdRegistry()
+    exact = HourlyDistinctCounter(registry, False, hour_count=48)
+    approximate = HourlyDistinctCounter(registry, True, precision=12, hour_count=48)
+    rng = random.Random(11)
+    devices = [registry.intern(dev_sn) for dev_sn in synthetic_devices(2000, seed=4)]
+    online = {}
+    change_time = 1000 * HOUR_MS
+    for _ in range(40000):
+        change_time += rng.randrange(0, 2000)
+        device_id = rng.choice(devices)
+        previous = online.get(device_id)
+        state = not previous if previous is not None else rng.random() < 0.8
+        online[device_id] = state
+        for counter in (exact, approximate):
+            counter.record(device_id, state, change_time, previous is not None)
+
+    assert sorted(exact.hours) == sorted(approximate.hours)
+    for hour, bitmap in exact.hours.items():
+        expected = HyperLogLog(12)
+        expected.update(registry.names[device_id] for device_id in bitmap)
+        assert approximate.hours[hour].registers == expected.registers
+    # 近似模式的计数内存与设备数无关
+    assert approximate.online.memory_bytes() == CountingHyperLogLog(12).memory_bytes()
+
+
+def run_distinct_mode(work_dir, replay, mode, precision):
+    """以 exact 或 approximate 去重模式端到端运行监控器，返回 distinct_summary()"""
+    monitor = DeviceMonitor()
+    monitor.pid_file = work_dir / f"{mode}.pid"
+    monitor.output_dir = work_dir / mode
+    monitor.log_file = work_dir / f"{mode}.log"
+    monitor.checkpoints = OffsetCheckpointStore(work_dir / f"{mode}.offsets.json")
+    monitor.snapshots = StateSnapshotStore(work_dir / f"{mode}.snapshot")
+    monitor.control_socket = work_dir / f"{mode}.sock"
+    monitor.sketch_file = work_dir / f"{mode}.sketches"
+    monitor.metrics_interval = 0
+    monitor.source_type = "file"
+    monitor.replay_path = replay
+    monitor.distinct_mode = mode
+    monitor.hll_precision = precision
+    monitor.setup_logging()
+    monitor.create_output_files()
+    monitor.running = True
+    monitor.start_kafka_consumers()
+    summary = monitor.distinct_summary()
+    monitor.save_distinct_sketches()
+    monitor.stop_monitoring()
+    return summary
+
+
+def test_monitor_approximate_mode_matches_exact_mode(tmp_path):
+    precision = 14
+    replay = str(tmp_path / "{topic}.txt")
+    # 每条消息间隔约1秒，覆盖若干小时
+    write_topic_files(MessageGenerator(devices=1000, seed=3, interval_ms=1000), replay, 20000)
+    exact = run_distinct_mode(tmp_path, replay, 'exact', precision)
+    approximate = run_distinct_mode(tmp_path, replay, 'approximate', precision)
+
+    bound = 3 * HyperLogLog.standard_error(precision)
+    assert sorted(exact) == sorted(approximate)
+    hours = 0
+    for app_id, summary in exact.items():
+        estimates = {hour['start']: hour['devices'] for hour in approximate[app_id]['hours']}
+        for hour in summary['hours']:
+            if hour['devices']:
+                hours += 1
+                assert abs(estimates[hour['start']] - hour['devices']) / hour['devices'] <= bound
+        # 全部小时合并后的去重数
+        assert abs(approximate[app_id]['total'] - summary['total']) / summary['total'] <= bound
+    assert hours > 1
+
+    # 导出的草图文件与内存中的每小时估计一致
+    saved = load_sketches(tmp_path / "approximate.sketches")
+    for app_id, summary in approximate.items():
+        for hour in summary['hours']:
+            assert round(saved[app_id]['hours'][hour['start']].count()) == hour['devices']